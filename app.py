@@ -7,52 +7,65 @@ Userbot-only combined app.py
 - YouTube playback (extract) uses yt-dlp (yt_dlp).
 Replace existing app.py with this file.
 """
+import time
+_IMPORT_STARTED = time.perf_counter()
+
 import os
 import re
-import time
 import asyncio
 import logging
 import random
 import inspect
+import hashlib
+import math
+import io
+import shlex
+import json
+import bisect
+import contextvars
+import functools
+import threading
+import traceback
+import sys
+import multiprocessing
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from collections import OrderedDict, deque
 from typing import Optional, Dict, Any, List
 from urllib.parse import urlparse, parse_qs
+try:
+    import re._parser as _sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse as _sre_parse
 
 from dotenv import load_dotenv
 load_dotenv()
 
-from pyrogram import Client, filters
+from pyrogram import Client, filters, raw, utils, StopPropagation
 from pyrogram.types import (
     Message,
     CallbackQuery,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaPhoto,
 )
 from pyrogram.errors import FloodWait, ReactionInvalid, PeerIdInvalid, RPCError
+from pyrogram.storage import FileStorage, MemoryStorage
 
-# optional pytgcalls
-try:
-    from pytgcalls import PyTgCalls
-    from pytgcalls.types import MediaStream
-except Exception:
-    PyTgCalls = None
-    MediaStream = None
-
-# yt-dlp
-try:
-    import yt_dlp as youtube_dl
-except Exception:
-    youtube_dl = None
-
-# thumbnail & helpers
-import aiohttp
-import aiofiles
-from PIL import Image, ImageDraw, ImageEnhance, ImageFilter, ImageFont, ImageOps
+# Heavy optional subsystems (pytgcalls, yt-dlp, PIL, aiohttp/aiofiles, pymongo) are imported
+# on first use so the userbot connects and starts reacting as fast as possible.
+PyTgCalls = None
+MediaStream = None
+AudioParameters = None
 
-# optional DB
-try:
-    from pymongo import MongoClient
-except Exception:
-    MongoClient = None
+# card rendering and yt-dlp extraction live in a side-effect-free module so shard workers can import it
+import shard_worker
+from shard_worker import (
+    THUMB_CACHE_DIR, PLAYLIST_LIMIT, AUDIO_PROFILES, AUDIO_PROFILE, ExtractorUnavailable,
+    looks_like_url, extract_audio_url, extract_tracks, track_to_entry, _render_overlay_sync,
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("dlk_userbot")
@@ -75,53 +88,1081 @@ if not API_ID or not API_HASH:
     raise SystemExit(1)
 
 # ===================== CLIENTS =====================
-user_app = Client(
-    name="userbot",
-    api_id=API_ID,
-    api_hash=API_HASH,
-    session_string=SESSION_STRING,
-    in_memory=True,
-)
+# Optional on-disk sessions: keeps Pyrogram's peer cache across restarts (no PeerIdInvalid / resolve RPCs)
+PERSIST_SESSIONS = os.environ.get("PERSIST_SESSIONS", "0") == "1"
+DATA_DIR = os.environ.get("DATA_DIR", "data")
+SESSION_FLUSH_INTERVAL = float(os.environ.get("SESSION_FLUSH_INTERVAL", "60") or 60)
+
+class BootstrapFileStorage(FileStorage):
+    """SQLite session file under DATA_DIR, seeded from a session string.
+
+    The string is only used when the file is new or belongs to a different login
+    (auth key changed); otherwise the stored session and its peer cache are reused.
+    """
+
+    def __init__(self, name: str, workdir: Path, session_string: Optional[str]):
+        super().__init__(name, workdir)
+        self.bootstrap_string = session_string
+
+    async def open(self):
+        await super().open()
+        if not self.bootstrap_string:
+            return
+        seed = MemoryStorage(self.name, self.bootstrap_string)
+        await seed.open()
+        try:
+            seed_key = await seed.auth_key()
+            if await self.auth_key() == seed_key:
+                return
+            with self.conn:
+                self.conn.execute("DELETE FROM peers")
+            await self.dc_id(await seed.dc_id())
+            await self.api_id(await seed.api_id())
+            await self.test_mode(await seed.test_mode())
+            await self.auth_key(seed_key)
+            await self.user_id(await seed.user_id())
+            await self.is_bot(await seed.is_bot())
+            await self.date(0)
+            await self.save()
+            logger.info(f"Seeded session file {self.database} from session string")
+        finally:
+            await seed.close()
+
+# Large replied audio is fetched as N byte ranges at once; each range is one media connection,
+# so Pyrogram's transfer semaphore has to allow that many.
+DOWNLOAD_PARALLELISM = max(1, int(os.environ.get("DOWNLOAD_PARALLELISM", "4") or 4))
+PARALLEL_DOWNLOAD_MIN = int(os.environ.get("PARALLEL_DOWNLOAD_MIN", str(8 * 1024 * 1024)) or 0)  # bytes
+
+def make_client(name: str, session_string: Optional[str]) -> Client:
+    if not PERSIST_SESSIONS:
+        return Client(name, api_id=API_ID, api_hash=API_HASH, session_string=session_string, in_memory=True,
+                      max_concurrent_transmissions=DOWNLOAD_PARALLELISM)
+    os.makedirs(DATA_DIR, exist_ok=True)
+    client = Client(name, api_id=API_ID, api_hash=API_HASH, workdir=DATA_DIR, max_concurrent_transmissions=DOWNLOAD_PARALLELISM)
+    client.storage = BootstrapFileStorage(name, Path(DATA_DIR), session_string)
+    return client
+
+async def session_flush_loop():
+    # commit peers learned since the last flush so a crash does not lose them
+    while True:
+        await asyncio.sleep(SESSION_FLUSH_INTERVAL)
+        for client in [user_app] + assistants:
+            try:
+                if client.is_connected:
+                    await client.storage.save()
+            except Exception as e:
+                logger.debug(f"Session flush failed for {client.name}: {e}")
+
+user_app = make_client("userbot", SESSION_STRING)
+
+ASSISTANT_FAILURE_THRESHOLD = int(os.environ.get("ASSISTANT_FAILURE_THRESHOLD", "3") or 3)
+ASSISTANT_HEALTH_INTERVAL = float(os.environ.get("ASSISTANT_HEALTH_INTERVAL", "60") or 60)
+
+class AssistantSlot:
+    __slots__ = ("index", "client", "call", "chats", "healthy", "failures", "user_id")
+
+    def __init__(self, index: int, client: Client, call: Any):
+        self.index = index
+        self.client = client
+        self.call = call
+        self.chats: set = set()
+        self.healthy = True
+        self.failures = 0
+        self.user_id: Optional[int] = None
+
+    @property
+    def is_user_app(self) -> bool:
+        return self.client is user_app
+
+    def __repr__(self) -> str:
+        return f"<AssistantSlot #{self.index} chats={len(self.chats)} healthy={self.healthy}>"
+
+class AssistantPool:
+    """Voice clients (one PyTgCalls per assistant account) with sticky least-loaded placement."""
+
+    def __init__(self):
+        self.slots: List[AssistantSlot] = []
+        self.assignments: Dict[int, AssistantSlot] = {}
+
+    def add(self, client: Client, call: Any) -> AssistantSlot:
+        slot = AssistantSlot(len(self.slots), client, call)
+        self.slots.append(slot)
+        return slot
+
+    def get(self, chat_id: int) -> Optional[AssistantSlot]:
+        return self.assignments.get(chat_id)
+
+    def assign(self, chat_id: int) -> Optional[AssistantSlot]:
+        slot = self.assignments.get(chat_id)
+        if slot is not None and slot.healthy:
+            return slot
+        if slot is not None:
+            slot.chats.discard(chat_id)
+        healthy = [s for s in self.slots if s.healthy] or self.slots
+        if not healthy:
+            return None
+        slot = min(healthy, key=lambda s: (len(s.chats), s.index))
+        slot.chats.add(chat_id)
+        self.assignments[chat_id] = slot
+        return slot
+
+    def release(self, chat_id: int) -> None:
+        slot = self.assignments.pop(chat_id, None)
+        if slot is not None:
+            slot.chats.discard(chat_id)
+
+    def record_success(self, slot: AssistantSlot) -> None:
+        slot.failures = 0
+        slot.healthy = True
 
-assistant = None
+    def record_failure(self, slot: AssistantSlot) -> List[int]:
+        slot.failures += 1
+        if slot.failures >= ASSISTANT_FAILURE_THRESHOLD and slot.healthy:
+            return self.mark_failed(slot)
+        return []
+
+    def mark_failed(self, slot: AssistantSlot) -> List[int]:
+        """Take a slot out of rotation; returns the chats that must be moved elsewhere."""
+        if len(self.slots) < 2:
+            return []
+        slot.healthy = False
+        moved = list(slot.chats)
+        for chat_id in moved:
+            self.release(chat_id)
+        logger.warning(f"Assistant #{slot.index} marked unhealthy; {len(moved)} chat(s) to rebalance")
+        return moved
+
+    def loads(self) -> Dict[int, int]:
+        return {s.index: len(s.chats) for s in self.slots}
+
+assistant_pool = AssistantPool()
+
+# ASSISTANT_SESSION plus any extra session strings in ASSISTANT_SESSIONS (comma/space separated)
+ASSISTANT_SESSIONS: List[str] = [s for s in re.split(r"[\s,]+", os.environ.get("ASSISTANT_SESSIONS", "")) if s]
+if ASSISTANT_SESSION and ASSISTANT_SESSION not in ASSISTANT_SESSIONS:
+    ASSISTANT_SESSIONS.insert(0, ASSISTANT_SESSION)
+
+assistants: List[Client] = []
+for _i, _session in enumerate(ASSISTANT_SESSIONS):
+    _name = "assistant" if _i == 0 else f"assistant{_i + 1}"
+    assistants.append(make_client(_name, _session))
+
+# assistant / call_py / CALL_CLIENT keep pointing at the first voice client for single-assistant setups
+assistant = assistants[0] if assistants else None
 call_py = None
-CALL_CLIENT = None  # client instance used by PyTgCalls (assistant or user_app)
+CALL_CLIENT = assistant if assistants else user_app  # client instance used by PyTgCalls (assistant or user_app)
+_voice_init_task: Optional[asyncio.Task] = None
 
-if ASSISTANT_SESSION:
-    assistant = Client("assistant", api_id=API_ID, api_hash=API_HASH, session_string=ASSISTANT_SESSION, in_memory=True)
-    CALL_CLIENT = assistant
-    if PyTgCalls:
-        call_py = PyTgCalls(assistant)
-    else:
-        logger.warning("pytgcalls not available - voice playback disabled.")
-else:
-    # Use userbot's client for voice if pytgcalls is present and assistant isn't configured.
-    CALL_CLIENT = user_app
-    if PyTgCalls:
-        call_py = PyTgCalls(user_app)
+def _import_pytgcalls() -> None:
+    """Import pytgcalls; slow (native extension), so ensure_voice runs it in an executor."""
+    global PyTgCalls, MediaStream, AudioParameters
+    try:
+        from pytgcalls import PyTgCalls
+        from pytgcalls.types import MediaStream
+    except Exception:
+        PyTgCalls = None
+        MediaStream = None
+    try:
+        from pytgcalls.types import AudioParameters
+    except Exception:
+        AudioParameters = None
+
+def init_voice() -> None:
+    """Attach one PyTgCalls instance per voice client.
+
+    Runs on the event loop: PyTgCalls registers handlers on the pyrogram client and
+    Dispatcher.add_handler is not thread-safe against a client that is starting.
+    """
+    global call_py
+    if assistants:
+        if PyTgCalls:
+            for client in assistants:
+                assistant_pool.add(client, PyTgCalls(client))
+            call_py = assistant_pool.slots[0].call
+            logger.info(f"Assistant pool: {len(assistant_pool.slots)} assistant account(s).")
+        else:
+            logger.warning("pytgcalls not available - voice playback disabled.")
     else:
-        logger.info("pytgcalls not available - voice playback disabled (no assistant).")
+        # Use userbot's client for voice if pytgcalls is present and assistant isn't configured.
+        if PyTgCalls:
+            call_py = PyTgCalls(user_app)
+            assistant_pool.add(user_app, call_py)
+        else:
+            logger.info("pytgcalls not available - voice playback disabled (no assistant).")
+
+async def _load_voice() -> None:
+    await asyncio.get_running_loop().run_in_executor(None, _import_pytgcalls)
+    init_voice()
 
-if not ASSISTANT_SESSION:
+async def ensure_voice() -> None:
+    global _voice_init_task
+    if _voice_init_task is None:
+        _voice_init_task = asyncio.ensure_future(_load_voice())
+    await _voice_init_task
+
+if not assistants:
     logger.info("ASSISTANT_SESSION not provided — attempting to use user account for VC if pytgcalls available.")
 
+# ===================== METRICS =====================
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0") or 0)  # 0 disables the /metrics endpoint
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metrics:
+    """Tiny in-process registry rendered in Prometheus text format."""
+
+    def __init__(self):
+        self.counters: Dict[tuple, float] = {}
+        self.gauges: Dict[tuple, float] = {}
+        self.histograms: Dict[tuple, List[float]] = {}  # per-bucket counts + [sum, count]
+        self.gauge_callbacks: Dict[str, Any] = {}
+        self.help: Dict[str, str] = {}
+
+    @staticmethod
+    def _k(name: str, labels: Dict[str, Any]) -> tuple:
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        k = self._k(name, labels)
+        self.counters[k] = self.counters.get(k, 0.0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        self.gauges[self._k(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        k = self._k(name, labels)
+        h = self.histograms.get(k)
+        if h is None:
+            h = self.histograms[k] = [0.0] * (len(LATENCY_BUCKETS) + 3)
+        h[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1  # last slot before sum/count is +Inf
+        h[-2] += value
+        h[-1] += 1
+
+    def gauge_callback(self, name: str, fn, help_text: str = "") -> None:
+        """fn() returns a number or a list of (labels_dict, value) pairs, evaluated at scrape time."""
+        self.gauge_callbacks[name] = fn
+        if help_text:
+            self.help[name] = help_text
+
+    def get(self, name: str, **labels) -> float:
+        k = self._k(name, labels)
+        return self.counters.get(k, self.gauges.get(k, 0.0))
+
+    @staticmethod
+    def _fmt_labels(labels: tuple, extra: tuple = ()) -> str:
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        body = ",".join(f'{k}="{_escape_label(v)}"' for k, v in items)
+        return "{" + body + "}"
+
+    def render(self) -> str:
+        lines: List[str] = []
+        seen_types = set()
+
+        def header(name: str, kind: str):
+            if name in seen_types:
+                return
+            seen_types.add(name)
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{self._fmt_labels(labels)} {value}")
+        for (name, labels), value in sorted(self.gauges.items()):
+            header(name, "gauge")
+            lines.append(f"{name}{self._fmt_labels(labels)} {value}")
+        for name, fn in self.gauge_callbacks.items():
+            try:
+                value = fn()
+            except Exception as e:
+                logger.debug(f"metrics gauge {name} failed: {e}")
+                continue
+            header(name, "gauge")
+            if isinstance(value, list):
+                for labels, v in value:
+                    lines.append(f"{name}{self._fmt_labels(tuple(sorted((k, str(x)) for k, x in labels.items())))} {v}")
+            else:
+                lines.append(f"{name} {value}")
+        for (name, labels), h in sorted(self.histograms.items()):
+            header(name, "histogram")
+            cumulative = 0.0
+            for bound, count in zip(LATENCY_BUCKETS, h):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._fmt_labels(labels, (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{self._fmt_labels(labels, (('le', '+Inf'),))} {h[-1]}")
+            lines.append(f"{name}_sum{self._fmt_labels(labels)} {h[-2]}")
+            lines.append(f"{name}_count{self._fmt_labels(labels)} {h[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.help.update({
+    "handler_latency_seconds": "Handler wall time",
+    "rpc_calls_total": "Telegram RPC calls by client and method",
+    "rpc_errors_total": "Telegram RPC calls that raised, by client, method and error",
+    "floodwait_total": "FloodWait errors received",
+    "floodwait_seconds_total": "Seconds of FloodWait requested by Telegram",
+    "event_loop_lag_seconds": "Extra delay of a periodic loop wakeup",
+    "cache_requests_total": "Cache lookups by cache and result",
+})
+
+def timed(name: str):
+    """Record the wall time of an async handler under handler_latency_seconds{handler=name}."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                metrics.observe("handler_latency_seconds", time.perf_counter() - start, handler=name)
+        return wrapper
+    return decorator
+
+def instrument_client(client: Client, label: str) -> None:
+    """Count RPCs (and FloodWaits) made through client.invoke by method name.
+
+    Session.invoke sleeps through FloodWaits up to sleep_threshold by itself, so those
+    would never reach this wrapper; the session is called with sleep_threshold=0 and the
+    short waits are slept (and counted) here instead.
+    """
+    original = client.invoke
+
+    async def invoke(query, *args, **kwargs):
+        method = type(query).__name__
+        if len(args) >= 3:
+            threshold, args = args[2], args[:2]
+        else:
+            threshold = kwargs.pop("sleep_threshold", None)
+        if threshold is None:
+            threshold = client.sleep_threshold
+        while True:
+            metrics.inc("rpc_calls_total", client=label, method=method)
+            try:
+                return await original(query, *args, sleep_threshold=0, **kwargs)
+            except FloodWait as e:
+                amount = float(e.value or 0)
+                metrics.inc("floodwait_total", client=label, method=method)
+                metrics.inc("floodwait_seconds_total", amount, client=label, method=method)
+                if amount > threshold >= 0:
+                    raise
+                logger.warning("[%s] FloodWait %ss on %s, waiting", label, amount, method)
+                await asyncio.sleep(amount)
+            except Exception as e:
+                metrics.inc("rpc_errors_total", client=label, method=method, error=type(e).__name__)
+                raise
+
+    client.invoke = invoke
+
+instrument_client(user_app, "user")
+for _i, _client in enumerate(assistants):
+    instrument_client(_client, f"assistant{_i + 1}")
+
+async def loop_lag_monitor(interval: float = 0.5):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - start - interval)
+        metrics.set("event_loop_lag_seconds", lag)
+        metrics.observe("event_loop_lag_histogram_seconds", lag)
+
+async def metrics_handler(request):
+    from aiohttp import web
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server() -> None:
+    asyncio.create_task(loop_lag_monitor())
+    if not METRICS_PORT:
+        return
+    from aiohttp import web
+    web_app = web.Application()
+    web_app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"Metrics endpoint on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+# ===================== TRACING =====================
+TRACE_FILE = os.environ.get("TRACE_FILE", "")  # JSON lines of finished spans; empty disables tracing
+TRACE_FLUSH_INTERVAL = float(os.environ.get("TRACE_FLUSH_INTERVAL", "2") or 2)
+TRACE_BUFFER = 20000  # spans kept in memory between flushes; the oldest are dropped beyond this
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("dlk_current_span", default=None)
+
+class Span:
+    """One timed stage of a trace. Entering it makes it the parent of spans opened in the same task
+    and in tasks created from it (asyncio copies the context), so a trace follows every awaited stage."""
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attrs", "ts", "start", "error", "_token")
+
+    def __init__(self, name: str, parent: Optional["Span"], attrs: Dict[str, Any]):
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(8).hex()
+        self.span_id = os.urandom(4).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.name = name
+        self.attrs = attrs
+        self.ts = 0.0
+        self.start = 0.0
+        self.error: Optional[str] = None
+        self._token = None
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.ts = time.time()
+        self.start = time.perf_counter()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            pass  # exited from another context; nothing to restore there
+        if exc_type is not None:
+            self.error = "cancelled" if issubclass(exc_type, asyncio.CancelledError) else f"{exc_type.__name__}: {exc}"
+        trace_exporter.export(self, duration)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+class _NoopSpan:
+    trace_id = None
+
+    def set(self, **attrs) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+def span(name: str, **attrs):
+    """Child span of the current one, or the root of a new trace if there is none."""
+    if not TRACE_FILE:
+        return _NOOP_SPAN
+    return Span(name, _current_span.get(), attrs)
+
+def new_trace(name: str, **attrs):
+    """Root span of a new trace, even inside another one (e.g. the next queued track)."""
+    if not TRACE_FILE:
+        return _NOOP_SPAN
+    return Span(name, None, attrs)
+
+def current_span():
+    current = _current_span.get()
+    return current if current is not None else _NOOP_SPAN
+
+def traced(name: str, root: bool = False):
+    """Run an async function inside a span. Returns func unchanged when tracing is off."""
+    def decorator(func):
+        if not TRACE_FILE:
+            return func
+        opener = new_trace if root else span
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with opener(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class TraceExporter:
+    """Buffers finished spans and appends them to TRACE_FILE as JSON lines from a worker thread."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.buffer: deque = deque(maxlen=TRACE_BUFFER)
+
+    def export(self, s: Span, duration: float) -> None:
+        if len(self.buffer) == self.buffer.maxlen:
+            metrics.inc("trace_spans_dropped_total")
+        record = {"trace_id": s.trace_id, "span_id": s.span_id, "parent_id": s.parent_id, "name": s.name,
+                  "ts": round(s.ts, 6), "duration_ms": round(duration * 1000, 3)}
+        if s.attrs:
+            record["attrs"] = s.attrs
+        if s.error:
+            record["error"] = s.error
+        self.buffer.append(record)
+
+    def flush(self) -> int:
+        batch = []
+        while self.buffer:
+            batch.append(self.buffer.popleft())
+        if not batch or not self.path:
+            return 0
+        lines = "".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in batch)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+        metrics.inc("trace_spans_exported_total", len(batch))
+        return len(batch)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(TRACE_FLUSH_INTERVAL)
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.flush)
+            except Exception as e:
+                logger.warning(f"Trace export to {self.path} failed: {e}")
+
+trace_exporter = TraceExporter(TRACE_FILE)
+
+# ===================== CIRCUIT BREAKERS =====================
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", "5") or 5)  # consecutive failures that open a breaker
+BREAKER_RESET = float(os.environ.get("BREAKER_RESET", "30") or 30)  # seconds open before a probe is let through
+BREAKER_QUEUE_TIMEOUT = 10.0  # max wait for a concurrency slot before failing fast
+YTDLP_CONCURRENCY = int(os.environ.get("YTDLP_CONCURRENCY", "4") or 4)
+THUMB_CONCURRENCY = int(os.environ.get("THUMB_CONCURRENCY", "8") or 8)
+STATION_CONCURRENCY = int(os.environ.get("STATION_CONCURRENCY", "4") or 4)  # per station host
+MONGO_CONCURRENCY = int(os.environ.get("MONGO_CONCURRENCY", "16") or 16)
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose breaker is open or whose concurrency limit is exhausted."""
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with its own concurrency limit.
+
+    closed -> open after `failure_threshold` failures in a row; while open every call fails fast with
+    CircuitOpenError. After `reset_timeout` one probe call is let through (half-open): success closes
+    the breaker, failure opens it again. Async callers use `async with breaker:` or `call()`,
+    blocking code (pymongo) uses `call_sync()`.
+    """
+    STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+    def __init__(self, name: str, max_concurrency: int, failure_threshold: int = BREAKER_FAILURES, reset_timeout: float = BREAKER_RESET):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.inflight = 0
+        self._probing = False
+        self._probe_task: Optional[asyncio.Task] = None  # the task holding the probe inside `async with`
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self._tsem = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()  # call_sync runs on executor threads too
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.reset_timeout - time.time()) if self.state == "open" else 0.0
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            logger.warning(f"Circuit breaker {self.name}: {self.state} -> {state}")
+            self.state = state
+
+    def _admit(self) -> bool:
+        """Count the caller in; returns True when it is the half-open probe."""
+        with self._lock:
+            if self.state == "open":
+                if time.time() - self.opened_at < self.reset_timeout:
+                    metrics.inc("breaker_rejected_total", breaker=self.name, reason="open")
+                    raise CircuitOpenError(f"{self.name} unavailable, retry in {math.ceil(self.retry_after())}s")
+                self._set_state("half_open")
+            probe = False
+            if self.state == "half_open":
+                if self._probing:
+                    metrics.inc("breaker_rejected_total", breaker=self.name, reason="open")
+                    raise CircuitOpenError(f"{self.name} is being probed, retry shortly")
+                self._probing = probe = True
+            self.inflight += 1
+            return probe
+
+    def _release(self, probe: bool) -> None:
+        """Leave without an outcome (never ran: saturated, cancelled); only the probe may reopen probing."""
+        with self._lock:
+            self.inflight -= 1
+            if probe:
+                self._probing = False
+
+    def _done(self, failed: bool, probe: bool) -> None:
+        with self._lock:
+            self.inflight -= 1
+            if probe:
+                self._probing = False
+            if not failed:
+                self.failures = 0
+                # a call admitted before the breaker opened does not get to close it; the probe does
+                if probe or self.state == "closed":
+                    self._set_state("closed")
+                return
+            self.failures += 1
+            metrics.inc("breaker_failures_total", breaker=self.name)
+            if probe or (self.state == "closed" and self.failures >= self.failure_threshold):
+                self.opened_at = time.time()
+                self._set_state("open")
+
+    async def _acquire(self, probe: bool) -> None:
+        try:
+            await asyncio.wait_for(self._sem.acquire(), BREAKER_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._release(probe)
+            metrics.inc("breaker_rejected_total", breaker=self.name, reason="saturated")
+            raise CircuitOpenError(f"{self.name} is saturated")
+        except BaseException:
+            self._release(probe)
+            raise
+
+    async def __aenter__(self):
+        probe = self._admit()
+        await self._acquire(probe)
+        if probe:
+            self._probe_task = asyncio.current_task()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._sem.release()
+        probe = self._probe_task is not None and self._probe_task is asyncio.current_task()
+        if probe:
+            self._probe_task = None
+        if exc_type is not None and issubclass(exc_type, (asyncio.CancelledError, CircuitOpenError)):
+            self._release(probe)
+        else:
+            self._done(exc_type is not None, probe)
+        return False
+
+    async def call(self, fn, *args, is_failure=None, **kwargs):
+        """await fn(*args); a result for which is_failure(result) is true counts as a failure but is still returned."""
+        probe = self._admit()
+        await self._acquire(probe)
+        try:
+            result = await fn(*args, **kwargs)
+        except (asyncio.CancelledError, CircuitOpenError):
+            self._sem.release()
+            self._release(probe)
+            raise
+        except Exception:
+            self._sem.release()
+            self._done(True, probe)
+            raise
+        self._sem.release()
+        self._done(is_failure is not None and bool(is_failure(result)), probe)
+        return result
+
+    def call_sync(self, fn, *args, **kwargs):
+        probe = self._admit()
+        if not self._tsem.acquire(timeout=0.05):
+            self._release(probe)
+            metrics.inc("breaker_rejected_total", breaker=self.name, reason="saturated")
+            raise CircuitOpenError(f"{self.name} is saturated")
+        failed = True
+        try:
+            result = fn(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            self._tsem.release()
+            self._done(failed, probe)
+
+breakers: Dict[str, CircuitBreaker] = {}
+
+def get_breaker(name: str, max_concurrency: int) -> CircuitBreaker:
+    breaker = breakers.get(name)
+    if breaker is None:
+        breaker = breakers[name] = CircuitBreaker(name, max_concurrency)
+    return breaker
+
+def station_breaker(url: str) -> CircuitBreaker:
+    return get_breaker(f"station:{urlparse(url).netloc or url}", STATION_CONCURRENCY)
+
+ytdlp_breaker = get_breaker("ytdlp", YTDLP_CONCURRENCY)
+thumb_breaker = get_breaker("thumbnails", THUMB_CONCURRENCY)
+mongo_breaker = get_breaker("mongo", MONGO_CONCURRENCY)
+
+def mongo_guarded(default: Any = CircuitOpenError):
+    """Run a blocking Mongo helper through mongo_breaker; with a default, failures return it instead of raising."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return mongo_breaker.call_sync(func, *args, **kwargs)
+            except Exception as e:
+                if default is CircuitOpenError:
+                    raise
+                logger.debug(f"{func.__name__} failed, using default: {e}")
+                return default
+        return wrapper
+    return decorator
+
+metrics.gauge_callback("breaker_state", lambda: [({"breaker": b.name}, CircuitBreaker.STATES[b.state]) for b in list(breakers.values())], "0 closed, 1 half-open, 2 open")
+metrics.gauge_callback("breaker_inflight", lambda: [({"breaker": b.name}, b.inflight) for b in list(breakers.values())], "Calls currently running through each breaker")
+
+# ===================== STALL DETECTOR =====================
+STALL_THRESHOLD = float(os.environ.get("STALL_THRESHOLD", "0.5") or 0)  # seconds the loop may block; 0 disables
+STALL_TOP_N = int(os.environ.get("STALL_TOP_N", "10") or 10)
+
+_STALL_WRAPPER_NAMES = {"wrapper", "invoke"}  # closures from timed()/traced()/instrument_client()
+
+class StallDetector:
+    """Watchdog thread that notices when the event loop stops ticking and captures what blocks it.
+
+    A loop task refreshes a heartbeat every `interval`; when the heartbeat gets older than
+    interval + threshold the watchdog snapshots the loop thread's stack, logs it with the
+    handler (the coroutine the loop is currently stepping) and keeps per-source totals for `top()`.
+    """
+
+    def __init__(self, threshold: float, top_n: int = 10, interval: float = 0.1):
+        self.threshold = threshold
+        self.top_n = top_n
+        self.interval = interval
+        self.sources: Dict[tuple, List[float]] = {}  # (handler, location) -> [count, total_s, max_s]
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pending: Optional[tuple] = None  # (heartbeat, key) of the stall being measured
+
+    def start(self) -> None:
+        if self.threshold <= 0 or self._thread is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        asyncio.create_task(self._beat())
+        self._thread = threading.Thread(target=self._watch, name="stall-detector", daemon=True)
+        self._thread.start()
+        logger.info(f"Stall detector active (threshold {self.threshold}s)")
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    async def _beat(self):
+        while not self._stop.is_set():
+            self._heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _capture(self) -> tuple:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return ("unknown", "unknown"), ""
+        stack = traceback.extract_stack(frame)
+        # everything above the loop's Handle._run is asyncio.run()/run_forever plumbing; the
+        # handler is the first app.py coroutine it is stepping, minus decorator wrappers
+        dispatch = max((i for i, f in enumerate(stack) if f.name == "_run" and f.filename.endswith(os.path.join("asyncio", "events.py"))), default=-1)
+        below = [f for f in stack[dispatch + 1:] if f.filename == __file__]
+        ours = below or [f for f in stack if f.filename == __file__]
+        named = [f for f in below if f.name not in _STALL_WRAPPER_NAMES]
+        handler = named[0].name if named else (ours[-1].name if ours else "unknown")
+        location = f"{ours[-1].name}:{ours[-1].lineno}" if ours else f"{stack[-1].name}:{stack[-1].lineno}"
+        return (handler, location), "".join(traceback.format_list(stack[-25:]))
+
+    def _finish(self, blocked: float) -> None:
+        hb, key = self._pending
+        self._pending = None
+        stat = self.sources.setdefault(key, [0, 0.0, 0.0])
+        stat[0] += 1
+        stat[1] += blocked
+        stat[2] = max(stat[2], blocked)
+        metrics.inc("loop_stalls_total", handler=key[0])
+        metrics.inc("loop_stall_seconds_total", blocked, handler=key[0])
+        logger.info(f"Event loop stall ended after {blocked:.2f}s in {key[0]} ({key[1]})")
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            hb = self._heartbeat
+            if self._pending is not None and self._pending[0] != hb:
+                self._finish(max(0.0, hb - self._pending[0] - self.interval))
+            lag = time.monotonic() - hb - self.interval
+            if lag < self.threshold or self._pending is not None:
+                continue
+            key, stack_text = self._capture()
+            self._pending = (hb, key)
+            logger.warning(f"Event loop blocked for {lag:.2f}s+ in handler {key[0]} at {key[1]}:\n{stack_text}")
+
+    def top(self, n: Optional[int] = None) -> List[tuple]:
+        ranked = sorted(self.sources.items(), key=lambda kv: kv[1][1], reverse=True)
+        return ranked[: n or self.top_n]
+
+stall_detector = StallDetector(STALL_THRESHOLD, STALL_TOP_N)
+
+# ===================== PROFILER =====================
+PROFILE_MAX_SECONDS = 300
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0.005") or 0.005)
+PROFILE_TOP_N = 30
+
+class SamplingProfiler:
+    """Stack sampler for the live process, used by !profile.
+
+    A daemon thread reads sys._current_frames() every `interval` and counts, per function,
+    how often it was on top of a stack (self) or anywhere in it (total). Nothing is hooked
+    into the interpreter, so the cost is one stack walk per thread per sample. With
+    `trace_memory` tracemalloc runs for the same window and the biggest allocation growth
+    sites are reported as well.
+    """
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL, trace_memory: bool = True):
+        self.interval = interval
+        self.trace_memory = trace_memory
+        self.samples = 0
+        self.self_counts: Dict[tuple, int] = {}
+        self.total_counts: Dict[tuple, int] = {}
+        self.thread_counts: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._snapshot = None
+        self._started_tracemalloc = False
+        self._loop_thread_id = threading.get_ident()
+        self.started = 0.0
+        self.elapsed = 0.0
+
+    @staticmethod
+    def _key(code) -> tuple:
+        return (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def _sample(self) -> None:
+        own = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            name = "event-loop" if ident == self._loop_thread_id else names.get(ident, str(ident))
+            self.thread_counts[name] = self.thread_counts.get(name, 0) + 1
+            leaf = self._key(frame.f_code)
+            self.self_counts[leaf] = self.self_counts.get(leaf, 0) + 1
+            seen = set()
+            while frame is not None:
+                key = self._key(frame.f_code)
+                if key not in seen:
+                    seen.add(key)
+                    self.total_counts[key] = self.total_counts.get(key, 0) + 1
+                frame = frame.f_back
+        self.samples += 1
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self) -> None:
+        if self.trace_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(1)
+                self._started_tracemalloc = True
+            self._snapshot = tracemalloc.take_snapshot()
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> List[Any]:
+        """Stop sampling; returns tracemalloc StatisticDiff entries (empty without trace_memory)."""
+        if self._stop.is_set():
+            return []
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+        diffs: List[Any] = []
+        if self._snapshot is not None:
+            import tracemalloc
+            diffs = tracemalloc.take_snapshot().compare_to(self._snapshot, "lineno")
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+        return diffs
+
+    def report(self, diffs: List[Any], top_n: int = PROFILE_TOP_N) -> str:
+        lines = [f"Profile: {self.elapsed:.1f}s, {self.samples} samples every {self.interval * 1000:.0f}ms", ""]
+        lines.append("Threads (samples):")
+        for name, count in sorted(self.thread_counts.items(), key=lambda kv: kv[1], reverse=True):
+            lines.append(f"  {count:>7}  {name}")
+        for title, counts in (("Hot functions (self)", self.self_counts), ("Hot functions (total, incl. callees)", self.total_counts)):
+            lines += ["", f"{title}:", f"  {'samples':>7} {'%':>6}  function"]
+            for (func, filename, lineno), count in sorted(counts.items(), key=lambda kv: kv[1], reverse=True)[:top_n]:
+                pct = 100.0 * count / max(1, self.samples)
+                lines.append(f"  {count:>7} {pct:>5.1f}%  {func} ({filename}:{lineno})")
+        if self.trace_memory:
+            lines += ["", "Allocation growth by site:", f"  {'size':>10} {'count':>8}  location"]
+            for stat in sorted(diffs, key=lambda d: d.size_diff, reverse=True)[:top_n]:
+                frame = stat.traceback[0]
+                lines.append(f"  {stat.size_diff / 1024:>8.1f}KB {stat.count_diff:>+8}  {os.path.basename(frame.filename)}:{frame.lineno}")
+        return "\n".join(lines) + "\n"
+
+_active_profile: Optional[SamplingProfiler] = None
+
 # ===================== DB SETUP =====================
 mongo_client = None
 db = None
 settings_coll = None
 playing_coll = None
-if MONGO_URI:
-    if MongoClient is None:
+_db_init_task: Optional[asyncio.Task] = None
+# what a settings write can raise: the breaker refusing it, or pymongo (added once it is imported)
+SETTINGS_STORE_ERRORS: tuple = (CircuitOpenError,)
+
+def init_db() -> None:
+    global mongo_client, db, settings_coll, playing_coll, SETTINGS_STORE_ERRORS
+    if not MONGO_URI:
+        return
+    try:
+        from pymongo import MongoClient
+        from pymongo.errors import PyMongoError
+    except Exception:
         logger.warning("pymongo not installed; continuing without DB persistence.")
-    else:
+        return
+    SETTINGS_STORE_ERRORS = (CircuitOpenError, PyMongoError)
+    try:
+        mongo_client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+        db = mongo_client.get_database(MONGO_DBNAME)
+        settings_coll = db.get_collection("react_settings")
+        playing_coll = db.get_collection("playing")
+        logger.info("Connected to MongoDB.")
+        station_catalog.reload()
+    except Exception as e:
+        logger.warning(f"Failed to connect to MongoDB: {e}")
+
+async def ensure_db() -> None:
+    """Connect to MongoDB once, off the event loop; later calls just wait for that to finish."""
+    global _db_init_task
+    if _db_init_task is None:
+        _db_init_task = asyncio.ensure_future(asyncio.get_running_loop().run_in_executor(None, init_db))
+    await _db_init_task
+
+# ===================== LEADER ELECTION =====================
+# Several replicas may run with the same SESSION_STRING; a lease document in Mongo decides which one
+# handles updates. The others keep their caches warm and take over once the lease expires.
+LEADER_ELECTION = os.environ.get("LEADER_ELECTION", "0") == "1"
+LEASE_TTL = float(os.environ.get("LEASE_TTL", "10") or 10)
+LEASE_CACHE_REFRESH = float(os.environ.get("LEASE_CACHE_REFRESH", "30") or 30)
+LEASE_MARGIN = float(os.environ.get("LEASE_MARGIN", "2") or 2)  # stop acting this long before the lease runs out (clock skew)
+INSTANCE_ID = os.environ.get("INSTANCE_ID") or f"{os.uname().nodename}-{os.getpid()}"
+
+def _is_duplicate_key(exc: Exception) -> bool:
+    return type(exc).__name__ == "DuplicateKeyError" or getattr(exc, "code", None) == 11000
+
+class LeaderLease:
+    """Lease-based leader election on a Mongo collection.
+
+    The leader renews {"_id": key, "holder": instance_id, "expires_at": t} every ttl/3. The conditional
+    upsert only matches when we already hold the lease or it has expired; otherwise the insert hits the
+    unique _id and fails with DuplicateKeyError, so exactly one replica can hold it.
+
+    Leadership is only trusted until `margin` seconds before our own view of expires_at (see holds()),
+    and a loop timer demotes the replica at that moment even if a renewal is still stuck in the store
+    call, so a partitioned leader stops before a standby can win the expired lease.
+    """
+
+    def __init__(self, key: str, instance_id: str, ttl: float = LEASE_TTL, collection: Any = None, margin: float = LEASE_MARGIN):
+        self.key = key
+        self.instance_id = instance_id
+        self.ttl = ttl
+        self.renew_interval = ttl / 3
+        self.margin = min(margin, ttl / 3)
+        self.collection = collection
+        self.is_leader = False
+        self.expires_at = 0.0
+        self.on_promote: List[Any] = []
+        self.on_demote: List[Any] = []  # called with lost=True when the lease ran out, False on step_down()
+        self._stopped = False
+        self._expiry: Optional[asyncio.TimerHandle] = None
+
+    def holds(self) -> bool:
+        """True while this replica may act as leader: it holds the lease and it is not about to expire."""
+        return self.is_leader and time.time() < self.expires_at - self.margin
+
+    def try_acquire(self) -> bool:
+        now = time.time()
+        try:
+            self.collection.update_one(
+                {"_id": self.key, "$or": [{"holder": self.instance_id}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"holder": self.instance_id, "expires_at": now + self.ttl, "renewed_at": now}},
+                upsert=True,
+            )
+        except Exception as e:
+            if not _is_duplicate_key(e):
+                raise
+            return False
+        # measured from before the write, so a slow round trip only shortens our view of the lease
+        self.expires_at = now + self.ttl
+        return True
+
+    def release(self) -> None:
+        self._stopped = True
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+        self.is_leader = False
+        if self.collection is None:
+            return
         try:
-            mongo_client = MongoClient(MONGO_URI)
-            db = mongo_client.get_database(MONGO_DBNAME)
-            settings_coll = db.get_collection("react_settings")
-            playing_coll = db.get_collection("playing")
-            logger.info("Connected to MongoDB.")
+            # matches only our own lease, so this is harmless when we were not holding it
+            self.collection.delete_one({"_id": self.key, "holder": self.instance_id})
         except Exception as e:
-            logger.warning(f"Failed to connect to MongoDB: {e}")
+            logger.debug(f"Lease release failed: {e}")
+
+    async def step_down(self) -> None:
+        """Graceful hand-over: run the demote callbacks while we still hold the lease, then release it."""
+        self._stopped = True
+        await self._transition(False, lost=False)
+        await asyncio.get_running_loop().run_in_executor(None, self.release)
+
+    async def _transition(self, leader: bool, lost: bool = True) -> None:
+        if leader == self.is_leader:
+            return
+        self.is_leader = leader
+        metrics.set("is_leader", 1.0 if leader else 0.0)
+        logger.warning(f"Instance {self.instance_id} is now {'LEADER' if leader else 'STANDBY'} for lease {self.key}"
+                       + ("" if leader or not lost else " (lease lost)"))
+        for cb in (self.on_promote if leader else self.on_demote):
+            try:
+                result = cb() if leader else cb(lost)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception:
+                logger.exception("Leader transition callback failed")
+
+    def _arm_expiry(self) -> None:
+        if self._expiry is not None:
+            self._expiry.cancel()
+        delay = max(0.0, self.expires_at - self.margin - time.time())
+        self._expiry = asyncio.get_running_loop().call_later(delay, self._expired)
+
+    def _expired(self) -> None:
+        self._expiry = None
+        if self.is_leader and not self._stopped and not self.holds():
+            logger.warning(f"Lease {self.key} ran out before it was renewed; stepping down")
+            asyncio.ensure_future(self._transition(False, lost=True))
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while not self._stopped:
+            try:
+                acquired = await loop.run_in_executor(None, self.try_acquire)
+                held = acquired and time.time() < self.expires_at - self.margin
+            except Exception as e:
+                logger.warning(f"Lease renewal failed: {e}")
+                held = self.holds()
+            if self._stopped:
+                break
+            if held:
+                self._arm_expiry()
+            await self._transition(held)
+            await asyncio.sleep(self.renew_interval)
+
+def _lease_key() -> str:
+    return "leader:" + hashlib.sha1((SESSION_STRING or f"{API_ID}:{DATA_DIR}").encode()).hexdigest()[:16]
+
+leader_lease = LeaderLease(_lease_key(), INSTANCE_ID)
+if not LEADER_ELECTION:
+    leader_lease.is_leader, leader_lease.expires_at = True, math.inf
 
 # ===================== IN-MEMORY CACHES =====================
 VALID_EMOJIS = [
@@ -130,8 +1171,149 @@ VALID_EMOJIS = [
     "🥱", "🥴", "😍", "🐳", "❤️‍🔥", "🌭", "💯", "🤣", "⚡", "🍌",
     "🏆", "💔", "🤨", "😐", "🍓", "🍾", "💋", "🖕", "😈", "😴"
 ]
-react_cache: Dict[tuple, bool] = {}
-radio_cache: Dict[tuple, str] = {}
+# Catch-up policy for updates delivered after downtime / reconnects
+REACT_MAX_AGE = float(os.environ.get("REACT_MAX_AGE", "120") or 0)  # seconds; older messages count as backlog
+REACT_BACKLOG_PER_CHAT = int(os.environ.get("REACT_BACKLOG_PER_CHAT", "2") or 0)  # backlog reactions allowed per chat
+REACT_DEDUP_SIZE = int(os.environ.get("REACT_DEDUP_SIZE", "50000") or 50000)
+
+class LRUSet:
+    """Bounded set that forgets the least recently added keys first."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Any, None]" = OrderedDict()
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def add(self, key) -> bool:
+        """Add key; returns False if it was already present."""
+        if key in self._data:
+            self._data.move_to_end(key)
+            return False
+        self._data[key] = None
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return True
+
+class LRUCache:
+    """Bounded mapping that evicts the least recently used key."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Any, Any]" = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def __setitem__(self, key, value) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+class ChatIdSet:
+    """Sorted array of chat ids: 8 bytes per member, O(log n) membership."""
+    __slots__ = ("_ids",)
+
+    def __init__(self, ids=()):
+        self._ids = array("q", sorted(set(ids)))
+
+    def _find(self, chat_id: int) -> tuple:
+        i = bisect.bisect_left(self._ids, chat_id)
+        return i, i < len(self._ids) and self._ids[i] == chat_id
+
+    def __contains__(self, chat_id: int) -> bool:
+        ids = self._ids
+        i = bisect.bisect_left(ids, chat_id)
+        return i < len(ids) and ids[i] == chat_id
+
+    def add(self, chat_id: int) -> None:
+        i, found = self._find(chat_id)
+        if not found:
+            self._ids.insert(i, chat_id)
+
+    def discard(self, chat_id: int) -> None:
+        i, found = self._find(chat_id)
+        if found:
+            del self._ids[i]
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._ids) * self._ids.itemsize
+
+# Settings caches. Once an owner's settings are loaded (load_caches_for_owner) a missing key means the
+# default, so only non-default state is kept: the chats with reactions off and the chats that have rules.
+REACT_LRU_SIZE = int(os.environ.get("REACT_LRU_SIZE", "50000") or 50000)
+RADIO_CACHE_SIZE = int(os.environ.get("RADIO_CACHE_SIZE", "10000") or 10000)
+settings_loaded: set = set()  # owner ids whose settings are fully in memory
+
+class ReactFlagCache:
+    """Per-(owner, chat) react on/off: a ChatIdSet of disabled chats for loaded owners, an LRU otherwise."""
+
+    def __init__(self, lru_size: int):
+        self.disabled: Dict[int, ChatIdSet] = {}
+        self.recent = LRUCache(lru_size)
+
+    def get(self, owner_id: int, chat_id: int) -> Optional[bool]:
+        if owner_id in settings_loaded:
+            off = self.disabled.get(owner_id)
+            return off is None or chat_id not in off
+        return self.recent.get((owner_id, chat_id))
+
+    def set(self, owner_id: int, chat_id: int, enabled: bool) -> None:
+        off = self.disabled.setdefault(owner_id, ChatIdSet())
+        if enabled:
+            off.discard(chat_id)
+        else:
+            off.add(chat_id)
+        if owner_id not in settings_loaded:
+            self.recent[(owner_id, chat_id)] = bool(enabled)
+
+    def load(self, owner_id: int, disabled_chat_ids) -> None:
+        self.disabled[owner_id] = ChatIdSet(disabled_chat_ids)
+
+    def clear(self) -> None:
+        self.disabled.clear()
+        self.recent.clear()
+
+    def __len__(self) -> int:
+        return sum(len(off) for off in self.disabled.values()) + len(self.recent)
+
+react_cache = ReactFlagCache(REACT_LRU_SIZE)
+radio_cache = LRUCache(RADIO_CACHE_SIZE)  # (owner_id, chat_id) -> radio url, filled on use
+react_rules_cache: Dict[tuple, List[Dict[str, Any]]] = {}  # only chats that have rules
+NO_RULES: List[Dict[str, Any]] = []
+
+reacted_messages = LRUSet(REACT_DEDUP_SIZE)  # (chat_id, message.id) already reacted to
+backlog_reactions: "OrderedDict[int, int]" = OrderedDict()  # chat_id -> backlog reactions since last live message
+react_flood_until = 0.0
+
+# Per-chat allowed reactions: chat_id -> (expires_at, emojis usable there); () means reactions are off
+REACTIONS_TTL = float(os.environ.get("REACTIONS_TTL", "3600") or 3600)
+allowed_reactions_cache: Dict[int, tuple] = {}
+_allowed_reactions_pending: Dict[int, asyncio.Future] = {}
 
 # Example stations
 RADIO_STATION = {
@@ -141,23 +1323,223 @@ RADIO_STATION = {
     "HiruFM": "https://radio.lotustechnologieslk.net:2020/stream/hirufmgarden?1707015384",
 }
 
-# Thumbnail cache dirs
-THUMB_CACHE_DIR = "cache"
-os.makedirs(THUMB_CACHE_DIR, exist_ok=True)
-DOWNLOADS_DIR = "downloads"
-os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+# Optional external station catalog (JSON file and/or "stations" collection)
+STATIONS_FILE = os.environ.get("STATIONS_FILE", "")
+STATIONS_RELOAD_INTERVAL = float(os.environ.get("STATIONS_RELOAD_INTERVAL", "30") or 30)
+STATION_LIST_LIMIT = 50
+LOOKUP_MIN_SCORE = 0.6  # weakest fuzzy match `!radio <name>` plays without asking
+LOOKUP_MIN_LEAD = 0.15  # and how far it must be ahead of the runner-up
+
+# Playlist / search ingestion: entries are queued as flat placeholders and resolved when played
+SEARCH_RESULTS = int(os.environ.get("SEARCH_RESULTS", "5") or 5)
+search_results: "OrderedDict[int, List[Dict[str, Any]]]" = OrderedDict()  # chat_id -> last /search results
+SEARCH_RESULTS_CHATS = 500
+PLAYLIST_FLAGS = ("--all", "-all", "--playlist")
+# /playall bulk import: items resolved at once, scanned audio messages by default, max text file size
+PLAYALL_CONCURRENCY = int(os.environ.get("PLAYALL_CONCURRENCY", "4") or 4)
+PLAYALL_HISTORY = int(os.environ.get("PLAYALL_HISTORY", "50") or 50)
+PLAYALL_MAX_FILE = 256 * 1024
+
+# CPU-heavy per-chat work (card rendering, yt-dlp extraction) can run in N worker processes
+SHARD_WORKERS = int(os.environ.get("SHARD_WORKERS", "0") or 0)
+
+# Thumbnail cache dirs
+os.makedirs(THUMB_CACHE_DIR, exist_ok=True)
+DOWNLOADS_DIR = "downloads"
+os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+
+def discard_local_file(entry: Optional[Dict[str, Any]], keep: Optional[str] = None) -> None:
+    """Delete the downloaded file behind a local entry once nothing is going to play it (keep: a path still in use)."""
+    path = (entry or {}).get("stream_url")
+    if not entry or not entry.get("is_local") or not path or path == keep:
+        return
+    if os.path.dirname(os.path.abspath(path)) != os.path.abspath(DOWNLOADS_DIR):
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def portable_entry(entry: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """A queue entry as stored for a takeover, or None if another replica could not play it.
+
+    Stream URLs expire and downloads live on this host's disk, so tracks keep their page (re-resolved
+    through yt-dlp) or the message they came from (downloaded again); only radio keeps its URL.
+    """
+    if not entry:
+        return None
+    doc = {k: entry.get(k) for k in ("title", "webpage", "duration", "is_local", "is_radio")}
+    doc["thumbnail"] = None if entry.get("is_local") else entry.get("thumbnail")
+    if entry.get("is_radio"):
+        doc["stream_url"] = entry.get("stream_url")
+        return doc if doc["stream_url"] else None
+    if entry.get("message"):
+        doc["message"] = list(entry["message"])
+    elif entry.get("is_local") or not entry.get("webpage"):
+        return None
+    doc.update(stream_url=None, lazy=True)
+    return doc
+
+# Radio runtime state
+RADIO_TIMER_INTERVAL = 8  # seconds between now-playing caption updates
+TIMER_MAX_FAILURES = 3  # consecutive failed caption edits before a timer gives up (message deleted etc.)
+# Idle reaper / call budget
+IDLE_GRACE = float(os.environ.get("IDLE_GRACE", "180") or 0)  # seconds a call may have no listeners before we leave (0 = never)
+IDLE_REAP_INTERVAL = float(os.environ.get("IDLE_REAP_INTERVAL", "30") or 30)
+MAX_ACTIVE_CALLS = int(os.environ.get("MAX_ACTIVE_CALLS", "0") or 0)  # 0 = unlimited
+
+class PlaybackSession:
+    """One chat's playback: queue, now-playing state, its timer/watcher tasks and the current play record.
+
+    Created by play_entry once a track is playing and torn down only through sessions.close(),
+    which cancels everything the session owns.
+    """
+    __slots__ = ("chat_id", "queue", "title", "url", "msg_id", "start_time", "elapsed", "paused",
+                 "timer_task", "watcher_task", "record", "created", "last_active", "empty_since",
+                 "source", "seekable", "quality", "entry")
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.queue: deque = deque()
+        self.title: Optional[str] = None
+        self.url: Optional[str] = None
+        self.msg_id: Optional[int] = None
+        self.start_time: Optional[float] = None
+        self.elapsed = 0.0
+        self.paused = False
+        self.timer_task: Optional[asyncio.Task] = None
+        self.watcher_task: Optional[asyncio.Task] = None
+        self.record: Optional[Dict[str, Any]] = None
+        self.created = self.last_active = time.time()
+        self.empty_since: Optional[float] = None
+        self.source: Optional[str] = None  # what the call is actually streaming (relay URL for relayed radio)
+        self.seekable = False
+        self.quality = 0  # index into QUALITY_TIERS of the running stream
+        self.entry: Optional[Dict[str, Any]] = None  # queue entry of the current track, to restart it elsewhere
+
+    @property
+    def active(self) -> bool:
+        """A track has been started (playing or paused)."""
+        return self.msg_id is not None
+
+    @property
+    def playing(self) -> bool:
+        return self.active and not self.paused
+
+    def position(self) -> float:
+        if self.paused or self.start_time is None:
+            return self.elapsed
+        return time.time() - self.start_time
+
+    def touch(self) -> None:
+        """Mark the session as in use (new track, resume, queue add, listeners seen)."""
+        self.last_active = time.time()
+        self.empty_since = None
+
+    def begin(self, title: str, url: Optional[str], msg_id: int, offset: float = 0.0) -> None:
+        """Start tracking a new track; offset is where in the track the stream started."""
+        self.title, self.url, self.msg_id = title, url, msg_id
+        self.touch()
+        self.start_time = time.time() - offset
+        self.elapsed = 0.0
+        self.paused = False
+
+    def pause(self) -> None:
+        self.elapsed = self.position()
+        self.start_time = None
+        self.paused = True
+
+    def resume(self) -> None:
+        self.touch()
+        self.start_time = time.time() - self.elapsed
+        self.elapsed = 0.0
+        self.paused = False
+
+    @staticmethod
+    def _swap(old: Optional[asyncio.Task], new: Optional[asyncio.Task]) -> Optional[asyncio.Task]:
+        # a watcher replacing itself (track_watcher -> play_entry) must not cancel its own task
+        if old is not None and old is not new and not old.done() and old is not asyncio.current_task():
+            old.cancel()
+        return new
+
+    def set_timer(self, task: Optional[asyncio.Task]) -> None:
+        self.timer_task = self._swap(self.timer_task, task)
+
+    def set_watcher(self, task: Optional[asyncio.Task]) -> None:
+        self.watcher_task = self._swap(self.watcher_task, task)
+
+    def cancel_tasks(self) -> None:
+        self.set_timer(None)
+        self.set_watcher(None)
+
+    def live_tasks(self) -> int:
+        return sum(1 for t in (self.timer_task, self.watcher_task) if t is not None and not t.done())
+
+    def to_doc(self) -> Dict[str, Any]:
+        """Play state for a standby to take over: the current entry, where it is, and the queue."""
+        queue = [doc for doc in map(portable_entry, self.queue) if doc]
+        return {"chat_id": self.chat_id, "station": self.title, "url": self.url, "msg_id": self.msg_id,
+                "start_time": self.start_time, "elapsed": self.elapsed, "paused": self.paused,
+                "entry": portable_entry(self.entry), "queue": queue, "ts": time.time()}
+
+class SessionRegistry:
+    """chat_id -> PlaybackSession."""
+
+    def __init__(self):
+        self._sessions: Dict[int, PlaybackSession] = {}
+
+    def get(self, chat_id: int) -> Optional[PlaybackSession]:
+        return self._sessions.get(chat_id)
+
+    def open(self, chat_id: int) -> PlaybackSession:
+        session = self._sessions.get(chat_id)
+        if session is None:
+            session = self._sessions[chat_id] = PlaybackSession(chat_id)
+        return session
+
+    def close(self, chat_id: int) -> Optional[PlaybackSession]:
+        session = self._sessions.pop(chat_id, None)
+        if session is not None:
+            session.cancel_tasks()
+            session.queue.clear()
+        return session
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self._sessions
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def least_recently_active(self, exclude: int) -> Optional[PlaybackSession]:
+        candidates = [s for s in self._sessions.values() if s.active and s.chat_id != exclude]
+        return min(candidates, key=lambda s: s.last_active) if candidates else None
+
+    def stats(self) -> Dict[str, int]:
+        values = list(self._sessions.values())
+        return {
+            "sessions": len(values),
+            "active": sum(1 for s in values if s.active),
+            "queued": sum(len(s.queue) for s in values),
+            "tasks": sum(s.live_tasks() for s in values),
+        }
+
+sessions = SessionRegistry()
 
-# Radio runtime state
-radio_tasks: Dict[int, asyncio.Task] = {}
-radio_paused = set()
-radio_state: Dict[int, Dict[str, Any]] = {}
-radio_queue: Dict[int, List[Dict[str, Any]]] = {}
-track_watchers: Dict[int, asyncio.Task] = {}
+metrics.gauge_callback("voice_sessions_active", lambda: sessions.stats()["active"], "Chats with an active playback")
+metrics.gauge_callback("playback_sessions", lambda: len(sessions), "Open playback sessions")
+metrics.gauge_callback("playback_queued_entries", lambda: sessions.stats()["queued"], "Entries queued across all chats")
+metrics.gauge_callback("playback_tasks", lambda: sessions.stats()["tasks"], "Live timer/watcher tasks owned by sessions")
+metrics.gauge_callback("assistant_chats", lambda: [({"assistant": i}, n) for i, n in assistant_pool.loads().items()], "Voice chats served per assistant")
+metrics.gauge_callback("react_cache_entries", lambda: len(react_cache), "Entries in the react setting cache")
 
 # ===================== UTIL: DB helpers =====================
 def _key(owner_id: int, chat_id: int) -> dict:
     return {"owner_id": owner_id, "chat_id": chat_id}
 
+@mongo_guarded(True)
 def get_react_setting(owner_id: int, chat_id: int) -> bool:
     if settings_coll is None:
         return True
@@ -166,19 +1548,28 @@ def get_react_setting(owner_id: int, chat_id: int) -> bool:
         return bool(doc["react"])
     return True
 
+@mongo_guarded()
 def set_react_setting(owner_id: int, chat_id: int, enabled: bool) -> None:
-    if settings_coll:
+    if settings_coll is not None:
         settings_coll.update_one(_key(owner_id, chat_id), {"$set": {"react": bool(enabled)}}, upsert=True)
-    react_cache[(owner_id, chat_id)] = bool(enabled)
+    react_cache.set(owner_id, chat_id, enabled)
 
 def get_radio(owner_id: int, chat_id: int) -> Optional[str]:
+    key = (owner_id, chat_id)
+    if key in radio_cache:
+        return radio_cache.get(key)
     if settings_coll is None:
         return None
-    doc = settings_coll.find_one(_key(owner_id, chat_id), {"radio_url": 1})
-    if doc:
-        return doc.get("radio_url")
-    return None
+    try:
+        doc = mongo_breaker.call_sync(settings_coll.find_one, _key(owner_id, chat_id), {"radio_url": 1})
+    except Exception as e:
+        logger.debug(f"get_radio failed: {e}")
+        return None
+    url = doc.get("radio_url") if doc else None
+    radio_cache[key] = url
+    return url
 
+@mongo_guarded()
 def set_radio(owner_id: int, chat_id: int, url: Optional[str]) -> None:
     if settings_coll is None:
         return
@@ -188,38 +1579,506 @@ def set_radio(owner_id: int, chat_id: int, url: Optional[str]) -> None:
         radio_cache[(owner_id, chat_id)] = url
     else:
         settings_coll.update_one(k, {"$unset": {"radio_url": ""}})
-        radio_cache.pop((owner_id, chat_id), None)
+        radio_cache[(owner_id, chat_id)] = None
+
+def get_react_rules(owner_id: int, chat_id: int) -> List[Dict[str, Any]]:
+    key = (owner_id, chat_id)
+    rules = react_rules_cache.get(key)
+    if rules is not None:
+        return rules
+    if owner_id in settings_loaded or settings_coll is None:
+        return NO_RULES
+    try:
+        doc = mongo_breaker.call_sync(settings_coll.find_one, _key(owner_id, chat_id), {"react_rules": 1})
+    except Exception as e:
+        logger.debug(f"get_react_rules failed: {e}")
+        return NO_RULES
+    if doc and isinstance(doc.get("react_rules"), list) and doc["react_rules"]:
+        react_rules_cache[key] = doc["react_rules"]
+        return doc["react_rules"]
+    return NO_RULES
+
+@mongo_guarded()
+def set_react_rules(owner_id: int, chat_id: int, rules: List[Dict[str, Any]]) -> None:
+    if settings_coll is not None:
+        if rules:
+            settings_coll.update_one(_key(owner_id, chat_id), {"$set": {"react_rules": rules}}, upsert=True)
+        else:
+            settings_coll.update_one(_key(owner_id, chat_id), {"$unset": {"react_rules": ""}})
+    if rules:
+        react_rules_cache[(owner_id, chat_id)] = list(rules)
+    else:
+        react_rules_cache.pop((owner_id, chat_id), None)
+        compiled_rules_cache.pop((owner_id, chat_id), None)
 
+@mongo_guarded(None)
 def load_caches_for_owner(owner_id: int):
+    """Load an owner's non-default settings (reactions off, rules). Radio URLs are fetched on use.
+
+    If Mongo is unavailable the owner is left unloaded, so lookups fall back to per-chat queries.
+    """
     if settings_coll is None:
+        settings_loaded.add(owner_id)
         return
-    for doc in settings_coll.find({"owner_id": owner_id}):
-        key = (doc["owner_id"], doc["chat_id"])
-        react_cache[key] = bool(doc.get("react", True))
-        if "radio_url" in doc:
-            radio_cache[key] = doc["radio_url"]
+    disabled = array("q")
+    rules: Dict[tuple, List[Dict[str, Any]]] = {}
+    cursor = settings_coll.find(
+        {"owner_id": owner_id, "$or": [{"react": False}, {"react_rules.0": {"$exists": True}}]},
+        {"chat_id": 1, "react": 1, "react_rules": 1},
+    )
+    for doc in cursor:
+        if doc.get("react") is False:
+            disabled.append(doc["chat_id"])
+        if isinstance(doc.get("react_rules"), list) and doc["react_rules"]:
+            rules[(owner_id, doc["chat_id"])] = doc["react_rules"]
+    react_cache.load(owner_id, disabled)
+    for key in [k for k in react_rules_cache if k[0] == owner_id and k not in rules]:
+        del react_rules_cache[key]
+    react_rules_cache.update(rules)
+    settings_loaded.add(owner_id)
+
+# ===================== REACTION RULES =====================
+class AhoCorasick:
+    """Multi-keyword matcher: one pass over the text finds every keyword occurrence."""
+
+    def __init__(self, keywords: List[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[List[int]] = [[]]
+        self.lengths = [len(k) for k in keywords]
+        for idx, word in enumerate(keywords):
+            node = 0
+            for ch in word:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                node = nxt
+            self.out[node].append(idx)
+        # breadth-first so every failure link points at an already finished node
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def iter_matches(self, text: str):
+        """Yields (keyword_index, end_position) for every occurrence."""
+        node = 0
+        goto, fail, out = self.goto, self.fail, self.out
+        for pos, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for idx in out[node]:
+                yield idx, pos + 1
+
+def _has_backref(items) -> bool:
+    for op, av in items:
+        if op in (_sre_parse.GROUPREF, _sre_parse.GROUPREF_EXISTS):
+            return True
+        stack = [av]
+        while stack:
+            x = stack.pop()
+            if isinstance(x, _sre_parse.SubPattern):
+                if _has_backref(x):
+                    return True
+            elif isinstance(x, (tuple, list)):
+                stack.extend(x)
+    return False
+
+def rule_regex_error(pattern: str) -> Optional[str]:
+    """Why `pattern` cannot be used as a rule regex, or None if it can.
+
+    CompiledRules ORs every rule into one regex as (?P<rN>...), which renumbers groups and
+    would turn an inline (?i) into a flag for all rules, so those constructs are refused.
+    """
+    try:
+        parsed = _sre_parse.parse(pattern)
+    except re.error as e:
+        return f"Invalid regex: {e}"
+    if parsed.state.groupdict:
+        return "Named groups are not supported in rule regexes."
+    if _has_backref(parsed):
+        return "Backreferences are not supported in rule regexes."
+    if parsed.state.flags & ~re.UNICODE:
+        return "Global inline flags like (?i) are not supported; use a scoped group such as (?i:...)."
+    try:
+        re.compile(f"(?P<r0>{pattern})", re.IGNORECASE)
+    except re.error as e:
+        return f"Invalid regex: {e}"
+    return None
+
+class CompiledRules:
+    """A chat's react_rules compiled into one keyword automaton plus one combined regex.
+
+    Rule format: {"pattern": str, "regex": bool, "emojis": {emoji: weight}}. Keywords match
+    case-insensitively on word boundaries; the earliest rule in the list wins.
+    """
+
+    def __init__(self, rules: List[Dict[str, Any]]):
+        self.pools: List[tuple] = []
+        keywords: List[str] = []
+        self.keyword_rule: List[int] = []
+        regex_parts: List[str] = []
+        for idx, rule in enumerate(rules):
+            pool = rule.get("emojis") or {}
+            if isinstance(pool, list):
+                pool = {e: 1 for e in pool}
+            self.pools.append((list(pool.keys()), [float(w) for w in pool.values()]))
+            pattern = str(rule.get("pattern") or "")
+            if not pattern:
+                continue
+            if rule.get("regex"):
+                error = rule_regex_error(pattern)
+                if error:
+                    logger.warning(f"React rule /{pattern}/ skipped: {error}")
+                    continue
+                regex_parts.append(f"(?P<r{idx}>{pattern})")
+            else:
+                keywords.append(pattern.lower())
+                self.keyword_rule.append(idx)
+        self.automaton = AhoCorasick(keywords) if keywords else None
+        self.regex = None
+        if regex_parts:
+            try:
+                self.regex = re.compile("|".join(regex_parts), re.IGNORECASE)
+            except re.error as e:
+                logger.warning(f"Invalid react rule regex skipped: {e}")
+
+    def match(self, text: str) -> Optional[int]:
+        """Index of the highest-priority rule matching text, if any."""
+        best: Optional[int] = None
+        if self.automaton is not None:
+            lowered = text.lower()
+            for kw_idx, end in self.automaton.iter_matches(lowered):
+                start = end - self.automaton.lengths[kw_idx]
+                if (start > 0 and lowered[start - 1].isalnum()) or (end < len(lowered) and lowered[end].isalnum()):
+                    continue
+                rule_idx = self.keyword_rule[kw_idx]
+                if best is None or rule_idx < best:
+                    best = rule_idx
+        if self.regex is not None:
+            for m in self.regex.finditer(text):
+                rule_idx = int(m.lastgroup[1:])
+                if best is None or rule_idx < best:
+                    best = rule_idx
+        return best
+
+    def choose(self, text: str, allowed: tuple) -> Optional[str]:
+        rule_idx = self.match(text)
+        if rule_idx is None:
+            return None
+        emojis, weights = self.pools[rule_idx]
+        pairs = [(e, w) for e, w in zip(emojis, weights) if e in allowed and w > 0]
+        if not pairs:
+            return None
+        return random.choices([p[0] for p in pairs], weights=[p[1] for p in pairs])[0]
+
+compiled_rules_cache: Dict[tuple, tuple] = {}  # (owner_id, chat_id) -> (rules list identity, CompiledRules)
+
+def get_compiled_rules(owner_id: int, chat_id: int) -> Optional[CompiledRules]:
+    rules = get_react_rules(owner_id, chat_id)
+    if not rules:
+        return None
+    key = (owner_id, chat_id)
+    cached = compiled_rules_cache.get(key)
+    # set_react_rules stores a new list object, so identity tells us whether the rules changed
+    if cached is None or cached[0] is not rules:
+        cached = (rules, CompiledRules(rules))
+        compiled_rules_cache[key] = cached
+    return cached[1]
+
+# ===================== STATION CATALOG =====================
+def _normalize_station_name(text: str) -> str:
+    return re.sub(r"[^0-9a-z]+", "", (text or "").lower())
+
+def _trigrams(norm: str) -> set:
+    padded = f"  {norm} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class StationCatalog:
+    """Station list with a normalized-name index, prefix/trigram fuzzy lookup and tags.
+
+    Sources are merged in order: built-in RADIO_STATION, STATIONS_FILE (JSON), then the
+    optional "stations" collection. The file is re-checked for changes every
+    STATIONS_RELOAD_INTERVAL seconds on lookup, so edits apply without a restart.
+    """
+
+    def __init__(self, defaults: Dict[str, str], path: str = "", reload_interval: float = 30.0):
+        self.defaults = dict(defaults)
+        self.path = path
+        self.reload_interval = reload_interval
+        self.stations: Dict[str, Dict[str, Any]] = {}
+        self._by_norm: Dict[str, str] = {}
+        self._sorted_norms: List[str] = []
+        self._trigram_index: Dict[str, set] = {}
+        self._name_trigrams: Dict[str, set] = {}
+        self._tag_index: Dict[str, set] = {}
+        self._file_mtime: Optional[float] = None
+        self._last_check = 0.0
+
+    @staticmethod
+    def _parse(data: Any) -> List[Dict[str, Any]]:
+        if isinstance(data, dict) and isinstance(data.get("stations"), list):
+            data = data["stations"]
+        items = []
+        if isinstance(data, dict):
+            for name, url in data.items():
+                items.append({"name": name, "url": url, "tags": []})
+        elif isinstance(data, list):
+            for item in data:
+                if isinstance(item, dict) and item.get("name") and item.get("url"):
+                    items.append({"name": str(item["name"]), "url": str(item["url"]), "tags": list(item.get("tags") or [])})
+        return items
+
+    def _load_file(self) -> List[Dict[str, Any]]:
+        if not self.path:
+            return []
+        try:
+            self._file_mtime = os.path.getmtime(self.path)
+            with open(self.path, "r", encoding="utf-8") as f:
+                return self._parse(json.load(f))
+        except Exception as e:
+            logger.warning(f"Failed to load stations file {self.path}: {e}")
+            return []
+
+    def _load_db(self) -> List[Dict[str, Any]]:
+        if db is None:
+            return []
+        try:
+            return self._parse(list(db.get_collection("stations").find({}, {"_id": 0, "name": 1, "url": 1, "tags": 1})))
+        except Exception as e:
+            logger.debug(f"Failed to load stations collection: {e}")
+            return []
+
+    def reload(self, include_db: bool = True) -> int:
+        items = [dict(i, source="builtin") for i in self._parse(self.defaults)]
+        items += [dict(i, source="file") for i in self._load_file()]
+        if include_db:
+            items += [dict(i, source="db") for i in self._load_db()]
+        else:
+            # keep previously loaded DB entries, only the file is re-read
+            items += [s for s in self.stations.values() if s.get("source") == "db"]
+        stations: Dict[str, Dict[str, Any]] = {}
+        by_norm: Dict[str, str] = {}
+        trigram_index: Dict[str, set] = {}
+        name_trigrams: Dict[str, set] = {}
+        tag_index: Dict[str, set] = {}
+        for item in items:
+            norm = _normalize_station_name(item["name"])
+            if not norm:
+                continue
+            old = by_norm.get(norm)
+            if old and old != item["name"]:
+                stations.pop(old, None)
+            tags = [str(t).lower() for t in item.get("tags") or []]
+            stations[item["name"]] = {"name": item["name"], "url": item["url"], "tags": tags, "source": item["source"]}
+            by_norm[norm] = item["name"]
+        for norm, name in by_norm.items():
+            tris = _trigrams(norm)
+            name_trigrams[norm] = tris
+            for tri in tris:
+                trigram_index.setdefault(tri, set()).add(norm)
+            for tag in stations[name]["tags"]:
+                tag_index.setdefault(tag, set()).add(name)
+        # swap in the new indexes in one go so lookups never see a half-built catalog
+        self.stations, self._by_norm, self._trigram_index = stations, by_norm, trigram_index
+        self._name_trigrams, self._tag_index = name_trigrams, tag_index
+        self._sorted_norms = sorted(by_norm)
+        self._last_check = time.time()
+        logger.info(f"Station catalog loaded: {len(stations)} stations, {len(tag_index)} tags")
+        return len(stations)
+
+    def maybe_reload(self) -> None:
+        now = time.time()
+        if not self.path or now - self._last_check < self.reload_interval:
+            return
+        self._last_check = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._file_mtime:
+            self.reload(include_db=False)
+
+    def _prefix_matches(self, norm: str, limit: int) -> List[str]:
+        idx = bisect.bisect_left(self._sorted_norms, norm)
+        out = []
+        while idx < len(self._sorted_norms) and len(out) < limit and self._sorted_norms[idx].startswith(norm):
+            out.append(self._sorted_norms[idx])
+            idx += 1
+        return out
+
+    def search(self, query: str, limit: int = 5, tag: Optional[str] = None, min_score: float = 0.3) -> List[Dict[str, Any]]:
+        return [station for _, station in self.search_scored(query, limit, tag, min_score)]
+
+    def search_scored(self, query: str, limit: int = 5, tag: Optional[str] = None, min_score: float = 0.3) -> List[tuple]:
+        """(score, station) pairs, best first: 2.0 exact, 1.0-2.0 prefix, trigram Jaccard below that."""
+        self.maybe_reload()
+        norm = _normalize_station_name(query)
+        if not norm:
+            return []
+        allowed = self._tag_index.get(tag.lower(), set()) if tag else None
+        ranked: List[tuple] = []
+        seen = set()
+        exact = self._by_norm.get(norm)
+        if exact:
+            ranked.append((2.0, exact))
+            seen.add(norm)
+        for cand in self._prefix_matches(norm, limit * 4):
+            if cand not in seen:
+                seen.add(cand)
+                ranked.append((1.0 + len(norm) / len(cand), self._by_norm[cand]))
+        if len(ranked) < limit or allowed is not None:
+            q_tris = _trigrams(norm)
+            postings = sorted((self._trigram_index.get(tri, ()) for tri in q_tris), key=len)
+            # very common trigrams (e.g. "fm ") only add noise; gather candidates from the selective ones
+            cutoff = max(64, len(self._by_norm) // 8)
+            candidates = set()
+            for posting in postings:
+                if len(posting) > cutoff and candidates:
+                    break
+                candidates.update(posting)
+            for cand in candidates - seen:
+                cand_tris = self._name_trigrams[cand]
+                n = len(q_tris & cand_tris)
+                score = n / (len(q_tris) + len(cand_tris) - n)
+                if score >= min_score:
+                    ranked.append((score, self._by_norm[cand]))
+        ranked.sort(key=lambda x: (-x[0], x[1]))
+        out = []
+        for score, name in ranked:
+            if allowed is not None and name not in allowed:
+                continue
+            out.append((score, self.stations[name]))
+            if len(out) >= limit:
+                break
+        return out
+
+    def lookup(self, query: str, tag: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """The station a name unambiguously refers to, or None when the best match is weak or close to the next one."""
+        ranked = self.search_scored(query, limit=2, tag=tag)
+        if not ranked:
+            return None
+        top = ranked[0][0]
+        if top >= 2.0:
+            return ranked[0][1]
+        if top < LOOKUP_MIN_SCORE or (len(ranked) > 1 and top - ranked[1][0] < LOOKUP_MIN_LEAD):
+            return None
+        return ranked[0][1]
+
+    def by_tag(self, tag: str) -> List[Dict[str, Any]]:
+        self.maybe_reload()
+        return [self.stations[n] for n in sorted(self._tag_index.get(tag.lower(), ()))]
+
+    def tags(self) -> List[str]:
+        return sorted(self._tag_index)
+
+    def names(self) -> List[str]:
+        self.maybe_reload()
+        return sorted(self.stations, key=str.lower)
+
+station_catalog = StationCatalog(RADIO_STATION, STATIONS_FILE, STATIONS_RELOAD_INTERVAL)
+station_catalog.reload()
 
 # ===================== STARTUP helper =====================
+_caches_loaded_for: Optional[int] = None
+
 async def ensure_owner_id():
-    global OWNER_ID
+    global OWNER_ID, _caches_loaded_for
+    if OWNER_ID is not None and _caches_loaded_for == OWNER_ID:
+        return
+    await ensure_db()
     if OWNER_ID is None:
         me = await user_app.get_me()
         OWNER_ID = me.id
-    load_caches_for_owner(OWNER_ID)
-    logger.info(f"Owner user id: {OWNER_ID}")
+    if _caches_loaded_for != OWNER_ID:
+        # settings are loaded once per owner instead of on every handler call
+        _caches_loaded_for = OWNER_ID
+        await asyncio.get_running_loop().run_in_executor(None, load_caches_for_owner, OWNER_ID)
+        logger.info(f"Owner user id: {OWNER_ID}")
 
-# ===================== THUMB / IMAGE HELPERS (trimmed) =====================
-def clear_title(text: str) -> str:
-    parts = (text or "").split(" ")
-    title = ""
-    for i in parts:
-        if len(title) + len(i) < 60:
-            title += " " + i
-    return title.strip()
+# ===================== SHARDED WORKERS =====================
+class ShardRouter:
+    """Runs blocking per-chat work off the event loop, partitioned by chat_id.
+
+    With SHARD_WORKERS=0 work goes to the loop's default thread pool. With N > 0 each
+    chat is pinned to one of N single-process executors (chat_id % N), so a chat's
+    renders and extractions stay ordered while different chats use different cores.
+    Shared state stays in the settings store; the MTProto clients and voice calls stay
+    in this process because each account's session can only be driven from one place.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = max(0, workers)
+        self._executors: List[Optional[ProcessPoolExecutor]] = [None] * self.workers
+        self.submitted: List[int] = [0] * max(1, self.workers)
+
+    def shard_for(self, chat_id: int) -> int:
+        return chat_id % self.workers if self.workers else 0
+
+    def _executor(self, idx: int) -> ProcessPoolExecutor:
+        ex = self._executors[idx]
+        if ex is None:
+            # never fork: this process already runs an event loop and several threads
+            ex = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+            self._start_worker(ex)
+            self._executors[idx] = ex
+        return ex
+
+    @staticmethod
+    def _start_worker(ex: ProcessPoolExecutor) -> None:
+        """Start the executor's process with shard_worker standing in for __main__.
+
+        A spawned child re-imports the parent's main module, and app.py's top level creates
+        clients and registers handlers. The process is launched synchronously inside submit(),
+        so the swap only has to last for that call.
+        """
+        main = sys.modules["__main__"]
+        sys.modules["__main__"] = shard_worker
+        try:
+            ex.submit(int)
+        finally:
+            sys.modules["__main__"] = main
 
+    async def run(self, chat_id: int, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = functools.partial(fn, *args, **kwargs)
+        idx = self.shard_for(chat_id)
+        self.submitted[idx] += 1
+        if not self.workers:
+            return await loop.run_in_executor(None, call)
+        try:
+            return await loop.run_in_executor(self._executor(idx), call)
+        except BrokenProcessPool:
+            logger.warning(f"Shard worker {idx} died; restarting it")
+            self._executors[idx] = None
+            return await loop.run_in_executor(self._executor(idx), call)
+
+    def shutdown(self) -> None:
+        for idx, ex in enumerate(self._executors):
+            if ex is not None:
+                ex.shutdown(wait=False, cancel_futures=True)
+                self._executors[idx] = None
+
+shard_router = ShardRouter(SHARD_WORKERS)
+
+# ===================== THUMB / IMAGE HELPERS (trimmed) =====================
+@traced("thumb.download")
 async def _download_file(url: str, dest: str) -> Optional[str]:
     try:
-        async with aiohttp.ClientSession() as session:
+        import aiohttp
+        import aiofiles
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=20)) as session:
             async with session.get(url) as resp:
                 if resp.status != 200:
                     return None
@@ -237,81 +2096,28 @@ async def _download_file(url: str, dest: str) -> Optional[str]:
             pass
         return None
 
-def _create_circular_artwork(image: Image.Image, diameter: int = 520, border: int = 8) -> Image.Image:
+@traced("thumb.render")
+async def _process_image_and_overlay(src_path: str, out_key: str, title: str, chat_id: int = 0) -> Optional[str]:
     try:
-        square = ImageOps.fit(image, (diameter, diameter), centering=(0.5, 0.5))
-    except Exception:
-        square = image.resize((diameter, diameter), Image.LANCZOS)
-    mask = Image.new('L', (diameter, diameter), 0)
-    draw = ImageDraw.Draw(mask)
-    draw.ellipse((0, 0, diameter, diameter), fill=255)
-    circ = Image.new('RGBA', (diameter, diameter), (0, 0, 0, 0))
-    circ.paste(square.convert('RGBA'), (0, 0), mask=mask)
-    out_size = diameter + border * 2
-    out = Image.new('RGBA', (out_size, out_size), (0, 0, 0, 0))
-    shadow = Image.new('RGBA', (out_size, out_size), (0, 0, 0, 0))
-    shadow_mask = Image.new('L', (out_size, out_size), 0)
-    draw_sm = ImageDraw.Draw(shadow_mask)
-    draw_sm.ellipse((border//2, border//2, out_size - border//2, out_size - border//2), fill=200)
-    shadow.putalpha(shadow_mask)
-    shadow = shadow.filter(ImageFilter.GaussianBlur(radius=6))
-    out = Image.alpha_composite(out, shadow)
-    border_layer = Image.new('RGBA', (out_size, out_size), (255, 255, 255, 0))
-    draw_bl = ImageDraw.Draw(border_layer)
-    draw_bl.ellipse((border, border, out_size - border, out_size - border), fill=(255, 255, 255, 255))
-    inner_margin = border + 4
-    draw_bl.ellipse((inner_margin, inner_margin, out_size - inner_margin, out_size - inner_margin), fill=(0, 0, 0, 0))
-    out = Image.alpha_composite(out, border_layer)
-    paste_pos = (border, border)
-    out.paste(circ, paste_pos, circ)
-    return out
-
-async def _process_image_and_overlay(src_path: str, out_key: str, title: str) -> Optional[str]:
-    try:
-        image = Image.open(src_path).convert("RGBA")
-        try:
-            background = ImageOps.fit(image, (1280, 720), centering=(0.5, 0.5)).convert("RGBA")
-        except Exception:
-            background = image.resize((1280, 720), Image.LANCZOS).convert("RGBA")
-        background = background.filter(ImageFilter.BoxBlur(6))
-        enhancer = ImageEnhance.Brightness(background)
-        background = enhancer.enhance(0.85)
-        art = _create_circular_artwork(image, diameter=520, border=10)
-        art_x = 60
-        art_y = (720 - art.size[1]) // 2
-        background.paste(art, (art_x, art_y), art)
-        draw = ImageDraw.Draw(background)
-        try:
-            title_font = ImageFont.truetype("arial.ttf", 48)
-            small_font = ImageFont.truetype("arial.ttf", 18)
-        except Exception:
-            title_font = ImageFont.load_default()
-            small_font = ImageFont.load_default()
-        draw.text((20, 20), "DLK DEVELOPER", fill="white", font=small_font)
-        title_x = art_x + art.size[0] + 30
-        title_y = art_y + 30
-        shadow_color = (0, 0, 0, 200)
-        for dx, dy in ((1, 1), (2, 2)):
-            draw.text((title_x + dx, title_y + dy), clear_title(title), fill=shadow_color, font=title_font)
-        draw.text((title_x, title_y), clear_title(title), fill="white", font=title_font)
-        out_path = os.path.join(THUMB_CACHE_DIR, f"{out_key}.png")
-        background.save(out_path)
-        return out_path
+        return await shard_router.run(chat_id, _render_overlay_sync, src_path, out_key, title)
     except Exception as e:
         logger.debug(f"_process_image failed: {e}")
         return None
 
-async def get_thumb_from_url_or_webpage(thumbnail_url: Optional[str], webpage: Optional[str], title: str) -> Optional[str]:
+async def get_thumb_from_url_or_webpage(thumbnail_url: Optional[str], webpage: Optional[str], title: str, chat_id: int = 0) -> Optional[str]:
     if thumbnail_url:
         if os.path.isfile(thumbnail_url):
             key = re.sub(r"[^0-9A-Za-z_-]", "_", os.path.basename(thumbnail_url))[:40]
-            return await _process_image_and_overlay(thumbnail_url, key, title)
+            return await _process_image_and_overlay(thumbnail_url, key, title, chat_id)
         if thumbnail_url.startswith("http"):
             key = re.sub(r"[^0-9A-Za-z_-]", "_", thumbnail_url)[:40]
             tmp = os.path.join(THUMB_CACHE_DIR, f"tmp_{key}")
-            downloaded = await _download_file(thumbnail_url, tmp)
+            try:
+                downloaded = await thumb_breaker.call(_download_file, thumbnail_url, tmp, is_failure=lambda r: r is None)
+            except CircuitOpenError:
+                return None
             if downloaded:
-                processed = await _process_image_and_overlay(downloaded, key, title)
+                processed = await _process_image_and_overlay(downloaded, key, title, chat_id)
                 try:
                     os.remove(downloaded)
                 except Exception:
@@ -321,13 +2127,6 @@ async def get_thumb_from_url_or_webpage(thumbnail_url: Optional[str], webpage: O
     return None
 
 # ===================== YT / stream extraction =====================
-def looks_like_url(text: str) -> bool:
-    try:
-        p = urlparse(text)
-        return bool(p.scheme and p.netloc)
-    except Exception:
-        return False
-
 def get_youtube_id(url: str) -> Optional[str]:
     try:
         p = urlparse(url)
@@ -344,59 +2143,463 @@ def get_youtube_id(url: str) -> Optional[str]:
         pass
     return None
 
-def extract_audio_url(query: str) -> Optional[Dict[str, Any]]:
-    if youtube_dl is None:
-        logger.warning("yt_dlp not installed. /play requires yt-dlp.")
+@traced("resolve")
+async def _download_queued_message(entry: dict) -> Optional[Dict[str, Any]]:
+    """Download the audio message a lazy /playall entry points at ({"message": [chat_id, message_id]})."""
+    msg = await user_app.get_messages(*entry["message"])
+    if msg is None or getattr(msg, "empty", False):
         return None
-    target = query if looks_like_url(query) else f"ytsearch1:{query}"
-    ydl_opts = {
-        "format": "bestaudio/best",
-        "quiet": True,
-        "no_warnings": True,
-        "skip_download": True,
-        "noplaylist": True,
-    }
-    try:
-        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(target, download=False)
-            if not info:
-                return None
-            if "entries" in info and isinstance(info["entries"], list) and info["entries"]:
-                info = info["entries"][0]
-            stream_url = info.get("url")
-            if not stream_url and "formats" in info:
-                formats = info.get("formats", [])
-                best = None
-                for f in sorted(formats, key=lambda x: (x.get("abr") or 0), reverse=True):
-                    if f.get("acodec") and f.get("url"):
-                        best = f.get("url")
-                        break
-                stream_url = best or stream_url
-            if not stream_url:
-                logger.warning("yt_dlp did not return playable stream URL.")
-                return None
-            return {
-                "title": info.get("title") or "Unknown",
-                "webpage_url": info.get("webpage_url") or info.get("id") or target,
-                "stream_url": stream_url,
-                "thumbnail": info.get("thumbnail"),
-                "duration": int(info.get("duration")) if info.get("duration") else None,
-            }
+    return await prepare_entry_from_reply(msg)
+
+async def resolve_entry(chat_id: int, entry: dict) -> bool:
+    """Fill in the stream URL of a lazy queue entry (yt-dlp, or downloading the queued audio message).
+    Concurrent callers share one extraction."""
+    if entry.get("stream_url"):
+        return True
+    from_message = bool(entry.get("message"))
+    task = entry.get("_resolving")
+    if task is None:
+        if from_message:
+            task = asyncio.ensure_future(_download_queued_message(entry))
+        else:
+            task = asyncio.ensure_future(run_ytdlp(chat_id, extract_audio_url, entry["webpage"], quality_controller.source_profile()))
+        entry["_resolving"] = task
+    try:
+        info = await asyncio.shield(task)
     except Exception as e:
-        logger.warning(f"yt_dlp extraction failed for {query}: {e}")
+        logger.debug(f"Resolving {entry.get('webpage')} failed: {e}")
+        info = None
+    finally:
+        if task.done():
+            entry.pop("_resolving", None)
+    if not info or not info.get("stream_url"):
+        return False
+    resolved = info if from_message else track_to_entry(info)
+    for key in ("thumbnail", "duration", "title"):
+        # a placeholder title that is just the link or search text gives way to the real one
+        if entry.get(key) and not (key == "title" and entry[key] == entry.get("webpage")):
+            resolved.pop(key, None)
+    entry.update(resolved)
+    entry.pop("lazy", None)
+    return True
+
+async def run_ytdlp(chat_id: int, fn, *args):
+    """Run a yt-dlp extraction on the chat's shard behind ytdlp_breaker.
+
+    Only network errors and rate limits (ExtractorUnavailable) or crashes count against the breaker;
+    a query with no results or an unavailable video just returns None.
+    """
+    with span(f"ytdlp.{fn.__name__}", shard=shard_router.shard_for(chat_id)):
+        try:
+            return await ytdlp_breaker.call(shard_router.run, chat_id, fn, *args)
+        except ExtractorUnavailable as e:
+            logger.warning(f"yt-dlp unavailable for chat {chat_id}: {e}")
+            return None
+
+def prefetch_next(chat_id: int) -> None:
+    """Resolve the head of the queue in the background so the next track starts without waiting on yt-dlp."""
+    session = sessions.get(chat_id)
+    if session and session.queue and session.queue[0].get("lazy") and "_resolving" not in session.queue[0]:
+        asyncio.create_task(_prefetch(chat_id, session, session.queue[0]))
+
+async def _prefetch(chat_id: int, session: PlaybackSession, entry: dict) -> None:
+    if await resolve_entry(chat_id, entry) and sessions.get(chat_id) is not session:
+        discard_local_file(entry)  # playback ended while the file was downloading
+
+# ===================== RADIO RELAY =====================
+RADIO_RELAY = os.environ.get("RADIO_RELAY", "0") == "1"
+RELAY_HOST = os.environ.get("RELAY_HOST", "127.0.0.1")
+RELAY_PORT = int(os.environ.get("RELAY_PORT", "8765") or 8765)
+RELAY_IDLE_GRACE = float(os.environ.get("RELAY_IDLE_GRACE", "10") or 10)  # keep upstream open briefly after the last listener
+RELAY_CHUNK = 16384
+RELAY_QUEUE = 64  # chunks buffered per listener before the oldest are dropped
+
+class RelayChannel:
+    """One upstream connection for a station, copied to every subscribed listener queue."""
+
+    def __init__(self, key: str, url: str):
+        self.key = key
+        self.url = url
+        self.listeners: set = set()
+        self.content_type = "audio/mpeg"
+        self.ready = asyncio.Event()
+        self.bytes_in = 0
+        self._pump: Optional[asyncio.Task] = None
+        self._teardown: Optional[asyncio.TimerHandle] = None
+
+    def subscribe(self) -> asyncio.Queue:
+        if self._teardown is not None:
+            self._teardown.cancel()
+            self._teardown = None
+        q: asyncio.Queue = asyncio.Queue(maxsize=RELAY_QUEUE)
+        self.listeners.add(q)
+        if self._pump is None or self._pump.done():
+            self.ready.clear()
+            self._pump = asyncio.create_task(self._run())
+        return q
+
+    def unsubscribe(self, q: asyncio.Queue, on_idle) -> None:
+        self.listeners.discard(q)
+        if not self.listeners and self._teardown is None:
+            self._teardown = asyncio.get_running_loop().call_later(RELAY_IDLE_GRACE, on_idle, self)
+
+    def close(self) -> None:
+        if self._pump is not None:
+            self._pump.cancel()
+        for q in list(self.listeners):
+            self._offer(q, None)
+
+    @staticmethod
+    def _offer(q: asyncio.Queue, chunk: Optional[bytes]) -> None:
+        if q.full():
+            # slow listener: drop its oldest audio rather than stall everyone else
+            try:
+                q.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+        q.put_nowait(chunk)
+
+    async def _connect(self, session):
+        resp = await session.get(self.url)
+        if resp.status != 200:
+            resp.release()
+            raise RuntimeError(f"HTTP {resp.status}")
+        return resp
+
+    async def _run(self):
+        import aiohttp
+        backoff = 1.0
+        breaker = station_breaker(self.url)
+        while self.listeners:
+            try:
+                timeout = aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=30)
+                async with aiohttp.ClientSession(timeout=timeout) as session:
+                    # only connection setup goes through the breaker; the stream itself is long-lived
+                    async with await breaker.call(self._connect, session) as resp:
+                        self.content_type = resp.headers.get("Content-Type", self.content_type)
+                        self.ready.set()
+                        backoff = 1.0
+                        async for chunk in resp.content.iter_chunked(RELAY_CHUNK):
+                            self.bytes_in += len(chunk)
+                            metrics.inc("relay_bytes_in_total", len(chunk))
+                            for q in list(self.listeners):
+                                self._offer(q, chunk)
+                            if not self.listeners:
+                                break
+                if self.listeners:
+                    logger.info(f"Relay upstream {self.url} ended; reconnecting")
+                    await asyncio.sleep(1.0)
+            except asyncio.CancelledError:
+                raise
+            except CircuitOpenError as e:
+                logger.info(f"Relay upstream {self.url} skipped: {e}")
+                await asyncio.sleep(max(breaker.retry_after(), 1.0))
+            except Exception as e:
+                logger.warning(f"Relay upstream {self.url} failed: {e}; retrying in {backoff:.0f}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+class StationRelay:
+    """Local HTTP relay: each station is fetched once and fanned out to all calls tuned to it."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.urls: Dict[str, str] = {}
+        self.channels: Dict[str, RelayChannel] = {}
+        self._runner = None
+
+    def url_for(self, upstream: str) -> str:
+        key = hashlib.sha1(upstream.encode("utf-8")).hexdigest()[:16]
+        self.urls[key] = upstream
+        return f"http://{self.host}:{self.port}/relay/{key}"
+
+    def _on_idle(self, channel: RelayChannel) -> None:
+        if channel.listeners:
+            return
+        channel.close()
+        self.channels.pop(channel.key, None)
+        logger.info(f"Relay closed upstream {channel.url}")
+
+    async def handle(self, request):
+        from aiohttp import web
+        key = request.match_info["key"]
+        upstream = self.urls.get(key)
+        if not upstream:
+            raise web.HTTPNotFound()
+        channel = self.channels.get(key)
+        if channel is None:
+            channel = self.channels[key] = RelayChannel(key, upstream)
+            logger.info(f"Relay opened upstream {upstream}")
+        q = channel.subscribe()
+        try:
+            try:
+                await asyncio.wait_for(channel.ready.wait(), timeout=20)
+            except asyncio.TimeoutError:
+                raise web.HTTPBadGateway()
+            resp = web.StreamResponse(headers={"Content-Type": channel.content_type, "Cache-Control": "no-cache"})
+            await resp.prepare(request)
+            try:
+                while True:
+                    chunk = await q.get()
+                    if chunk is None:
+                        break
+                    await resp.write(chunk)
+            except ConnectionResetError:
+                pass  # listener (ffmpeg) went away
+            return resp
+        finally:
+            channel.unsubscribe(q, self._on_idle)
+
+    async def start(self) -> None:
+        from aiohttp import web
+        web_app = web.Application()
+        web_app.router.add_get("/relay/{key}", self.handle)
+        self._runner = web.AppRunner(web_app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Radio relay listening on http://{self.host}:{self.port}/relay/")
+
+    async def stop(self) -> None:
+        for channel in list(self.channels.values()):
+            channel.close()
+        self.channels.clear()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+station_relay: Optional[StationRelay] = StationRelay(RELAY_HOST, RELAY_PORT) if RADIO_RELAY else None
+metrics.gauge_callback("relay_upstreams", lambda: len(station_relay.channels) if station_relay else 0, "Stations currently pulled by the relay")
+metrics.gauge_callback("relay_listeners", lambda: sum(len(c.listeners) for c in station_relay.channels.values()) if station_relay else 0, "Calls reading from the relay")
+
+# ===================== STREAM QUALITY =====================
+ADAPTIVE_QUALITY = os.environ.get("ADAPTIVE_QUALITY", "1") == "1"
+QUALITY_CPU_HIGH = float(os.environ.get("QUALITY_CPU_HIGH", "0.85") or 0.85)  # CPU share counted as overload
+QUALITY_CPU_LOW = float(os.environ.get("QUALITY_CPU_LOW", "0.6") or 0.6)  # below this, new streams may step back up
+QUALITY_SUSTAIN = float(os.environ.get("QUALITY_SUSTAIN", "20") or 20)  # seconds of overload before stepping down
+QUALITY_INTERVAL = 5.0
+QUALITY_STEP_BATCH = 3  # running calls restarted per tick; each restart briefly costs CPU itself
+
+# (name, sample rate, channels, yt-dlp source profile); the first tier is what MediaStream uses by default
+QUALITY_TIERS = (
+    ("high", 48000, 2, "high"),
+    ("medium", 48000, 1, "medium"),
+    ("low", 36000, 1, "low"),
+    ("minimal", 24000, 1, "low"),
+)
+
+_CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+def _child_pids(pid: int) -> List[int]:
+    """Direct children of `pid` from /proc/<pid>/task/*/children (Linux 3.5+)."""
+    children: List[int] = []
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return children  # exited meanwhile, or no /proc
+    for tid in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{tid}/children", "r") as f:
+                children.extend(int(c) for c in f.read().split())
+        except OSError:
+            continue
+    return children
+
+def _live_children_cpu_seconds() -> float:
+    """utime+stime of this process's live descendants (the ffmpeg encoders) from /proc/<pid>/stat.
+
+    Only our own process tree is read, never the whole of /proc. Blocking: call it off the loop.
+    """
+    total, frontier = 0, _child_pids(os.getpid())
+    while frontier:
+        pid = frontier.pop()
+        try:
+            with open(f"/proc/{pid}/stat", "r") as f:
+                data = f.read()
+        except OSError:
+            continue  # exited meanwhile
+        # the command name is in parentheses and may contain spaces; fields after it start at "state"
+        fields = data[data.rfind(")") + 2:].split()
+        total += int(fields[11]) + int(fields[12])  # utime + stime
+        frontier.extend(_child_pids(pid))
+    return total / _CLK_TCK
+
+def _cpu_seconds() -> float:
+    """CPU time of the bot and its ffmpeg children. os.times() only has the children once they are
+    reaped, so running ones are read from /proc; a child's time moves from one term to the other
+    when it exits. Blocking (file reads): run it in the executor."""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system + _live_children_cpu_seconds()
+
+def _host_cpu_times() -> Optional[tuple]:
+    """(busy, total) jiffies from /proc/stat, or None off Linux."""
+    try:
+        with open("/proc/stat", "r") as f:
+            fields = [int(v) for v in f.readline().split()[1:]]
+    except Exception:
         return None
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+    total = sum(fields[:8])
+    return total - idle, total
+
+class QualityController:
+    """Chooses stream quality from process and host CPU.
+
+    New streams use the current level. Once the load has stayed above QUALITY_CPU_HIGH for
+    QUALITY_SUSTAIN seconds the level drops one tier and running calls above it are restarted at
+    the lower tier (seeking back to their position), a few per tick. The level only climbs back,
+    for new streams, after three times as long below QUALITY_CPU_LOW.
+    """
+
+    def __init__(self):
+        self.level = 0
+        self.process_cpu = 0.0
+        self.host_cpu = 0.0
+        self.over_since: Optional[float] = None
+        self.under_since: Optional[float] = None
+        self._last_proc = (time.perf_counter(), _cpu_seconds())
+        self._last_host = _host_cpu_times()
+
+    @property
+    def load(self) -> float:
+        return max(self.process_cpu, self.host_cpu)
+
+    def tier(self, level: Optional[int] = None) -> tuple:
+        return QUALITY_TIERS[self.level if level is None else level]
+
+    def source_profile(self) -> str:
+        """yt-dlp profile for new extractions: the tier's, never above the configured AUDIO_PROFILE."""
+        profile = self.tier()[3]
+        return profile if AUDIO_PROFILES[profile] < AUDIO_PROFILES[AUDIO_PROFILE] else AUDIO_PROFILE
+
+    def sample(self) -> None:
+        """Read process and host CPU since the last sample. Blocking (/proc reads): runs in the executor."""
+        now, cpu = time.perf_counter(), _cpu_seconds()
+        wall = max(1e-6, now - self._last_proc[0])
+        self.process_cpu = max(0.0, cpu - self._last_proc[1]) / wall / (os.cpu_count() or 1)
+        self._last_proc = (now, cpu)
+        host = _host_cpu_times()
+        if host is not None and self._last_host is not None and host[1] > self._last_host[1]:
+            self.host_cpu = (host[0] - self._last_host[0]) / (host[1] - self._last_host[1])
+        elif host is None and hasattr(os, "getloadavg"):
+            self.host_cpu = min(1.0, os.getloadavg()[0] / (os.cpu_count() or 1))
+        self._last_host = host
+
+    def update(self, now: Optional[float] = None) -> int:
+        """Apply hysteresis to the latest sample. Returns 1 if quality was lowered, -1 if raised, else 0."""
+        now = time.time() if now is None else now
+        if self.load >= QUALITY_CPU_HIGH:
+            self.under_since = None
+            self.over_since = self.over_since or now
+            if now - self.over_since >= QUALITY_SUSTAIN and self.level < len(QUALITY_TIERS) - 1:
+                self.level += 1
+                self.over_since = now  # another full sustain period before the next step
+                return 1
+        elif self.load < QUALITY_CPU_LOW:
+            self.over_since = None
+            self.under_since = self.under_since or now
+            if now - self.under_since >= QUALITY_SUSTAIN * 3 and self.level > 0:
+                self.level -= 1
+                self.under_since = now
+                return -1
+        else:
+            self.over_since = self.under_since = None
+        return 0
+
+quality_controller = QualityController()
+
+metrics.gauge_callback("stream_quality_level", lambda: quality_controller.level, "Tier index for new streams (0 = best)")
+metrics.gauge_callback("cpu_process_ratio", lambda: quality_controller.process_cpu, "Bot process CPU as a share of all cores")
+metrics.gauge_callback("cpu_host_ratio", lambda: quality_controller.host_cpu, "Host CPU busy share")
+
+_seek_param: Optional[str] = None
+
+def _media_stream_seek_param() -> str:
+    """Name of MediaStream's extra-ffmpeg-arguments parameter on this pytgcalls version ("" if it has none)."""
+    global _seek_param
+    if _seek_param is None:
+        try:
+            params = inspect.signature(MediaStream).parameters
+        except (TypeError, ValueError):
+            params = {}
+        _seek_param = next((n for n in ("ffmpeg_parameters", "additional_ffmpeg_parameters") if n in params), "")
+    return _seek_param
+
+def can_seek() -> bool:
+    """Whether a stream can be started part-way through (ffmpeg -ss) on this pytgcalls version."""
+    return MediaStream is not None and bool(_media_stream_seek_param())
+
+def build_media_stream(source: str, level: int = 0, seek: float = 0.0):
+    """MediaStream at a quality tier, optionally starting `seek` seconds in. Options this pytgcalls
+    version does not support are left out (check can_seek() before relying on the seek)."""
+    kwargs: Dict[str, Any] = {}
+    if ADAPTIVE_QUALITY and AudioParameters is not None:
+        _, rate, channels, _ = QUALITY_TIERS[level]
+        kwargs["audio_parameters"] = AudioParameters(rate, channels)
+    if seek >= 1 and can_seek():
+        kwargs[_media_stream_seek_param()] = f"-ss {int(seek)}"
+    if not kwargs:
+        return MediaStream(source)
+    try:
+        return MediaStream(source, **kwargs)
+    except TypeError:
+        return MediaStream(source)
+
+def _can_restream(session: PlaybackSession) -> bool:
+    """Live streams can always be restarted; a track only if it can resume where it was rather than from 0:00."""
+    return bool(session.source) and not session.paused and (not session.seekable or can_seek())
+
+async def _restream(session: PlaybackSession, level: int) -> bool:
+    slot = assistant_pool.get(session.chat_id)
+    if slot is None or not _can_restream(session):
+        return False
+    seek = session.position() if session.seekable else 0.0
+    try:
+        result = slot.call.play(session.chat_id, build_media_stream(session.source, level, seek))
+        if inspect.isawaitable(result):
+            await result
+    except Exception as e:
+        logger.debug(f"Quality step-down failed for {session.chat_id}: {e}")
+        return False
+    session.quality = level
+    metrics.inc("quality_stepdowns_total", tier=QUALITY_TIERS[level][0])
+    return True
+
+async def quality_controller_loop():
+    while True:
+        await asyncio.sleep(QUALITY_INTERVAL)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, quality_controller.sample)
+            change = quality_controller.update()
+            if change:
+                name = quality_controller.tier()[0]
+                logger.warning(f"Stream quality {'lowered' if change > 0 else 'raised'} to {name} "
+                               f"(process {quality_controller.process_cpu:.0%}, host {quality_controller.host_cpu:.0%})")
+            if quality_controller.over_since is None or quality_controller.level == 0:
+                continue
+            # still overloaded: move running calls that are above the current level down to it
+            level = quality_controller.level
+            # tracks that cannot seek stay at their tier rather than restart from the beginning
+            stale = [s for s in sessions if s.playing and s.quality < level and _can_restream(s)]
+            stale.sort(key=lambda s: s.quality)
+            for session in stale[:QUALITY_STEP_BATCH]:
+                await _restream(session, level)
+        except Exception as e:
+            logger.debug(f"quality controller error: {e}")
 
 # ===================== PLAY FLOW =====================
-async def _safe_call_py_method(method_name: str, *args, **kwargs):
+async def _safe_call_py_method(method_name: str, chat_id: int, *args, **kwargs):
     try:
-        if not call_py:
+        # route to the PyTgCalls instance of the assistant serving this chat
+        slot = assistant_pool.get(chat_id)
+        call = slot.call if slot is not None else call_py
+        if not call:
             return None
-        if not hasattr(call_py, method_name):
+        if not hasattr(call, method_name):
             return None
-        attr = getattr(call_py, method_name)
+        attr = getattr(call, method_name)
         if not callable(attr):
             return None
-        result = attr(*args, **kwargs)
+        result = attr(chat_id, *args, **kwargs)
         if inspect.isawaitable(result):
             return await result
         return result
@@ -404,12 +2607,192 @@ async def _safe_call_py_method(method_name: str, *args, **kwargs):
         logger.debug(f"_safe_call_py_method {method_name} failed: {e}")
         return None
 
+async def _get_slot_user_id(slot: AssistantSlot) -> Optional[int]:
+    if slot.user_id is None:
+        try:
+            me = await slot.client.get_me()
+            slot.user_id = me.id
+        except Exception:
+            return None
+    return slot.user_id
+
+@traced("assistant.ensure_in_chat")
+async def ensure_assistant_in_chat(slot: AssistantSlot, chat_id: int) -> tuple:
+    """Make sure the slot's account is a member of chat_id.
+
+    Returns (present, invite_link); invite_link is set when an invite was created but the
+    assistant could not join by itself.
+    """
+    if slot.is_user_app:
+        return True, None
+    assistant_id = await _get_slot_user_id(slot)
+    if assistant_id:
+        try:
+            await slot.client.get_chat_member(chat_id, assistant_id)
+            return True, None
+        except Exception:
+            pass
+    try:
+        invite = await user_app.create_chat_invite_link(chat_id, member_limit=1, name="dlk_assistant_invite")
+    except Exception:
+        return False, None
+    try:
+        await slot.client.join_chat(invite.invite_link)
+        return True, None
+    except Exception:
+        return False, invite.invite_link
+
+async def _play_on_slot(slot: AssistantSlot, chat_id: int, stream_source: str, offset: float = 0.0) -> None:
+    try:
+        with span("voice.play", assistant=slot.index):
+            result = slot.call.play(chat_id, build_media_stream(stream_source, quality_controller.level, offset))
+            if inspect.isawaitable(result):
+                await result
+        assistant_pool.record_success(slot)
+    except Exception:
+        moved = assistant_pool.record_failure(slot)
+        if moved:
+            asyncio.create_task(rebalance_chats([c for c in moved if c != chat_id], slot))
+        raise
+
+async def rebalance_chats(chat_ids: List[int], failed: Optional[AssistantSlot] = None):
+    """Restart the current track of each chat on another assistant, from where it was."""
+    for chat_id in chat_ids:
+        if failed is not None:
+            # best effort: the failed account may not answer, which is why the chat is being moved
+            try:
+                result = failed.call.leave_call(chat_id)
+                if inspect.isawaitable(result):
+                    await asyncio.wait_for(result, 5)
+            except Exception as e:
+                logger.debug(f"Leaving {chat_id} on assistant #{failed.index} failed: {e}")
+        session = sessions.get(chat_id)
+        if not session or not session.entry:
+            continue
+        entry = dict(session.entry)
+        offset = session.position() if session.seekable and can_seek() else 0.0
+        logger.info(f"Rebalancing chat {chat_id} to another assistant at {offset:.0f}s")
+        try:
+            if not await play_entry(chat_id, entry, offset=offset):
+                logger.warning(f"Rebalance failed for {chat_id}: could not restart {entry.get('title')}")
+                await leave_voice_chat(chat_id)
+        except Exception as e:
+            logger.warning(f"Rebalance failed for {chat_id}: {e}")
+
+async def assistant_health_loop():
+    while True:
+        await asyncio.sleep(ASSISTANT_HEALTH_INTERVAL)
+        for slot in assistant_pool.slots:
+            try:
+                me = await slot.client.get_me()
+                slot.user_id = me.id
+                if not slot.healthy:
+                    logger.info(f"Assistant #{slot.index} recovered")
+                    assistant_pool.record_success(slot)
+            except Exception as e:
+                if slot.healthy:
+                    logger.warning(f"Assistant #{slot.index} health check failed: {e}")
+                    await rebalance_chats(assistant_pool.mark_failed(slot), slot)
+
+async def _count_listeners(chat_id: int) -> Optional[int]:
+    """Participants in the chat's call other than our own account, or None if the call backend cannot tell."""
+    participants = await _safe_call_py_method("get_participants", chat_id)
+    if participants is None:
+        return None
+    slot = assistant_pool.get(chat_id)
+    own_id = await _get_slot_user_id(slot) if slot is not None else None
+    return sum(1 for p in participants if getattr(p, "user_id", None) != own_id)
+
+async def _stop_session(chat_id: int, reason: str, notice: str) -> None:
+    session = sessions.get(chat_id)
+    msg_id = session.msg_id if session is not None else None
+    await leave_voice_chat(chat_id)
+    metrics.inc("calls_reaped_total", reason=reason)
+    logger.info(f"Left voice chat {chat_id} ({reason})")
+    try:
+        if msg_id:
+            await user_app.edit_message_caption(chat_id=chat_id, message_id=msg_id, caption=notice, reply_markup=None)
+        else:
+            await user_app.send_message(chat_id, notice)
+    except Exception:
+        pass
+
+# chat_id -> chat it will evict once its join succeeds (None: a free slot was left)
+call_reservations: Dict[int, Optional[int]] = {}
+_call_slots = asyncio.Condition()
+
+async def reserve_call_slot(chat_id: int) -> None:
+    """Claim one of the MAX_ACTIVE_CALLS slots for chat_id before it joins.
+
+    Active calls plus pending reservations are counted under the condition's lock, so concurrent
+    joins cannot both take the last slot. At the cap the least recently active call is picked as
+    the victim, but it is only stopped by settle_call_slot() once the new join has worked; if every
+    slot is held by a join still in flight, this waits for one of them to finish.
+    """
+    if MAX_ACTIVE_CALLS <= 0:
+        return
+    async with _call_slots:
+        while True:
+            session = sessions.get(chat_id)
+            if chat_id in call_reservations or (session is not None and session.active):
+                return
+            claimed = {v for v in call_reservations.values() if v is not None}
+            active = [s for s in sessions if s.active and s.chat_id not in claimed and s.chat_id not in call_reservations]
+            if len(active) + len(call_reservations) < MAX_ACTIVE_CALLS:
+                call_reservations[chat_id] = None
+                return
+            if active:
+                call_reservations[chat_id] = min(active, key=lambda s: s.last_active).chat_id
+                return
+            await _call_slots.wait()
+
+async def release_call_slot(chat_id: int) -> None:
+    """Drop chat_id's reservation (failed join); its victim keeps playing."""
+    if chat_id not in call_reservations:
+        return
+    async with _call_slots:
+        call_reservations.pop(chat_id, None)
+        _call_slots.notify_all()
+
+async def settle_call_slot(chat_id: int) -> None:
+    """chat_id joined: turn its reservation into a real call and stop the victim it displaced."""
+    if chat_id not in call_reservations:
+        return
+    async with _call_slots:
+        victim = call_reservations.pop(chat_id, None)
+        _call_slots.notify_all()
+    session = sessions.get(victim) if victim is not None else None
+    if session is not None and session.active:
+        await _stop_session(victim, "evicted", "⏹ Playback stopped to free a voice slot for another chat.")
+
+async def idle_reaper_loop():
+    while True:
+        await asyncio.sleep(IDLE_REAP_INTERVAL)
+        for session in sessions:
+            if not session.active:
+                continue
+            try:
+                listeners = await _count_listeners(session.chat_id)
+            except Exception as e:
+                logger.debug(f"Listener count failed for {session.chat_id}: {e}")
+                continue
+            if listeners is None:
+                continue
+            now = time.time()
+            if listeners > 0:
+                session.touch()
+            elif session.empty_since is None:
+                session.empty_since = now
+            elif now - session.empty_since >= IDLE_GRACE:
+                await _stop_session(session.chat_id, "idle", "⏹ Left the voice chat: nobody was listening.")
+
 def player_controls_markup(chat_id: int):
     # Inline player controls removed per request - return None so no inline buttons are posted.
     return None
 
 async def update_radio_timer(chat_id: int, msg_id: int, title: str, start_time: float):
-    while True:
+    failures = 0
+    while failures < TIMER_MAX_FAILURES:
         try:
             elapsed = int(time.time() - start_time)
             m, s = divmod(elapsed, 60)
@@ -418,48 +2801,189 @@ async def update_radio_timer(chat_id: int, msg_id: int, title: str, start_time:
             caption = f"🎧 Now Playing: {title}\n⏳ Duration: {timer}"
             try:
                 await user_app.edit_message_caption(chat_id=chat_id, message_id=msg_id, caption=caption, reply_markup=player_controls_markup(chat_id))
+                failures = 0
             except Exception:
                 try:
                     await user_app.edit_message_text(chat_id, msg_id, caption, reply_markup=player_controls_markup(chat_id))
+                    failures = 0
                 except Exception:
-                    pass
+                    failures += 1
         except Exception as e:
             logger.debug(f"Timer update failed for {chat_id}/{msg_id}: {e}")
             break
-        await asyncio.sleep(8)
+        await asyncio.sleep(RADIO_TIMER_INTERVAL)
+
+# Per-play resource accounting: format/size of what was streamed and the CPU it cost while playing
+def start_play_record(session: PlaybackSession, entry: dict) -> None:
+    finish_play_record(session)
+    chat_id = session.chat_id
+    fmt = entry.get("format") or {}
+    # the CPU reading walks /proc, so it is taken in the executor; finish awaits it
+    cpu0 = asyncio.get_running_loop().run_in_executor(None, _cpu_seconds)
+    session.record = {"chat_id": chat_id, "title": entry.get("title"), "format": fmt, "started": time.time(), "cpu0": cpu0}
+    metrics.inc("streams_started_total", acodec=fmt.get("acodec") or "unknown", profile=fmt.get("profile") or "radio")
+    if fmt.get("filesize"):
+        metrics.inc("stream_bytes_planned_total", float(fmt["filesize"]))
+    logger.info(f"Streaming in {chat_id}: {entry.get('title')} format={fmt.get('format_id')} {fmt.get('acodec')} {fmt.get('abr')}kbps size={fmt.get('filesize')}")
+
+def finish_play_record(session: PlaybackSession) -> None:
+    rec, session.record = session.record, None
+    if rec is None:
+        return
+    wall = max(1.0, time.time() - rec.pop("started"))
+    # process-wide CPU over the play, split evenly over the calls that were active meanwhile
+    share = max(1, sum(1 for s in sessions if s.record) + 1)
+    asyncio.create_task(_finish_play_record(rec, wall, share))
+
+async def _finish_play_record(rec: dict, wall: float, share: int):
+    loop = asyncio.get_running_loop()
+    try:
+        cpu0 = await rec.pop("cpu0")
+        cpu = max(0.0, await loop.run_in_executor(None, _cpu_seconds) - cpu0) / share
+    except Exception as e:
+        logger.debug(f"Play CPU reading failed for {rec['chat_id']}: {e}")
+        cpu = 0.0
+    rec.update({"seconds": round(wall, 1), "cpu_seconds": round(cpu, 2), "cpu_per_minute": round(cpu / wall * 60, 2), "ts": time.time()})
+    metrics.inc("stream_seconds_total", wall)
+    metrics.inc("stream_cpu_seconds_total", cpu)
+    logger.info(f"Play finished in {rec['chat_id']}: {rec['seconds']}s, ~{rec['cpu_per_minute']} CPU-s/min, format={rec['format'].get('format_id')}")
+    if db is not None:
+        loop.run_in_executor(None, store_play_record, rec)
 
-def store_play_state(chat_id: int, title: str, url: str, msg_id: int, start_time: Optional[float], elapsed: float = 0.0, paused: bool = False):
-    state = {"chat_id": chat_id, "station": title, "url": url, "msg_id": msg_id, "start_time": start_time, "elapsed": elapsed, "paused": paused, "ts": time.time()}
-    radio_state[chat_id] = state
+def store_play_record(rec: dict):
     try:
-        if playing_coll:
-            playing_coll.update_one({"chat_id": chat_id}, {"$set": state}, upsert=True)
+        if db is not None:
+            mongo_breaker.call_sync(db.get_collection("play_stats").insert_one, rec)
+    except Exception as e:
+        logger.debug(f"play_stats insert failed: {e}")
+
+def store_play_state(doc: Dict[str, Any]):
+    """Upsert a session's to_doc(). Built on the loop, since the queue may change while this runs."""
+    try:
+        if playing_coll is not None:
+            mongo_breaker.call_sync(playing_coll.update_one, {"chat_id": doc["chat_id"]}, {"$set": doc}, upsert=True)
     except Exception:
         pass
 
-async def leave_voice_chat(chat_id: int):
+def save_play_state(session: Optional[PlaybackSession]) -> None:
+    """Store the session's play state in the background (after a track starts or the queue changes)."""
+    if session is not None and session.active and playing_coll is not None:
+        asyncio.get_running_loop().run_in_executor(None, store_play_state, session.to_doc())
+
+def forget_play_state(chat_id: int):
     try:
-        if chat_id in radio_tasks:
-            radio_tasks[chat_id].cancel()
-            radio_tasks.pop(chat_id, None)
-        if chat_id in track_watchers:
-            try:
-                track_watchers[chat_id].cancel()
-            except Exception:
-                pass
-            track_watchers.pop(chat_id, None)
-        if chat_id in radio_paused:
-            radio_paused.discard(chat_id)
-        radio_state.pop(chat_id, None)
-        if call_py:
+        if playing_coll is not None:
+            mongo_breaker.call_sync(playing_coll.delete_one, {"chat_id": chat_id})
+    except Exception:
+        pass
+
+async def leave_voice_chat(chat_id: int, forget: bool = True, leave: bool = True):
+    """Leave the call and close the chat's session; forget=False keeps the stored play state for a takeover.
+
+    leave=False only closes the session, for when another replica has taken the call over.
+    """
+    try:
+        session = sessions.get(chat_id)
+        leftovers = [session.entry, *session.queue] if session is not None else []
+        session = sessions.close(chat_id)
+        for entry in leftovers:
+            discard_local_file(entry)
+        if session is not None:
+            finish_play_record(session)
+            if forget:
+                asyncio.get_running_loop().run_in_executor(None, forget_play_state, chat_id)
+        if call_py and leave:
             try:
                 await _safe_call_py_method("leave_call", chat_id)
                 await _safe_call_py_method("stop", chat_id)
             except Exception:
                 pass
+        assistant_pool.release(chat_id)
+    except Exception as e:
+        logger.warning(f"Failed to leave VC/cancel task for {chat_id}: {e}")
+
+TG_CHUNK = 1024 * 1024  # upload.GetFile part size used by stream_media offsets/limits
+
+@traced("media.download")
+async def parallel_download(client: Client, message: Message, media: Any, dest: str, parallelism: int = DOWNLOAD_PARALLELISM) -> Optional[str]:
+    """Download message media as `parallelism` concurrent byte ranges into a preallocated file.
+
+    Each range is its own stream_media() call, and pyrogram opens a separate media session for
+    every one of them (sessions are per range, not pooled), so parallelism also bounds the number
+    of extra connections. Chunks are written at their offset with os.pwrite in the executor, keeping
+    disk I/O off the event loop. The result is checked against the expected size of every range
+    before it is moved into place; small files, or any failure, fall back to a plain download_media().
+    """
+    size = getattr(media, "file_size", 0) or 0
+    started = time.perf_counter()
+    if parallelism <= 1 or size < max(PARALLEL_DOWNLOAD_MIN, 2 * TG_CHUNK):
+        path = await client.download_media(message, file_name=dest)
+        metrics.observe("download_seconds", time.perf_counter() - started, mode="sequential")
+        return path
+    chunks = -(-size // TG_CHUNK)
+    per_part = -(-chunks // min(parallelism, chunks))
+    ranges = [(first, min(per_part, chunks - first)) for first in range(0, chunks, per_part)]
+    tmp_path = dest + ".part"
+
+    loop = asyncio.get_running_loop()
+    # one writer thread: chunks land in order of arrival and the final close queues behind every
+    # write already handed over, even those of ranges cancelled after a failure
+    writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="download")
+
+    def preallocate() -> int:
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(fd, size)
+        return fd
+
+    def finish(fd: int) -> None:
+        os.close(fd)
+        if os.path.getsize(tmp_path) != size:
+            raise IOError("size mismatch after download")
+        os.replace(tmp_path, dest)
+
+    async def fetch(fd: int, first: int, count: int) -> int:
+        written = 0
+        async for chunk in client.stream_media(message, limit=count, offset=first):
+            await loop.run_in_executor(writer, os.pwrite, fd, chunk, first * TG_CHUNK + written)
+            written += len(chunk)
+        return written
+
+    fd = None
+    try:
+        fd = await loop.run_in_executor(writer, preallocate)
+        tasks = [asyncio.ensure_future(fetch(fd, first, count)) for first, count in ranges]
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for (first, count), got in zip(ranges, results):
+            expected = min(count * TG_CHUNK, size - first * TG_CHUNK)
+            if got != expected:
+                raise IOError(f"range at chunk {first}: got {got} of {expected} bytes")
+        fd, owned = None, fd
+        await loop.run_in_executor(writer, finish, owned)
     except Exception as e:
-        logger.warning(f"Failed to leave VC/cancel task for {chat_id}: {e}")
+        if fd is not None:
+            await loop.run_in_executor(writer, os.close, fd)
+        writer.shutdown(wait=False)
+        logger.warning(f"Parallel download failed ({e}); retrying sequentially")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        path = await client.download_media(message, file_name=dest)
+        metrics.observe("download_seconds", time.perf_counter() - started, mode="sequential")
+        return path
+    writer.shutdown(wait=False)
+    elapsed = time.perf_counter() - started
+    metrics.observe("download_seconds", elapsed, mode="parallel")
+    metrics.inc("download_bytes_total", float(size))
+    logger.info(f"Downloaded {size / 1e6:.1f}MB in {len(ranges)} parts in {elapsed:.1f}s ({size / 1e6 / max(elapsed, 1e-6):.1f}MB/s)")
+    return dest
 
+@traced("media.prepare_reply")
 async def prepare_entry_from_reply(reply_msg: Message) -> Optional[Dict[str, Any]]:
     try:
         media_field = None
@@ -484,14 +3008,14 @@ async def prepare_entry_from_reply(reply_msg: Message) -> Optional[Dict[str, Any
                 ext = ".raw"
         base_name = f"audio_{int(time.time())}_{random.randint(1000,9999)}"
         download_path = os.path.join(DOWNLOADS_DIR, base_name + ext)
-        local_path = await user_app.download_media(reply_msg, file_name=download_path)
+        local_path = await parallel_download(user_app, reply_msg, media_field, download_path)
         title = getattr(media_field, "title", None) or getattr(media_field, "file_name", None) or reply_msg.caption or "Telegram Audio"
         duration = getattr(media_field, "duration", None) or None
         thumb_path = None
         if reply_msg.photo:
             tmp_img = os.path.join(THUMB_CACHE_DIR, f"photo_{base_name}.jpg")
             thumb_path_local = await user_app.download_media(reply_msg.photo, file_name=tmp_img)
-            thumb_path = await _process_image_and_overlay(thumb_path_local, base_name, title)
+            thumb_path = await _process_image_and_overlay(thumb_path_local, base_name, title, reply_msg.chat.id)
             try:
                 os.remove(thumb_path_local)
             except Exception:
@@ -503,20 +3027,101 @@ async def prepare_entry_from_reply(reply_msg: Message) -> Optional[Dict[str, Any
             "thumbnail": thumb_path,
             "duration": duration,
             "is_local": True,
+            "message": [reply_msg.chat.id, reply_msg.id],  # lets another replica download it again
         }
         return entry
     except Exception as e:
         logger.debug(f"prepare_entry_from_reply failed: {e}")
         return None
 
-async def play_entry(chat_id: int, entry: dict, reply_message: Optional[Message] = None):
+NOW_PLAYING_PLACEHOLDER = "https://files.catbox.moe/3o9qj5.jpg"
+
+async def _play_stage(timings: Dict[str, float], name: str, coro):
+    start = time.perf_counter()
+    try:
+        with span(f"play.{name}"):
+            return await coro
+    finally:
+        timings[name] = time.perf_counter() - start
+        metrics.observe("play_stage_seconds", timings[name], stage=name)
+
+async def _prepare_artwork(chat_id: int, entry: dict) -> Optional[str]:
+    thumb_val = entry.get("thumbnail")
+    if not thumb_val or not isinstance(thumb_val, str):
+        return None
+    if os.path.isfile(thumb_val):
+        return thumb_val
+    if thumb_val.startswith("http"):
+        return await get_thumb_from_url_or_webpage(thumb_val, entry.get("webpage"), entry.get("title") or "Unknown", chat_id)
+    return None
+
+async def _join_voice_chat(chat_id: int, stream_source: str, offset: float = 0.0) -> bool:
+    """Pick the assistant serving this chat (sticky) or the least-loaded one, make sure it is in the chat and start the stream."""
+    for attempt in range(2):
+        slot = assistant_pool.assign(chat_id)
+        present, invite_link = await ensure_assistant_in_chat(slot, chat_id)
+        if not present:
+            if invite_link:
+                # cannot auto-join assistant
+                await user_app.send_message(chat_id, "Assistant not in group. Add it via invite link and retry.")
+                await user_app.send_message(chat_id, invite_link)
+            else:
+                await user_app.send_message(chat_id, "Assistant not in this group. Please add the assistant account and try again.")
+            assistant_pool.release(chat_id)
+            return False
+        try:
+            await _play_on_slot(slot, chat_id, stream_source, offset)
+            return True
+        except Exception:
+            # retry once if the failure took this assistant out of rotation
+            if attempt or slot.healthy:
+                raise
+    return False
+
+async def _upgrade_now_playing(chat_id: int, msg_id: int, title: str, art_task: asyncio.Task, timings: Dict[str, float]):
+    try:
+        thumb_path = await art_task
+        if thumb_path and os.path.isfile(thumb_path):
+            media = InputMediaPhoto(thumb_path, caption=f"🎧 Now Playing: {title}")
+            await _play_stage(timings, "card_upgrade", user_app.edit_message_media(chat_id, msg_id, media, reply_markup=player_controls_markup(chat_id)))
+    except Exception as e:
+        logger.debug(f"Now-playing card upgrade failed for {chat_id}: {e}")
+    logger.debug(f"play_entry stages for {chat_id}: " + ", ".join(f"{k}={v * 1000:.0f}ms" for k, v in timings.items()))
+
+async def _discard_pending(art_task: Optional[asyncio.Task], announce_task: Optional[asyncio.Task]):
+    if art_task is not None:
+        art_task.cancel()
+    if announce_task is None:
+        return
+    try:
+        msg = await announce_task
+        await user_app.delete_messages(chat_id=msg.chat.id, message_ids=msg.id)
+    except Exception:
+        pass
+
+@timed("play_entry")
+@traced("play_entry")
+async def play_entry(chat_id: int, entry: dict, reply_message: Optional[Message] = None, offset: float = 0.0):
+    current_span().set(chat_id=chat_id, title=entry.get("title"), radio=bool(entry.get("is_radio")))
+    if not await resolve_entry(chat_id, entry):
+        logger.warning(f"Could not resolve stream for {entry.get('webpage')} in {chat_id}")
+        return False
+    # Stages run as a pipeline: artwork is rendered and the now-playing message goes out (with a placeholder
+    # image) while the assistant joins; the card replaces the placeholder once it is ready.
+    timings: Dict[str, float] = {}
+    started = time.perf_counter()
+    art_task = announce_task = None
     try:
-        if chat_id in radio_tasks:
-            radio_tasks[chat_id].cancel()
-            radio_tasks.pop(chat_id, None)
         stream_source = entry["stream_url"]
+        if station_relay is not None and entry.get("is_radio"):
+            # live stations go through the local relay so N chats share one upstream fetch
+            stream_source = station_relay.url_for(stream_source)
+        title = entry.get("title") or "Unknown"
+        art_task = asyncio.create_task(_play_stage(timings, "artwork", _prepare_artwork(chat_id, entry)))
+        await _play_stage(timings, "voice_init", ensure_voice())
         # play via call_py (either assistant or user account)
         if not call_py:
+            art_task.cancel()
             # fallback: just post the link
             try:
                 await user_app.send_message(chat_id, f"▶️ Now playing: {entry.get('title')}\n{stream_source}")
@@ -524,97 +3129,88 @@ async def play_entry(chat_id: int, entry: dict, reply_message: Optional[Message]
                 pass
             return True
 
-        # If the PyTgCalls instance is using assistant, ensure assistant is present in the chat.
-        if CALL_CLIENT is not None and CALL_CLIENT != user_app:
-            # CALL_CLIENT is assistant: make sure assistant is in chat
-            try:
-                assistant_user = await CALL_CLIENT.get_me()
-                assistant_id = assistant_user.id
-            except Exception:
-                assistant_id = None
-            assistant_present = False
-            if assistant_id:
-                try:
-                    await CALL_CLIENT.get_chat_member(chat_id, assistant_id)
-                    assistant_present = True
-                except Exception:
-                    assistant_present = False
-            if not assistant_present:
-                # try inviting assistant
-                try:
-                    invite = await user_app.create_chat_invite_link(chat_id, member_limit=1, name="dlk_assistant_invite")
-                    invite_link = invite.invite_link
-                    try:
-                        await CALL_CLIENT.join_chat(invite_link)
-                        assistant_present = True
-                    except Exception:
-                        # cannot auto-join assistant
-                        await user_app.send_message(chat_id, "Assistant not in group. Add it via invite link and retry.")
-                        await user_app.send_message(chat_id, invite_link)
-                        return False
-                except Exception:
-                    await user_app.send_message(chat_id, "Assistant not in this group. Please add the assistant account and try again.")
-                    return False
-
-        # Call play on the active PyTgCalls instance
-        await _safe_call_py_method("play", chat_id, MediaStream(stream_source))
-
-        thumb_path = None
-        thumb_val = entry.get("thumbnail")
-        title = entry.get("title") or "Unknown"
-        if thumb_val and isinstance(thumb_val, str) and os.path.isfile(thumb_val):
-            thumb_path = thumb_val
-        elif thumb_val and isinstance(thumb_val, str) and thumb_val.startswith("http"):
-            thumb_path = await get_thumb_from_url_or_webpage(thumb_val, entry.get("webpage"), title)
-        else:
-            thumb_path = None
-
-        if thumb_path and os.path.isfile(thumb_path):
-            try:
-                msg = await user_app.send_photo(chat_id, photo=thumb_path, caption=f"🎧 Now Playing: {title}", reply_markup=player_controls_markup(chat_id))
-            except Exception:
-                msg = await user_app.send_photo(chat_id, photo="https://files.catbox.moe/3o9qj5.jpg", caption=f"🎧 Now Playing: {title}", reply_markup=player_controls_markup(chat_id))
+        await reserve_call_slot(chat_id)
+        announce_task = asyncio.create_task(_play_stage(timings, "announce", user_app.send_photo(
+            chat_id, photo=NOW_PLAYING_PLACEHOLDER, caption=f"🎧 Now Playing: {title}", reply_markup=player_controls_markup(chat_id))))
+        if entry.get("is_radio") and station_relay is None:
+            # without the relay ffmpeg fetches the station itself, so a failed join counts against the station
+            join = station_breaker(stream_source).call(_join_voice_chat, chat_id, stream_source, offset)
         else:
-            msg = await user_app.send_photo(chat_id, photo="https://files.catbox.moe/3o9qj5.jpg", caption=f"🎧 Now Playing: {title}", reply_markup=player_controls_markup(chat_id))
+            join = _join_voice_chat(chat_id, stream_source, offset)
+        joined = await _play_stage(timings, "join", join)
+        if not joined:
+            await _discard_pending(art_task, announce_task)
+            current = sessions.get(chat_id)
+            discard_local_file(entry, keep=(current.entry or {}).get("stream_url") if current else None)
+            return False
+        metrics.observe("time_to_first_audio_seconds", time.perf_counter() - started)
+        msg = await announce_task
 
-        start_time = time.time()
-        store_play_state(chat_id, title, entry.get("stream_url"), msg.id, start_time, elapsed=0.0, paused=False)
-        radio_tasks[chat_id] = asyncio.create_task(update_radio_timer(chat_id, msg.id, title, start_time))
-        radio_paused.discard(chat_id)
+        session = sessions.open(chat_id)
+        start_play_record(session, entry)
+        session.begin(title, entry.get("stream_url"), msg.id, offset)
+        session.source, session.seekable, session.quality = stream_source, bool(entry.get("duration")), quality_controller.level
+        previous, session.entry = session.entry, {k: v for k, v in entry.items() if not k.startswith("_")}
+        discard_local_file(previous, keep=entry.get("stream_url"))
+        save_play_state(session)
+        # replaces (and cancels) the previous track's timer only now that the new one is playing
+        session.set_timer(asyncio.create_task(update_radio_timer(chat_id, msg.id, title, session.start_time)))
         duration = entry.get("duration")
-        if duration:
-            if chat_id in track_watchers:
-                try:
-                    track_watchers[chat_id].cancel()
-                except Exception:
-                    pass
-            track_watchers[chat_id] = asyncio.create_task(track_watcher(chat_id, duration, msg.id))
+        session.set_watcher(asyncio.create_task(track_watcher(chat_id, max(1, duration - int(offset)), msg.id)) if duration else None)
+        asyncio.create_task(_upgrade_now_playing(chat_id, msg.id, title, art_task, timings))
+        prefetch_next(chat_id)
+        await settle_call_slot(chat_id)
         return True
     except Exception as e:
-        logger.exception("Play entry failed")
-        try:
-            await leave_voice_chat(chat_id)
-        except Exception:
-            pass
+        trace_id = current_span().trace_id
+        logger.exception("Play entry failed" + (f" (trace {trace_id})" if trace_id else ""))
+        await _discard_pending(art_task, announce_task)
+        current = sessions.get(chat_id)
+        discard_local_file(entry, keep=(current.entry or {}).get("stream_url") if current else None)
         return False
+    finally:
+        # no-op once settle_call_slot() has consumed the reservation
+        await release_call_slot(chat_id)
+
+async def close_if_idle(chat_id: int) -> None:
+    """Tear the chat down after a failed play_entry unless an earlier track is still playing.
+
+    play_entry only drops what its own attempt set up; what happens to the session afterwards
+    (next queued track, or leaving) is up to the caller.
+    """
+    session = sessions.get(chat_id)
+    if session is not None and session.playing:
+        return
+    try:
+        await leave_voice_chat(chat_id)
+    except Exception:
+        pass
+
+async def play_next_in_queue(chat_id: int) -> Optional[dict]:
+    """Play queued entries until one starts; leaves the call if none does. Returns the entry now playing."""
+    session = sessions.get(chat_id)
+    while session is not None and session.queue:
+        entry = session.queue.popleft()
+        # each queued track gets its own trace rather than hanging off the previous play's
+        with new_trace("queue.advance", chat_id=chat_id):
+            if await play_entry(chat_id, entry):
+                return entry
+        session = sessions.get(chat_id)
+    try:
+        await leave_voice_chat(chat_id)
+    except Exception:
+        pass
+    return None
 
 async def track_watcher(chat_id: int, duration: int, msg_id: int):
     try:
         await asyncio.sleep(max(1, duration) + 2)
-        q = radio_queue.get(chat_id, [])
-        if q:
-            next_entry = q.pop(0)
-            radio_queue[chat_id] = q
-            await play_entry(chat_id, next_entry)
-        else:
-            try:
-                await leave_voice_chat(chat_id)
-            except Exception:
-                pass
-            try:
-                await user_app.edit_message_caption(chat_id=chat_id, message_id=msg_id, caption="▶️ Playback finished.", reply_markup=None)
-            except Exception:
-                pass
+        if await play_next_in_queue(chat_id):
+            return
+        try:
+            await user_app.edit_message_caption(chat_id=chat_id, message_id=msg_id, caption="▶️ Playback finished.", reply_markup=None)
+        except Exception:
+            pass
     except asyncio.CancelledError:
         return
     except Exception as e:
@@ -672,7 +3268,14 @@ async def user_help(client: Client, message: Message):
         "!react - Post control buttons to toggle Auto-React for this chat\n"
         "!setradio <url> - Save a radio URL for this chat\n"
         "!radio - List stations or use: !radio <station-name> to play\n"
-        "!play <query or URL> - Play YouTube or reply to audio to play local\n"
+        "!stations [tag | tags | find <name> | reload] - Browse or reload the station catalog\n"
+        "!play <query, URL or playlist> - Play YouTube or reply to audio to play local (--all <link> queues a video's playlist)\n"
+        "!search <terms> - Show the top results, then !play #<n>\n"
+        "!playall [N] - Queue a replied text file of links/queries, or the last N audio messages\n"
+        "!rule add <word|/regex/> <emoji>[:weight] ... - Keyword reactions for this chat (!rules to list)\n"
+        "!stalls - Show what has been blocking the event loop\n"
+        "!breakers - Show circuit breaker state for yt-dlp, stations, thumbnails and Mongo\n"
+        "!profile <seconds> - Profile the running bot and send the report to Saved Messages\n"
         "!help - Show this message\n"
     )
 
@@ -718,13 +3321,83 @@ async def user_react_onoff_cmd(client: Client, message: Message):
     val = m.group(1).lower()
     owner = OWNER_ID
     chat_id = message.chat.id
+    try:
+        set_react_setting(owner, chat_id, val == "on")
+    except SETTINGS_STORE_ERRORS as e:
+        logger.warning(f"Saving react setting for {chat_id} failed: {e}")
+        await message.reply_text("⏳ Settings store unavailable, try again shortly.")
+        return
     if val == "on":
-        set_react_setting(owner, chat_id, True)
         await message.reply_text("🟢 Auto React ENABLED for this chat.")
     else:
-        set_react_setting(owner, chat_id, False)
         await message.reply_text("🔴 Auto React DISABLED for this chat.")
 
+# keyword/regex -> emoji rules for this chat: !rule add <word|"some words"|/regex/> <emoji>[:weight] ...
+@user_app.on_message(filters.command(["rule", "rules"], prefixes=["!", "/"]) & filters.me)
+async def user_react_rules_cmd(client: Client, message: Message):
+    await ensure_owner_id()
+    owner = OWNER_ID
+    chat_id = message.chat.id
+    try:
+        args = shlex.split(message.text)[1:]
+    except ValueError:
+        args = message.text.split()[1:]
+    rules = list(get_react_rules(owner, chat_id))
+    action = args[0].lower() if args else "list"
+    if action == "add" and len(args) >= 3:
+        pattern = args[1]
+        is_regex = len(pattern) > 2 and pattern.startswith("/") and pattern.endswith("/")
+        if is_regex:
+            pattern = pattern[1:-1]
+            error = rule_regex_error(pattern)
+            if error:
+                await message.reply_text(error)
+                return
+        pool: Dict[str, float] = {}
+        for item in args[2:]:
+            emoji, _, weight = item.partition(":")
+            try:
+                pool[emoji] = float(weight) if weight else 1.0
+            except ValueError:
+                await message.reply_text(f"Bad weight in '{item}'. Use emoji or emoji:weight.")
+                return
+        unknown = [e for e in pool if e not in VALID_EMOJIS]
+        if unknown:
+            await message.reply_text(f"Not a supported reaction: {' '.join(unknown)}")
+            return
+        rules.append({"pattern": pattern, "regex": is_regex, "emojis": pool})
+        set_react_rules(owner, chat_id, rules)
+        await message.reply_text(f"Rule #{len(rules)} added.")
+        return
+    if action in ("del", "delete", "rm") and len(args) == 2 and args[1].isdigit():
+        idx = int(args[1]) - 1
+        if not 0 <= idx < len(rules):
+            await message.reply_text("No such rule.")
+            return
+        rules.pop(idx)
+        set_react_rules(owner, chat_id, rules)
+        await message.reply_text(f"Rule #{idx + 1} removed.")
+        return
+    if action == "clear":
+        set_react_rules(owner, chat_id, [])
+        await message.reply_text("All reaction rules removed for this chat.")
+        return
+    if action != "list":
+        await message.reply_text("Usage: !rule add <word|\"some words\"|/regex/> <emoji>[:weight] ... | !rule del <n> | !rule clear | !rules")
+        return
+    if not rules:
+        await message.reply_text("No reaction rules for this chat (random emojis are used).")
+        return
+    lines = ["Reaction rules (first match wins):"]
+    for i, rule in enumerate(rules[:STATION_LIST_LIMIT], 1):
+        pattern = f"/{rule['pattern']}/" if rule.get("regex") else rule["pattern"]
+        pool = rule.get("emojis") or {}
+        pool_text = " ".join(f"{e}:{w:g}" if w != 1 else e for e, w in (pool.items() if isinstance(pool, dict) else ((e, 1) for e in pool)))
+        lines.append(f"{i}. {pattern} → {pool_text}")
+    if len(rules) > STATION_LIST_LIMIT:
+        lines.append(f"... and {len(rules) - STATION_LIST_LIMIT} more.")
+    await message.reply_text("\n".join(lines))
+
 @user_app.on_callback_query(filters.regex(r"^react_(on|off)_[\d-]+_[\d-]+$"))
 async def user_handle_react_toggle(client: Client, cb: CallbackQuery):
     await ensure_owner_id()
@@ -741,7 +3414,12 @@ async def user_handle_react_toggle(client: Client, cb: CallbackQuery):
         await cb.answer("You are not allowed to change this.", show_alert=True)
         return
     enabled = state == "on"
-    set_react_setting(owner, chat_id, enabled)
+    try:
+        set_react_setting(owner, chat_id, enabled)
+    except SETTINGS_STORE_ERRORS as e:
+        logger.warning(f"Saving react setting for {chat_id} failed: {e}")
+        await cb.answer("⏳ Settings store unavailable, try again shortly.", show_alert=True)
+        return
     text = "🟢 Auto React ENABLED!" if enabled else "🔴 Auto React DISABLED!"
     try:
         await cb.message.edit_text(
@@ -844,29 +3522,146 @@ async def user_handle_close(client: Client, cb: CallbackQuery):
     except Exception:
         await cb.answer("Could not delete message.", show_alert=True)
 
+def _message_age(message: Message) -> float:
+    date = getattr(message, "date", None)
+    if date is None:
+        return 0.0
+    ts = date.timestamp() if hasattr(date, "timestamp") else float(date)
+    return max(0.0, time.time() - ts)
+
+def _allow_backlog_reaction(chat_id: int, message: Message) -> bool:
+    """Live messages always pass; stale ones only up to REACT_BACKLOG_PER_CHAT per chat."""
+    if not REACT_MAX_AGE or _message_age(message) <= REACT_MAX_AGE:
+        backlog_reactions.pop(chat_id, None)
+        return True
+    used = backlog_reactions.get(chat_id, 0)
+    if used >= REACT_BACKLOG_PER_CHAT:
+        return False
+    backlog_reactions[chat_id] = used + 1
+    backlog_reactions.move_to_end(chat_id)
+    if len(backlog_reactions) > REACT_DEDUP_SIZE:
+        backlog_reactions.popitem(last=False)
+    return True
+
+def _chat_type_name(chat) -> str:
+    ctype = getattr(chat, "type", None)
+    return str(getattr(ctype, "value", ctype) or "").lower()
+
+def _emoji_key(emoji: str) -> str:
+    return emoji.replace("\ufe0f", "")
+
+async def _fetch_allowed_reactions(chat_id: int) -> tuple:
+    chat = await user_app.get_chat(chat_id)
+    available = getattr(chat, "available_reactions", None)
+    if available is None:
+        return ()
+    if getattr(available, "all_are_enabled", False):
+        return tuple(VALID_EMOJIS)
+    # Telegram lists emoticons without the U+FE0F variation selector ("❤" for "❤️"), so compare without it
+    allowed = {_emoji_key(getattr(r, "emoji", None) or getattr(r, "emoticon", None) or "") for r in (getattr(available, "reactions", None) or [])}
+    return tuple(e for e in VALID_EMOJIS if _emoji_key(e) in allowed)
+
+async def get_allowed_reactions(chat) -> tuple:
+    """Emojis from VALID_EMOJIS the chat accepts, cached for REACTIONS_TTL (one fetch per chat at a time)."""
+    if _chat_type_name(chat) in ("private", "bot"):
+        return tuple(VALID_EMOJIS)
+    chat_id = chat.id
+    cached = allowed_reactions_cache.get(chat_id)
+    if cached and cached[0] > time.time():
+        metrics.inc("cache_requests_total", cache="reactions", result="hit")
+        return cached[1]
+    metrics.inc("cache_requests_total", cache="reactions", result="miss")
+    pending = _allowed_reactions_pending.get(chat_id)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    fut = asyncio.get_running_loop().create_future()
+    _allowed_reactions_pending[chat_id] = fut
+    emojis = None
+    try:
+        emojis = await _fetch_allowed_reactions(chat_id)
+        allowed_reactions_cache[chat_id] = (time.time() + REACTIONS_TTL, emojis)
+    except Exception as e:
+        # fall back to the full list but retry the lookup soon
+        logger.debug(f"get_chat for reactions failed in {chat_id}: {e}")
+        emojis = tuple(VALID_EMOJIS)
+        allowed_reactions_cache[chat_id] = (time.time() + 60, emojis)
+    finally:
+        _allowed_reactions_pending.pop(chat_id, None)
+        if emojis is None:
+            fut.cancel()
+        else:
+            fut.set_result(emojis)
+    return emojis
+
+def invalidate_allowed_reactions(chat_id: int) -> None:
+    allowed_reactions_cache.pop(chat_id, None)
+
+# drop cached reaction settings when Telegram reports a chat/channel change (runs on standbys too)
+@user_app.on_raw_update(group=-2)
+async def on_chat_changed(client: Client, update, users, chats):
+    if isinstance(update, raw.types.UpdateChannel):
+        invalidate_allowed_reactions(utils.get_channel_id(update.channel_id))
+    elif isinstance(update, raw.types.UpdateChat):
+        invalidate_allowed_reactions(-update.chat_id)
+
+# standby replicas stop every update here, before auto_react, commands and voice handlers
+@user_app.on_raw_update(group=-1)
+async def leader_gate(client: Client, update, users, chats):
+    if not leader_lease.holds():
+        raise StopPropagation
+
 # auto-react
 @user_app.on_message((filters.private | filters.group | filters.channel) & filters.incoming & ~filters.reply)
+@timed("auto_react")
 async def auto_react(client: Client, message: Message):
+    global react_flood_until
     if getattr(message, "edit_date", None):
         return
-    await ensure_owner_id()
     chat_id = message.chat.id
+    if (chat_id, message.id) in reacted_messages:
+        metrics.inc("reactions_skipped_total", reason="duplicate")
+        return
+    if time.time() < react_flood_until:
+        # still inside a FloodWait window: drop instead of queueing more doomed requests
+        metrics.inc("reactions_skipped_total", reason="floodwait")
+        return
+    await ensure_owner_id()
     owner = OWNER_ID
-    enabled = react_cache.get((owner, chat_id))
+    enabled = react_cache.get(owner, chat_id)
     if enabled is None:
+        metrics.inc("cache_requests_total", cache="react", result="miss")
         enabled = get_react_setting(owner, chat_id)
-        react_cache[(owner, chat_id)] = enabled
+        react_cache.set(owner, chat_id, enabled)
+    else:
+        metrics.inc("cache_requests_total", cache="react", result="hit")
     if not enabled:
         return
-    emoji = random.choice(VALID_EMOJIS)
+    emojis = await get_allowed_reactions(message.chat)
+    if not emojis:
+        metrics.inc("reactions_skipped_total", reason="not_allowed")
+        return
+    # spend the backlog budget only on messages that would actually get a reaction
+    if not _allow_backlog_reaction(chat_id, message):
+        metrics.inc("reactions_skipped_total", reason="stale")
+        return
+    if not reacted_messages.add((chat_id, message.id)):
+        return
+    emoji = None
+    compiled = get_compiled_rules(owner, chat_id)
+    text = message.text or message.caption
+    if compiled is not None and text:
+        emoji = compiled.choose(text, emojis)
+    emoji = emoji or random.choice(emojis)
     try:
         await message.react(emoji=emoji)
+        metrics.inc("reactions_total", result="ok")
         logger.info(f"Reacted {emoji} in chat {chat_id} (msg {message.id})")
     except ReactionInvalid:
-        pass
+        metrics.inc("reactions_total", result="invalid")
+        invalidate_allowed_reactions(chat_id)
     except FloodWait as e:
-        logger.warning(f"FloodWait: sleeping {e.value}s")
-        await asyncio.sleep(e.value)
+        logger.warning(f"FloodWait: pausing reactions for {e.value}s")
+        react_flood_until = max(react_flood_until, time.time() + float(e.value or 0))
     except PeerIdInvalid:
         logger.warning(f"PeerIdInvalid skipped: {chat_id}")
     except Exception:
@@ -895,94 +3690,172 @@ async def user_set_radio(client: Client, message: Message):
 
 # radio command: list stations or play by name: "!radio HiruFM"
 @user_app.on_message(filters.command("radio", prefixes=["!", "/"]) & (filters.group | filters.channel | filters.me))
+@traced("cmd.radio", root=True)
 async def cmd_radio_menu(_, message: Message):
     await ensure_owner_id()
     chat_id = message.chat.id
+    current_span().set(chat_id=chat_id)
     owner = OWNER_ID
     # If user supplied a station name or URL: play it directly
     parts = message.text.split(maxsplit=1)
     if len(parts) > 1:
         target = parts[1].strip()
-        # if user provided a known station name (case-insensitive)
-        found = None
-        for name in RADIO_STATION:
-            if name.lower() == target.lower():
-                found = (name, RADIO_STATION[name])
-                break
         # if provided a URL directly
         url = None
         title = None
-        if found:
-            title, url = found
-        elif target.startswith("http://") or target.startswith("https://"):
+        if target.startswith("http://") or target.startswith("https://"):
             url = target
             title = target
         else:
-            await message.reply_text("Station not found. Use `!radio` to list stations.")
+            # known station name: exact, prefix or fuzzy (typo-tolerant) match from the catalog
+            found = station_catalog.lookup(target)
+            if not found:
+                candidates = station_catalog.search(target, limit=5)
+                if candidates:
+                    names = "\n".join(f"- {c['name']}" for c in candidates)
+                    await message.reply_text(f"Which station did you mean?\n{names}\n\nUse `!radio <exact name>` to play one.")
+                else:
+                    await message.reply_text("Station not found. Use `!radio` to list stations.")
+                return
+            title, url = found["name"], found["url"]
+
+        breaker = station_breaker(url)
+        if breaker.state == "open" and breaker.retry_after() > 0:
+            await message.reply_text(f"📡 {title} is not responding, try again in {math.ceil(breaker.retry_after())}s.")
             return
 
         # Prepare entry and play
-        entry = {"title": title or "Radio", "stream_url": url, "webpage": None, "thumbnail": None, "duration": None, "is_local": False}
+        entry = {"title": title or "Radio", "stream_url": url, "webpage": None, "thumbnail": None, "duration": None, "is_local": False, "is_radio": True}
+        await ensure_voice()
         if not call_py:
             await message.reply_text(f"▶️ {title}\n{url}")
             return
-        # If CALL_CLIENT is assistant, ensure assistant is in chat, otherwise user_app will be used
-        if CALL_CLIENT is not None and CALL_CLIENT != user_app:
-            try:
-                assistant_user = await CALL_CLIENT.get_me()
-                assistant_id = assistant_user.id
-            except Exception:
-                assistant_id = None
-            assistant_present = False
-            if assistant_id:
-                try:
-                    await CALL_CLIENT.get_chat_member(chat_id, assistant_id)
-                    assistant_present = True
-                except Exception:
-                    assistant_present = False
-            if not assistant_present:
-                try:
-                    invite = await user_app.create_chat_invite_link(chat_id, member_limit=1, name="dlk_assistant_invite")
-                    invite_link = invite.invite_link
-                    try:
-                        await CALL_CLIENT.join_chat(invite_link)
-                        assistant_present = True
-                    except Exception:
-                        await message.reply_text("Assistant not in the group. Add it with the invite link and retry.")
-                        await message.reply_text(invite_link)
-                        return
-                except Exception:
-                    await message.reply_text("Assistant is not in this group. Please add the assistant account and try again.")
-                    return
+        # If the chat is served by an assistant, ensure it is in chat, otherwise user_app will be used
+        slot = assistant_pool.assign(chat_id)
+        present, invite_link = await ensure_assistant_in_chat(slot, chat_id)
+        if not present:
+            assistant_pool.release(chat_id)
+            if invite_link:
+                await message.reply_text("Assistant not in the group. Add it with the invite link and retry.")
+                await message.reply_text(invite_link)
+            else:
+                await message.reply_text("Assistant is not in this group. Please add the assistant account and try again.")
+            return
         ok = await play_entry(chat_id, entry, reply_message=message)
         if ok:
             await message.reply_text(f"▶️ Now playing: {entry['title']}")
         else:
+            await close_if_idle(chat_id)
             await message.reply_text("❌ Failed to play the requested station.")
         return
 
     # No arg: list available stations and usage
+    names = station_catalog.names()
     lines = ["📻 Radio Stations (use `!radio <name>` to play):"]
-    for name in RADIO_STATION:
+    for name in names[:STATION_LIST_LIMIT]:
         lines.append(f"- {name}")
+    if len(names) > STATION_LIST_LIMIT:
+        lines.append(f"... and {len(names) - STATION_LIST_LIMIT} more. Use `!stations <tag>` or `!stations find <name>`.")
     lines.append("\nOr set a per-chat radio URL with `!setradio <url>`.")
     await message.reply_text("\n".join(lines))
 
-# stations list command (shows station names & URLs)
+# stations list command (shows station names & URLs, by tag, fuzzy search or reload)
 @user_app.on_message(filters.command("stations", prefixes=["!", "/"]) & filters.me)
 async def cmd_stations(client: Client, message: Message):
-    lines = ["Available stations:"]
-    for name, url in RADIO_STATION.items():
-        lines.append(f"- {name}: {url}")
+    parts = message.text.split(maxsplit=2)
+    arg = parts[1].strip().lower() if len(parts) > 1 else ""
+    if arg == "reload":
+        count = station_catalog.reload()
+        await message.reply_text(f"Station catalog reloaded: {count} stations.")
+        return
+    if arg == "tags":
+        tags = station_catalog.tags()
+        await message.reply_text("Station tags:\n" + (", ".join(tags) if tags else "(none)"))
+        return
+    if arg == "find" and len(parts) > 2:
+        stations = station_catalog.search(parts[2], limit=10)
+        title = f"Stations matching '{parts[2]}':"
+    elif arg:
+        stations = station_catalog.by_tag(arg)
+        title = f"Stations tagged '{arg}':"
+    else:
+        stations = [station_catalog.stations[n] for n in station_catalog.names()]
+        title = "Available stations:"
+    lines = [title]
+    for st in stations[:STATION_LIST_LIMIT]:
+        tags = f" [{', '.join(st['tags'])}]" if st["tags"] else ""
+        lines.append(f"- {st['name']}{tags}: {st['url']}")
+    if len(stations) > STATION_LIST_LIMIT:
+        lines.append(f"... and {len(stations) - STATION_LIST_LIMIT} more.")
+    if len(lines) == 1:
+        lines.append("(none)")
+    await message.reply_text("\n".join(lines), disable_web_page_preview=True)
+
+# stalls command: rolling top-N of what blocked the event loop
+@user_app.on_message(filters.command("stalls", prefixes=["!", "/"]) & filters.me)
+async def cmd_stalls(client: Client, message: Message):
+    top = stall_detector.top()
+    if stall_detector.threshold <= 0:
+        await message.reply_text("Stall detector is disabled (set STALL_THRESHOLD).")
+        return
+    if not top:
+        await message.reply_text(f"No event loop stalls over {stall_detector.threshold}s recorded.")
+        return
+    lines = [f"Top event loop stalls (> {stall_detector.threshold}s):"]
+    for (handler, location), (count, total, worst) in top:
+        lines.append(f"- {handler} @ {location}: {int(count)}x, total {total:.1f}s, max {worst:.1f}s")
     await message.reply_text("\n".join(lines))
 
+# circuit breaker status for the external dependencies
+@user_app.on_message(filters.command("breakers", prefixes=["!", "/"]) & filters.me)
+async def cmd_breakers(client: Client, message: Message):
+    lines = ["Circuit breakers:"]
+    for b in sorted(breakers.values(), key=lambda b: b.name):
+        extra = f", retry in {math.ceil(b.retry_after())}s" if b.state == "open" else ""
+        lines.append(f"- {b.name}: {b.state}, {b.failures} consecutive failures, {b.inflight} in flight{extra}")
+    await message.reply_text("\n".join(lines))
+
+# profile command: sample the live process for N seconds and send the report to Saved Messages
+@user_app.on_message(filters.command("profile", prefixes=["!", "/"]) & filters.me)
+async def cmd_profile(client: Client, message: Message):
+    global _active_profile
+    parts = message.text.split()
+    try:
+        seconds = float(parts[1]) if len(parts) > 1 else 30.0
+    except ValueError:
+        return await message.reply_text("Usage: !profile <seconds> [nomem]")
+    seconds = max(1.0, min(seconds, PROFILE_MAX_SECONDS))
+    if _active_profile is not None:
+        return await message.reply_text("A profile is already running.")
+    profiler = SamplingProfiler(trace_memory="nomem" not in parts[2:])
+    _active_profile = profiler
+    try:
+        profiler.start()
+        await message.reply_text(f"Profiling for {seconds:.0f}s...")
+        await asyncio.sleep(seconds)
+        diffs = await asyncio.get_running_loop().run_in_executor(None, profiler.stop)
+        text = profiler.report(diffs)
+    finally:
+        profiler.stop()
+        _active_profile = None
+    doc = io.BytesIO(text.encode("utf-8"))
+    doc.name = f"profile_{time.strftime('%Y%m%d_%H%M%S')}.txt"
+    top = sorted(profiler.self_counts.items(), key=lambda kv: kv[1], reverse=True)[:3]
+    summary = ", ".join(f"{func} {100.0 * count / max(1, profiler.samples):.0f}%" for (func, _, _), count in top)
+    await client.send_document("me", doc, caption=f"Profile ({seconds:.0f}s): {summary}")
+    await message.reply_text("Profile sent to Saved Messages.")
+
 # play command: plays YouTube via call_py (assistant or user account) or local reply audio
 @user_app.on_message(filters.command("play", prefixes=["!", "/"]) & (filters.group | filters.channel))
+@timed("cmd_play")
+@traced("cmd.play", root=True)
 async def cmd_play(_, message: Message):
     chat_id = message.chat.id
+    current_span().set(chat_id=chat_id)
 
     entry = None
     info_msg = None
+    rest: List[dict] = []  # the rest of a playlist, queued once its first track plays
     if message.reply_to_message:
         entry = await prepare_entry_from_reply(message.reply_to_message)
         if entry:
@@ -994,28 +3867,71 @@ async def cmd_play(_, message: Message):
         elif message.reply_to_message and message.reply_to_message.text:
             query = message.reply_to_message.text
         if not query:
-            return await message.reply_text("Usage: /play <YouTube url or search terms> OR reply to an audio/voice file and use /play")
-        info_msg = await message.reply_text("🔎 Searching and preparing stream...")
-        info = extract_audio_url(query)
-        if info is None or not info.get("stream_url"):
+            return await message.reply_text("Usage: /play <YouTube url, playlist or search terms> OR reply to an audio/voice file and use /play\n"
+                                            "A video link with &list= plays just that video; /play --all <link> queues its playlist.")
+        # "/play --all <watch?v=..&list=..>" queues the whole playlist instead of just that video
+        flag, _, link = query.strip().partition(" ")
+        expand = flag.lower() in PLAYLIST_FLAGS and looks_like_url(link.strip())
+        if expand:
+            query = link.strip()
+        pick = re.fullmatch(r"#(\d+)", query.strip())
+        if pick:
+            # "/play #2" plays the 2nd result of the last /search in this chat
+            results = search_results.get(chat_id) or []
+            idx = int(pick.group(1)) - 1
+            if not 0 <= idx < len(results):
+                return await message.reply_text("No such search result. Use /search <terms> first.")
+            entry = dict(results[idx])
+            info_msg = await message.reply_text(f"🔎 Preparing {entry['title']}...")
+        elif looks_like_url(query):
+            info_msg = await message.reply_text("🔎 Reading link...")
             try:
-                await info_msg.edit_text("❌ Could not extract audio stream. Ensure yt-dlp is installed.")
-            except Exception:
-                pass
-            return
-        entry = {
-            "title": info.get("title"),
-            "stream_url": info.get("stream_url"),
-            "webpage": info.get("webpage_url"),
-            "thumbnail": info.get("thumbnail"),
-            "duration": info.get("duration"),
-            "is_local": False,
-        }
-    if chat_id not in radio_queue:
-        radio_queue[chat_id] = []
-    current_state = radio_state.get(chat_id)
-    if current_state and not current_state.get("paused"):
-        radio_queue[chat_id].append(entry)
+                result = await run_ytdlp(chat_id, extract_tracks, query, PLAYLIST_LIMIT, expand, quality_controller.source_profile())
+            except CircuitOpenError as e:
+                result, unavailable = None, e
+            else:
+                unavailable = None
+            entries = (result or {}).get("entries") or []
+            if not entries:
+                try:
+                    await info_msg.edit_text(f"⏳ Extraction {unavailable}" if unavailable else "❌ Could not extract audio stream. Ensure yt-dlp is installed.")
+                except Exception:
+                    pass
+                return
+            entry, rest = entries[0], entries[1:]
+            if rest:
+                session = sessions.get(chat_id)
+                if session is not None and session.playing:
+                    session.queue.extend(entries)
+                    session.touch()
+                    prefetch_next(chat_id)
+                    save_play_state(session)
+                    try:
+                        await info_msg.edit_text(f"➕ Queued {len(entries)} tracks from {result.get('title') or 'playlist'}")
+                    except Exception:
+                        pass
+                    return
+        else:
+            info_msg = await message.reply_text("🔎 Searching and preparing stream...")
+            try:
+                info = await run_ytdlp(chat_id, extract_audio_url, query, quality_controller.source_profile())
+            except CircuitOpenError as e:
+                info, unavailable = None, e
+            else:
+                unavailable = None
+            if info is None or not info.get("stream_url"):
+                try:
+                    await info_msg.edit_text(f"⏳ Extraction {unavailable}" if unavailable else "❌ Could not extract audio stream. Ensure yt-dlp is installed.")
+                except Exception:
+                    pass
+                return
+            entry = track_to_entry(info)
+    session = sessions.get(chat_id)
+    if session is not None and session.playing:
+        session.queue.append(entry)
+        session.touch()
+        prefetch_next(chat_id)
+        save_play_state(session)
         try:
             if info_msg:
                 await info_msg.edit_text(f"➕ Added to queue: {entry['title']}")
@@ -1025,42 +3941,224 @@ async def cmd_play(_, message: Message):
 
     ok = await play_entry(chat_id, entry, reply_message=message)
     if ok:
+        text = f"▶️ Now playing: {entry['title']}"
+        if rest:
+            session = sessions.open(chat_id)
+            session.queue.extend(rest)
+            prefetch_next(chat_id)
+            save_play_state(session)
+            text += f"\n➕ Queued {len(rest)} more tracks from {result.get('title') or 'playlist'}"
         try:
             if info_msg:
-                await info_msg.edit_text(f"▶️ Now playing: {entry['title']}")
+                await info_msg.edit_text(text)
         except Exception:
             pass
     else:
+        await close_if_idle(chat_id)
         try:
             if info_msg:
                 await info_msg.edit_text("❌ Failed to play the requested track.")
         except Exception:
             pass
 
+@user_app.on_message(filters.command("search", prefixes=["!", "/"]) & (filters.group | filters.channel))
+@traced("cmd.search", root=True)
+async def cmd_search(_, message: Message):
+    chat_id = message.chat.id
+    current_span().set(chat_id=chat_id)
+    if len(message.command) < 2:
+        return await message.reply_text("Usage: /search <terms>, then /play #<n> to play a result")
+    query = message.text.split(None, 1)[1]
+    info_msg = await message.reply_text("🔎 Searching...")
+    try:
+        result = await run_ytdlp(chat_id, extract_tracks, f"ytsearch{SEARCH_RESULTS}:{query}", SEARCH_RESULTS, False, quality_controller.source_profile())
+    except CircuitOpenError as e:
+        result, unavailable = None, e
+    else:
+        unavailable = None
+    entries = (result or {}).get("entries") or []
+    if not entries:
+        try:
+            await info_msg.edit_text(f"⏳ Search {unavailable}" if unavailable else "❌ No results.")
+        except Exception:
+            pass
+        return
+    search_results[chat_id] = entries
+    search_results.move_to_end(chat_id)
+    while len(search_results) > SEARCH_RESULTS_CHATS:
+        search_results.popitem(last=False)
+    lines = [f"🔎 Results for: {query}"]
+    for i, e in enumerate(entries, 1):
+        dur = f" [{e['duration'] // 60}:{e['duration'] % 60:02d}]" if e.get("duration") else ""
+        lines.append(f"{i}. {e['title']}{dur}")
+    lines.append("\nPlay one with /play #<n>")
+    try:
+        await info_msg.edit_text("\n".join(lines), disable_web_page_preview=True)
+    except Exception:
+        pass
+
+# bulk import: /playall (reply to a text file of URLs/queries) or /playall [N] (last N audio messages)
+def _is_audio_message(msg: Message) -> bool:
+    if msg.audio or msg.voice:
+        return True
+    return bool(msg.document and (msg.document.mime_type or "").startswith("audio/"))
+
+def _parse_playall_lines(text: str) -> List[str]:
+    """Non-empty, non-comment lines (so .m3u files work too), de-duplicated, capped at PLAYLIST_LIMIT."""
+    seen = set()
+    items: List[str] = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#") or line in seen:
+            continue
+        seen.add(line)
+        items.append(line)
+        if len(items) >= PLAYLIST_LIMIT:
+            break
+    return items
+
+def _playall_label(item: Any) -> str:
+    if isinstance(item, str):
+        return item
+    media = item.audio or item.voice or item.document
+    return getattr(media, "title", None) or getattr(media, "file_name", None) or f"message {item.id}"
+
+async def _resolve_playall_item(chat_id: int, item: Any) -> List[Dict[str, Any]]:
+    """A text line or an audio message -> lazy queue entries (a playlist URL can yield several).
+
+    Stream URLs expire and audio files take disk space, so nothing is resolved or downloaded here:
+    resolve_entry/prefetch_next do that when an entry reaches the head of the queue. Links are
+    still listed now, to expand playlists and report dead ones.
+    """
+    if isinstance(item, str):
+        if not looks_like_url(item):
+            return [{"title": item, "stream_url": None, "webpage": item, "thumbnail": None, "duration": None, "is_local": False, "lazy": True}]
+        result = await run_ytdlp(chat_id, extract_tracks, item, PLAYLIST_LIMIT, False, quality_controller.source_profile())
+        entries = (result or {}).get("entries") or []
+        for entry in entries:
+            if entry.get("stream_url"):
+                entry.update(stream_url=None, format=None, lazy=True)
+        return entries
+    media = item.audio or item.voice or item.document
+    return [{"title": _playall_label(item), "stream_url": None, "webpage": None, "thumbnail": None,
+             "duration": getattr(media, "duration", None) or None, "is_local": True, "lazy": True,
+             "message": [item.chat.id, item.id]}]
+
+async def resolve_many(chat_id: int, items: List[Any]) -> List[Optional[List[Dict[str, Any]]]]:
+    """Resolve items with at most PLAYALL_CONCURRENCY in flight, keeping their order.
+
+    Each result is a list of entries (empty if nothing playable was found) or None when the
+    extractor's circuit breaker was open.
+    """
+    sem = asyncio.Semaphore(PLAYALL_CONCURRENCY)
+
+    async def one(item):
+        async with sem:
+            try:
+                return await _resolve_playall_item(chat_id, item)
+            except CircuitOpenError:
+                return None
+            except Exception as e:
+                logger.debug(f"/playall could not resolve {item if isinstance(item, str) else item.id}: {e}")
+                return []
+    return await asyncio.gather(*(one(item) for item in items))
+
+@user_app.on_message(filters.command("playall", prefixes=["!", "/"]) & (filters.group | filters.channel))
+@timed("cmd_playall")
+@traced("cmd.playall", root=True)
+async def cmd_playall(_, message: Message):
+    chat_id = message.chat.id
+    current_span().set(chat_id=chat_id)
+    reply = message.reply_to_message
+    if reply and reply.document and not _is_audio_message(reply):
+        if (reply.document.file_size or 0) > PLAYALL_MAX_FILE:
+            return await message.reply_text(f"That file is too large for /playall (max {PLAYALL_MAX_FILE // 1024} KB).")
+        try:
+            data = await user_app.download_media(reply, in_memory=True)
+            text = bytes(data.getbuffer()).decode("utf-8", errors="replace")
+        except Exception as e:
+            logger.debug(f"/playall download failed in {chat_id}: {e}")
+            return await message.reply_text("❌ Could not read the replied file.")
+        items: List[Any] = _parse_playall_lines(text)
+        source = reply.document.file_name or "file"
+    else:
+        limit = PLAYALL_HISTORY
+        if len(message.command) > 1:
+            if not message.command[1].isdigit():
+                return await message.reply_text("Usage: reply to a text file of links/queries with /playall, or /playall [N] to queue the last N audio messages")
+            limit = int(message.command[1])
+        limit = max(1, min(limit, PLAYLIST_LIMIT))
+        items = []
+        async for msg in user_app.get_chat_history(chat_id, limit=limit * 10):
+            if _is_audio_message(msg):
+                items.append(msg)
+                if len(items) >= limit:
+                    break
+        items.reverse()  # oldest first, the order they were posted in
+        source = "recent audio messages"
+    if not items:
+        return await message.reply_text("Nothing to import. Reply to a text file of links/queries, or post some audio first.")
+
+    results = await resolve_many(chat_id, items)
+    entries = [e for group in results if group for e in group]
+    failed = [item for item, group in zip(items, results) if not group]
+    unavailable = sum(1 for group in results if group is None)
+
+    now_playing = None
+    session = sessions.get(chat_id)
+    if session is not None and session.playing:
+        session.queue.extend(entries)
+        session.touch()
+        prefetch_next(chat_id)
+        save_play_state(session)
+        queued = len(entries)
+    else:
+        # start the first entry that plays, then queue the rest behind it in one go
+        pending = deque(entries)
+        while pending:
+            entry = pending.popleft()
+            if await play_entry(chat_id, entry, reply_message=message):
+                now_playing = entry["title"]
+                break
+            failed.append(entry.get("webpage") or entry["title"])
+        if now_playing is None:
+            await close_if_idle(chat_id)
+        queued = len(pending)
+        if now_playing is not None and pending:
+            session = sessions.open(chat_id)
+            session.queue.extend(pending)
+            prefetch_next(chat_id)
+            save_play_state(session)
+
+    lines = [f"📥 Imported {len(items)} items from {source}: {queued} queued"]
+    if now_playing:
+        lines[0] += ", 1 playing"
+        lines.append(f"▶️ Now playing: {now_playing}")
+    if failed:
+        lines.append(f"⚠️ {len(failed)} could not be played" + (f" ({unavailable} skipped, extractor unavailable)" if unavailable else "") + ":")
+        for item in failed[:5]:
+            lines.append(f"- {_playall_label(item)[:80]}")
+        if len(failed) > 5:
+            lines.append(f"... and {len(failed) - 5} more")
+    await message.reply_text("\n".join(lines), disable_web_page_preview=True)
+
 # skip/stop/queue commands
 @user_app.on_message(filters.command(["skip", "s"], prefixes=["!", "/"]) & (filters.group | filters.channel))
 async def cmd_skip(_, message: Message):
     chat_id = message.chat.id
     if not await dlk_privilege_validator(message):
         return await message.reply_text("Only admins can skip tracks.")
-    q = radio_queue.get(chat_id, [])
-    if not q:
+    session = sessions.get(chat_id)
+    if session is None or not session.queue:
         await leave_voice_chat(chat_id)
         await message.reply_text("⛔ Skipped. No more tracks in queue.")
         return
-    next_entry = q.pop(0)
-    radio_queue[chat_id] = q
-    if chat_id in track_watchers:
-        try:
-            track_watchers[chat_id].cancel()
-        except Exception:
-            pass
-        track_watchers.pop(chat_id, None)
-    ok = await play_entry(chat_id, next_entry)
-    if ok:
+    session.set_watcher(None)
+    next_entry = await play_next_in_queue(chat_id)
+    if next_entry:
         await message.reply_text(f"⏭️ Now playing: {next_entry['title']}")
     else:
-        await message.reply_text(f"Failed to play next track: {next_entry.get('title')}")
+        await message.reply_text("⛔ None of the queued tracks could be played. Left the call.")
 
 @user_app.on_message(filters.command(["stop", "end"], prefixes=["!", "/"]) & (filters.group | filters.channel))
 async def general_stop_handler(_, message: Message):
@@ -1109,8 +4207,8 @@ async def cb_music_skip(_, query: CallbackQuery):
     if not await dlk_privilege_validator(query):
         return await query.answer("Only admins can skip tracks.", show_alert=True)
     chat_id = query.message.chat.id
-    q = radio_queue.get(chat_id, [])
-    if not q:
+    session = sessions.get(chat_id)
+    if session is None or not session.queue:
         await leave_voice_chat(chat_id)
         try:
             await query.message.edit_caption(caption="⛔ Skipped. No more tracks in queue.", reply_markup=None)
@@ -1118,38 +4216,27 @@ async def cb_music_skip(_, query: CallbackQuery):
             pass
         await query.answer("Skipped. No queue.", show_alert=True)
         return
-    next_entry = q.pop(0)
-    radio_queue[chat_id] = q
-    if chat_id in track_watchers:
-        try:
-            track_watchers[chat_id].cancel()
-        except Exception:
-            pass
-        track_watchers.pop(chat_id, None)
-    ok = await play_entry(chat_id, next_entry)
-    if ok:
+    session.set_watcher(None)
+    next_entry = await play_next_in_queue(chat_id)
+    if next_entry:
         await query.answer(f"⏭️ Now: {next_entry['title']}", show_alert=False)
     else:
-        await query.answer("Failed to skip to next track.", show_alert=True)
+        await query.answer("None of the queued tracks could be played.", show_alert=True)
 
 @user_app.on_callback_query(filters.regex("^radio_pause$"))
 async def radio_pause_cb(_, query: CallbackQuery):
     if not await dlk_privilege_validator(query):
         return await query.answer("Only admins can pause the radio!", show_alert=True)
     chat_id = query.message.chat.id
-    state = radio_state.get(chat_id)
-    if not state:
+    session = sessions.get(chat_id)
+    if session is None or not session.active:
         return await query.answer("Nothing is playing.", show_alert=True)
     try:
         await _safe_call_py_method("pause_stream", chat_id)
         await _safe_call_py_method("pause", chat_id)
-        start_time = state.get("start_time") or time.time()
-        elapsed = time.time() - start_time if start_time else state.get("elapsed", 0.0)
-        state["paused"] = True
-        state["elapsed"] = elapsed
-        state["start_time"] = None
-        radio_paused.add(chat_id)
-        store_play_state(chat_id, state.get("station"), state.get("url"), state.get("msg_id"), None, elapsed=elapsed, paused=True)
+        session.pause()
+        session.set_timer(None)
+        save_play_state(session)
         try:
             await query.message.edit_reply_markup(reply_markup=player_controls_markup(chat_id))
         except Exception:
@@ -1164,26 +4251,15 @@ async def radio_resume_cb(_, query: CallbackQuery):
     if not await dlk_privilege_validator(query):
         return await query.answer("Only admins can resume the bot!", show_alert=True)
     chat_id = query.message.chat.id
-    state = radio_state.get(chat_id)
-    if not state:
+    session = sessions.get(chat_id)
+    if session is None or not session.active:
         return await query.answer("Nothing to resume.", show_alert=True)
     try:
         await _safe_call_py_method("resume_stream", chat_id)
         await _safe_call_py_method("resume", chat_id)
-        elapsed = state.get("elapsed", 0.0) or 0.0
-        start_time = time.time() - elapsed
-        state["paused"] = False
-        state["elapsed"] = 0.0
-        state["start_time"] = start_time
-        radio_paused.discard(chat_id)
-        store_play_state(chat_id, state.get("station"), state.get("url"), state.get("msg_id"), start_time, elapsed=0.0, paused=False)
-        if chat_id in radio_tasks:
-            try:
-                radio_tasks[chat_id].cancel()
-            except Exception:
-                pass
-            radio_tasks.pop(chat_id, None)
-        radio_tasks[chat_id] = asyncio.create_task(update_radio_timer(chat_id, state.get("msg_id"), state.get("station"), start_time))
+        session.resume()
+        save_play_state(session)
+        session.set_timer(asyncio.create_task(update_radio_timer(chat_id, session.msg_id, session.title, session.start_time)))
         try:
             await query.message.edit_reply_markup(reply_markup=player_controls_markup(chat_id))
         except Exception:
@@ -1210,47 +4286,205 @@ async def cb_radio_stop(_, query: CallbackQuery):
         await query.answer("Failed to stop bot.", show_alert=True)
 
 # ===================== START/STOP helpers =====================
-async def start_all():
+startup_timings: Dict[str, float] = {}
+
+async def _on_promoted():
+    """Standby -> leader: refresh settings and pick up the calls the previous leader was serving."""
+    loop = asyncio.get_running_loop()
+    # radio URLs are cached on use and a standby never refreshes them; the old leader may have changed them
+    radio_cache.clear()
+    if OWNER_ID is not None:
+        await loop.run_in_executor(None, load_caches_for_owner, OWNER_ID)
+    if playing_coll is None:
+        return
+    try:
+        # calls that went quiet hours ago are not worth rejoining
+        since = time.time() - 6 * 3600
+        docs = await loop.run_in_executor(None, lambda: list(playing_coll.find({"paused": False, "ts": {"$gt": since}})))
+    except Exception as e:
+        logger.warning(f"Could not read play state for takeover: {e}")
+        return
+    for doc in docs:
+        chat_id = doc.get("chat_id")
+        if chat_id is None or chat_id in sessions or not (doc.get("entry") or doc.get("queue")):
+            continue
+        logger.info(f"Taking over playback in {chat_id}")
+        asyncio.create_task(_take_over_chat(chat_id, doc))
+
+async def _take_over_chat(chat_id: int, doc: dict) -> None:
+    """Resume a stored session: the current track from where it was (tracks are re-resolved from their
+    page or message, see portable_entry), then its queue. Entries only the old host could play were
+    left out when the state was stored."""
+    entry, queue = doc.get("entry"), [e for e in doc.get("queue") or [] if e]
+    offset = 0.0
+    if entry is not None and entry.get("duration"):
+        await ensure_voice()
+        started = doc.get("start_time")
+        position = time.time() - started if started and not doc.get("paused") else doc.get("elapsed") or 0.0
+        offset = max(0.0, position) if can_seek() else 0.0
+        if position >= entry["duration"] - 1:
+            entry = None  # it ended while nobody was leading; go on with the queue
+    if queue:
+        sessions.open(chat_id).queue.extend(queue)
+    if entry is None or not await play_entry(chat_id, entry, offset=offset):
+        await play_next_in_queue(chat_id)  # leaves the chat if nothing in the queue plays either
+
+async def _on_demoted(lost: bool):
+    # another replica owns the lease now: drop our calls but keep their stored state for it. When the
+    # lease was lost that replica may already be streaming to these chats on the same account, and
+    # leave_call would end its call, so only the local state goes.
+    for session in sessions:
+        await leave_voice_chat(session.chat_id, forget=False, leave=not lost)
+
+async def standby_cache_refresh_loop():
+    while True:
+        await asyncio.sleep(LEASE_CACHE_REFRESH)
+        if not leader_lease.holds() and OWNER_ID is not None:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, load_caches_for_owner, OWNER_ID)
+            except Exception as e:
+                logger.debug(f"Standby cache refresh failed: {e}")
+
+async def start_leader_election():
+    if not LEADER_ELECTION:
+        return
+    if db is None:
+        logger.warning("LEADER_ELECTION needs MongoDB; running as the only leader.")
+        leader_lease.is_leader, leader_lease.expires_at = True, math.inf
+        return
+    # own client with timeouts well inside the TTL: a renewal stuck on a dead server must fail long
+    # before the lease could pass to a standby (the expiry timer demotes us in any case)
+    from pymongo import MongoClient
+    timeout_ms = int(leader_lease.renew_interval * 1000)
+    lease_client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=timeout_ms, connectTimeoutMS=timeout_ms, socketTimeoutMS=timeout_ms)
+    leader_lease.collection = lease_client.get_database(MONGO_DBNAME).get_collection("leases")
+    leader_lease.on_promote.append(_on_promoted)
+    leader_lease.on_demote.append(_on_demoted)
+    metrics.set("is_leader", 0.0)
+    try:
+        await ensure_owner_id()
+    except Exception:
+        pass
+    asyncio.create_task(leader_lease.run())
+    asyncio.create_task(standby_cache_refresh_loop())
+
+async def _timed_phase(name: str, coro):
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        startup_timings[name] = time.perf_counter() - start
+
+async def _start_user_app(ready: asyncio.Event):
     await user_app.start()
-    if not SESSION_STRING:
+    ready.set()
+    if PERSIST_SESSIONS:
+        asyncio.create_task(session_flush_loop())
+    if not SESSION_STRING and not PERSIST_SESSIONS:
         try:
             session_str = await user_app.export_session_string()
             logger.info("New session string generated. Please save it for future runs.")
             logger.info(session_str)
         except Exception:
             pass
-    if assistant:
-        await assistant.start()
-    if call_py:
-        try:
-            call_py.start()
-        except Exception:
-            logger.exception("Failed to start PyTgCalls")
     await ensure_owner_id()
     me = await user_app.get_me()
-    logger.info(f"Userbot started as @{me.username or me.first_name} ({me.id})")
-    if assistant:
+    logger.info(f"Userbot started as @{me.username or me.first_name} ({me.id}), {time.perf_counter() - _IMPORT_STARTED:.2f}s after launch")
+
+async def _start_assistant(client: Client):
+    try:
+        await client.start()
+    except Exception:
+        logger.exception(f"Failed to start assistant {client.name}")
+
+async def _start_voice(user_ready: asyncio.Event):
+    # assistants connect while pytgcalls is being imported
+    await asyncio.gather(_timed_phase("voice_import", ensure_voice()), *(_start_assistant(c) for c in assistants))
+    for slot in assistant_pool.slots:
+        if slot.is_user_app:
+            await user_ready.wait()
+        try:
+            result = slot.call.start()
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            logger.exception(f"Failed to start PyTgCalls for assistant #{slot.index}")
+            assistant_pool.mark_failed(slot)
+    for slot in assistant_pool.slots:
+        if slot.is_user_app:
+            continue
         try:
-            a = await assistant.get_me()
-            logger.info(f"Assistant started as @{a.username} ({a.id})")
+            a = await slot.client.get_me()
+            slot.user_id = a.id
+            logger.info(f"Assistant #{slot.index} started as @{a.username} ({a.id})")
         except Exception:
-            logger.info("Assistant started (username unknown).")
-    if CALL_CLIENT is user_app:
+            logger.info(f"Assistant #{slot.index} started (username unknown).")
+    if len(assistant_pool.slots) > 1:
+        asyncio.create_task(assistant_health_loop())
+    if IDLE_GRACE > 0:
+        asyncio.create_task(idle_reaper_loop())
+    if ADAPTIVE_QUALITY:
+        asyncio.create_task(quality_controller_loop())
+    if CALL_CLIENT is user_app and call_py:
         logger.info("Using userbot account for voice (PyTgCalls attached to user_app).")
 
+async def start_all():
+    startup_timings["import"] = time.perf_counter() - _IMPORT_STARTED
+    stall_detector.start()
+    await start_metrics_server()
+    if TRACE_FILE:
+        asyncio.create_task(trace_exporter.run())
+        logger.info(f"Tracing enabled, spans appended to {TRACE_FILE}")
+    if station_relay is not None:
+        await station_relay.start()
+    user_ready = asyncio.Event()
+    # user_app, the assistants/voice stack and MongoDB come up concurrently
+    results = await asyncio.gather(
+        _timed_phase("user_app", _start_user_app(user_ready)),
+        _timed_phase("voice", _start_voice(user_ready)),
+        _timed_phase("db", ensure_db()),
+        return_exceptions=True,
+    )
+    for name, result in zip(("user_app", "voice", "db"), results):
+        if isinstance(result, BaseException):
+            logger.error(f"Startup phase {name} failed: {result!r}")
+    if isinstance(results[0], BaseException):
+        raise results[0]
+    await start_leader_election()
+    startup_timings["total"] = time.perf_counter() - _IMPORT_STARTED
+    logger.info("Startup timings: " + ", ".join(f"{k}={v:.2f}s" for k, v in startup_timings.items()))
+    for name, value in startup_timings.items():
+        metrics.set("startup_phase_seconds", value, phase=name)
+
 async def stop_all():
+    # hand the lease over right away instead of letting the standby wait for it to expire
+    if LEADER_ELECTION and leader_lease.collection is not None:
+        await leader_lease.step_down()
+    for slot in assistant_pool.slots:
+        try:
+            result = slot.call.stop()
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            pass
+    for client in assistants:
+        try:
+            await client.stop()
+        except Exception:
+            pass
     try:
-        if call_py:
-            call_py.stop()
-    except Exception:
-        pass
-    try:
-        if assistant:
-            await assistant.stop()
+        await user_app.stop()
     except Exception:
         pass
+    if station_relay is not None:
+        try:
+            await station_relay.stop()
+        except Exception:
+            pass
+    shard_router.shutdown()
+    stall_detector.stop()
     try:
-        await user_app.stop()
+        trace_exporter.flush()
     except Exception:
         pass
 
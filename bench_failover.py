@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Failover check for LEADER_ELECTION: runs several LeaderLease replicas in one process
+against a lease store, repeatedly cuts the current leader off from the store (or stops
+it gracefully) and measures how long the standbys take to elect a new one. A cut-off
+leader keeps running, as a real partitioned replica would, so the check that two
+replicas never act as leader (LeaderLease.holds()) at the same time covers it too.
+
+The store is an in-memory stand-in with Mongo's semantics for the lease operations
+(conditional upsert + unique _id), or a real server with --mongo mongodb://localhost:27017.
+
+Usage: python bench_failover.py [--replicas 3] [--ttl 3] [--rounds 4] [--mongo URI]
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import threading
+from typing import Any, Dict, List, Optional
+
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ["MONGO_URI"] = ""
+
+import app  # noqa: E402
+
+
+class DuplicateKeyError(Exception):
+    code = 11000
+
+
+class MemoryLeaseCollection:
+    """Just enough of a pymongo collection for LeaderLease, with the same conflict behaviour."""
+
+    def __init__(self):
+        self.docs: Dict[Any, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _matches(doc: Dict[str, Any], flt: Dict[str, Any]) -> bool:
+        for field, cond in flt.items():
+            if field == "$or":
+                if not any(MemoryLeaseCollection._matches(doc, sub) for sub in cond):
+                    return False
+            elif isinstance(cond, dict):
+                if "$lt" in cond and not (field in doc and doc[field] < cond["$lt"]):
+                    return False
+            elif doc.get(field) != cond:
+                return False
+        return True
+
+    def update_one(self, flt: Dict[str, Any], update: Dict[str, Any], upsert: bool = False):
+        with self._lock:
+            doc = self.docs.get(flt["_id"])
+            if doc is not None and self._matches(doc, flt):
+                doc.update(update["$set"])
+                return
+            if not upsert:
+                return
+            if doc is not None:
+                raise DuplicateKeyError("E11000 duplicate key error")
+            self.docs[flt["_id"]] = dict(update["$set"], _id=flt["_id"])
+
+    def delete_one(self, flt: Dict[str, Any]):
+        with self._lock:
+            doc = self.docs.get(flt["_id"])
+            if doc is not None and self._matches(doc, flt):
+                del self.docs[flt["_id"]]
+
+    def find_one(self, flt: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            doc = self.docs.get(flt["_id"])
+            return dict(doc) if doc is not None else None
+
+
+class PartitionedCollection:
+    """A leader's view of the store after a network partition: every call hangs, then times out."""
+
+    def __init__(self, hang: float):
+        self.hang = hang
+
+    def _fail(self, *args, **kwargs):
+        time.sleep(self.hang)
+        raise ConnectionError("lease store unreachable")
+
+    update_one = delete_one = find_one = _fail
+
+
+def make_collection(mongo_uri: Optional[str]):
+    if not mongo_uri:
+        return MemoryLeaseCollection()
+    from pymongo import MongoClient
+    coll = MongoClient(mongo_uri).get_database("dlk_failover_bench").get_collection("leases")
+    coll.delete_many({})
+    return coll
+
+
+async def wait_for_leader(replicas: List["app.LeaderLease"], exclude: Optional["app.LeaderLease"], timeout: float) -> Optional["app.LeaderLease"]:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        leaders = [r for r in replicas if r.holds() and r is not exclude]
+        if leaders:
+            return leaders[0]
+        await asyncio.sleep(0.01)
+    return None
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--ttl", type=float, default=3.0)
+    parser.add_argument("--rounds", type=int, default=4)
+    parser.add_argument("--mongo", help="use a real MongoDB instead of the in-memory stand-in")
+    args = parser.parse_args()
+
+    coll = make_collection(args.mongo)
+    replicas: List[app.LeaderLease] = []
+    tasks: Dict[int, asyncio.Task] = {}
+    overlaps = 0
+    spawned = 0
+    stop = asyncio.Event()
+
+    def spawn() -> app.LeaderLease:
+        nonlocal spawned
+        lease = app.LeaderLease("leader:bench", f"replica-{spawned}", ttl=args.ttl, collection=coll)
+        spawned += 1
+        replicas.append(lease)
+        tasks[id(lease)] = asyncio.create_task(lease.run())
+        return lease
+
+    async def watch_overlap():
+        nonlocal overlaps
+        while not stop.is_set():
+            if sum(1 for r in replicas if r.holds()) > 1:
+                overlaps += 1
+            await asyncio.sleep(0.005)
+
+    for _ in range(args.replicas):
+        spawn()
+    watcher = asyncio.create_task(watch_overlap())
+    leader = await wait_for_leader(replicas, None, args.ttl * 3)
+    print(f"initial leader: {leader.instance_id if leader else None}")
+
+    print(f"{'round':>5} {'mode':>9} {'old':>11} {'new':>11} {'takeover_s':>11} {'old_down_s':>11}")
+    for rnd in range(args.rounds):
+        graceful = rnd % 2 == 1
+        old = leader
+        start = time.perf_counter()
+        demoted_at: List[float] = []
+        old.on_demote.append(lambda lost: demoted_at.append(time.perf_counter()))
+        if graceful:
+            await old.step_down()
+        else:
+            # partition: the old leader keeps running, but its renewals hang until the client times out
+            old.collection = PartitionedCollection(old.renew_interval)
+        leader = await wait_for_leader(replicas, old, args.ttl * 3)
+        took = time.perf_counter() - start
+        while old.is_leader and time.perf_counter() - start < args.ttl * 3:
+            await asyncio.sleep(0.01)
+        down = (demoted_at[0] - start) if demoted_at else float("nan")
+        tasks.pop(id(old)).cancel()
+        replicas.remove(old)
+        print(f"{rnd + 1:>5} {'graceful' if graceful else 'partition':>9} {old.instance_id:>11} "
+              f"{leader.instance_id if leader else '-':>11} {took:>11.2f} {down:>11.2f}")
+        spawn()  # keep the replica count constant
+
+    stop.set()
+    await watcher
+    for t in tasks.values():
+        t.cancel()
+    print(f"overlapping leaders observed: {overlaps}")
+    print(f"expected worst case: partition <= ttl + ttl/3 = {args.ttl * 4 / 3:.2f}s, graceful <= ttl/3 = {args.ttl / 3:.2f}s; "
+          f"a partitioned leader steps down <= ttl - margin after its last renewal")
+    app.shard_router.shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
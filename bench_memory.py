@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark for the settings caches at 10k / 100k / 1M chats.
+
+Compares the old layout (plain dicts keyed by (owner_id, chat_id) holding every
+settings document) with the current one (ChatIdSet of chats with reactions off,
+rules only where set, radio URLs in a bounded LRU filled on use). Reports the
+memory held after load_caches_for_owner, load time and react lookup cost.
+
+Settings documents are generated on the fly by an in-memory stand-in for the
+react_settings collection; nothing connects to MongoDB or Telegram.
+
+Usage: python bench_memory.py [--chats 10000,100000,1000000] [--off 0.05] [--radio 0.2] [--rules 0.005]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+from typing import Any, Dict, Iterator
+
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ["MONGO_URI"] = ""
+
+import app  # noqa: E402
+
+OWNER = 1000
+
+
+class SettingsStandIn:
+    """Generates settings docs deterministically; find() applies the filters load_caches_for_owner uses."""
+
+    def __init__(self, chats: int, off: float, radio: float, rules: float, seed: int = 0):
+        self.chats, self.off, self.radio, self.rules, self.seed = chats, off, radio, rules, seed
+
+    def _docs(self) -> Iterator[Dict[str, Any]]:
+        rng = random.Random(self.seed)
+        for i in range(self.chats):
+            doc: Dict[str, Any] = {"owner_id": OWNER, "chat_id": -1001000000000 - i, "react": rng.random() >= self.off}
+            if rng.random() < self.radio:
+                doc["radio_url"] = f"https://stream.example/{i}.mp3"
+            if rng.random() < self.rules:
+                doc["react_rules"] = [{"pattern": "hello", "regex": False, "emojis": {"👍": 1}}]
+            yield doc
+
+    def find(self, flt: Dict[str, Any], projection: Any = None) -> Iterator[Dict[str, Any]]:
+        selective = "$or" in flt
+        for doc in self._docs():
+            if selective and doc["react"] is not False and not doc.get("react_rules"):
+                continue
+            yield doc
+
+
+def load_legacy(coll: SettingsStandIn) -> tuple:
+    react: Dict[tuple, bool] = {}
+    radio: Dict[tuple, str] = {}
+    rules: Dict[tuple, Any] = {}
+    for doc in coll.find({"owner_id": OWNER}):
+        key = (doc["owner_id"], doc["chat_id"])
+        react[key] = bool(doc.get("react", True))
+        if "radio_url" in doc:
+            radio[key] = doc["radio_url"]
+        if isinstance(doc.get("react_rules"), list):
+            rules[key] = doc["react_rules"]
+    return react, radio, rules
+
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, current
+
+
+def lookup_cost(get, chats: int, n: int = 200000) -> float:
+    rng = random.Random(1)
+    ids = [-1001000000000 - rng.randrange(chats) for _ in range(n)]
+    start = time.perf_counter()
+    for chat_id in ids:
+        get(chat_id)
+    return (time.perf_counter() - start) / n * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", default="10000,100000,1000000")
+    parser.add_argument("--off", type=float, default=0.05, help="share of chats with reactions off")
+    parser.add_argument("--radio", type=float, default=0.2, help="share of chats with a saved radio URL")
+    parser.add_argument("--rules", type=float, default=0.005, help="share of chats with reaction rules")
+    args = parser.parse_args()
+
+    print(f"{'chats':>9} {'layout':>8} {'memory_MB':>10} {'load_s':>8} {'lookup_ns':>10}")
+    for chats in [int(c) for c in args.chats.split(",") if c.strip()]:
+        coll = SettingsStandIn(chats, args.off, args.radio, args.rules)
+
+        (react, radio, rules), elapsed, mem = measure(lambda: load_legacy(coll))
+        ns = lookup_cost(lambda c: react.get((OWNER, c)), chats)
+        print(f"{chats:>9} {'legacy':>8} {mem / 1e6:>10.1f} {elapsed:>8.2f} {ns:>10.0f}")
+        del react, radio, rules
+
+        app.settings_coll = coll
+        app.react_cache.clear()
+        app.radio_cache.clear()
+        app.react_rules_cache.clear()
+        app.settings_loaded.discard(OWNER)
+        _, elapsed, mem = measure(lambda: app.load_caches_for_owner(OWNER))
+        ns = lookup_cost(lambda c: app.react_cache.get(OWNER, c), chats)
+        print(f"{chats:>9} {'compact':>8} {mem / 1e6:>10.1f} {elapsed:>8.2f} {ns:>10.0f}"
+              f"   (off={len(app.react_cache)}, rules={len(app.react_rules_cache)}, radio LRU max {app.RADIO_CACHE_SIZE})")
+    app.shard_router.shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
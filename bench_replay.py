@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Offline replay benchmark for the userbot handlers.
+
+Replaces user_app, the assistant pool and call_py with in-process fakes that add
+simulated RPC latency and random FloodWaits, then replays a synthetic (or recorded)
+update stream through auto_react, cmd_play / play_entry and update_radio_timer.
+Reports throughput, p50/p99 latency and RPC counts for each chat count.
+
+Usage:
+  python bench_replay.py --chats 10,100,1000 --messages 2000 --plays 50
+  python bench_replay.py --replay updates.jsonl     # lines: {"kind": "message"|"play", "chat_id": .., "text": ..}
+  python bench_replay.py --record updates.jsonl     # write the synthetic stream for later replays
+  TRACE_FILE=traces.jsonl python bench_replay.py    # also export play pipeline spans
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import logging
+from datetime import datetime
+from collections import Counter
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ["MONGO_URI"] = ""
+os.environ["METRICS_PORT"] = "0"
+os.environ["STALL_THRESHOLD"] = "0"
+
+import app  # noqa: E402
+from pyrogram.errors import FloodWait  # noqa: E402
+
+
+class FakeRPC:
+    """Shared latency / FloodWait model and RPC accounting for all fakes."""
+
+    def __init__(self, latency: float, jitter: float, flood_rate: float, flood_seconds: float, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.calls: Counter = Counter()
+        self.floods: Counter = Counter()
+        self.rng = random.Random(seed)
+
+    async def __call__(self, method: str):
+        self.calls[method] += 1
+        await asyncio.sleep(max(0.0, self.rng.gauss(self.latency, self.jitter)))
+        if self.flood_rate and self.rng.random() < self.flood_rate:
+            self.floods[method] += 1
+            raise FloodWait(value=self.flood_seconds)
+
+    def reset(self):
+        self.calls.clear()
+        self.floods.clear()
+
+
+class FakeMessage:
+    _ids = 0
+
+    def __init__(self, client: "FakeClient", chat_id: int, text: str = "", outgoing: bool = False):
+        FakeMessage._ids += 1
+        self.id = FakeMessage._ids
+        self.message_id = self.id
+        self._client = client
+        self.chat = SimpleNamespace(id=chat_id, type="supergroup", title=f"chat {chat_id}")
+        self.from_user = SimpleNamespace(id=app.OWNER_ID if outgoing else 42, username="bench", first_name="bench")
+        self.sender_chat = None
+        self.text = text
+        self.caption = None
+        self.edit_date = None
+        self.reply_to_message = None
+        self.date = datetime.now()
+        self.command = text.lstrip("!/").split() if text[:1] in ("!", "/") else []
+        self.voice = self.audio = self.document = self.photo = None
+
+    async def react(self, emoji: str = ""):
+        await self._client.rpc("SendReaction")
+
+    async def reply_text(self, text: str, **kwargs):
+        return await self._client.send_message(self.chat.id, text)
+
+    async def edit_text(self, text: str, **kwargs):
+        await self._client.rpc("EditMessage")
+        return self
+
+
+class FakeClient:
+    name = "fake"
+
+    def __init__(self, rpc: FakeRPC, user_id: int):
+        self.rpc = rpc
+        self.user_id = user_id
+
+    async def get_me(self):
+        await self.rpc("GetFullUser")
+        return SimpleNamespace(id=self.user_id, username="bench", first_name="bench")
+
+    async def get_chat_member(self, chat_id: int, user_id: int):
+        await self.rpc("GetParticipant")
+        return SimpleNamespace(status="member")
+
+    async def get_chat(self, chat_id: int):
+        await self.rpc("GetFullChannel")
+        return SimpleNamespace(id=chat_id, available_reactions=SimpleNamespace(all_are_enabled=True, reactions=None))
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        await self.rpc("SendMessage")
+        return FakeMessage(self, chat_id, text, outgoing=True)
+
+    async def send_photo(self, chat_id: int, photo: Any = None, caption: str = "", **kwargs):
+        await self.rpc("SendMedia")
+        return FakeMessage(self, chat_id, caption or "", outgoing=True)
+
+    async def edit_message_caption(self, chat_id: int, message_id: int, caption: str = "", **kwargs):
+        await self.rpc("EditMessage")
+
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str = "", **kwargs):
+        await self.rpc("EditMessage")
+
+    async def edit_message_media(self, chat_id: int, message_id: int, media: Any = None, **kwargs):
+        await self.rpc("EditMessageMedia")
+
+    async def delete_messages(self, chat_id: int, message_ids: Any = None, **kwargs):
+        await self.rpc("DeleteMessages")
+
+
+class FakeCall:
+    def __init__(self, rpc: FakeRPC):
+        self.rpc = rpc
+        self.active: set = set()
+
+    async def play(self, chat_id: int, stream: Any = None, **kwargs):
+        await self.rpc("JoinGroupCall")
+        self.active.add(chat_id)
+
+    async def leave_call(self, chat_id: int):
+        await self.rpc("LeaveGroupCall")
+        self.active.discard(chat_id)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def install_fakes(rpc: FakeRPC) -> FakeClient:
+    fake_user = FakeClient(rpc, user_id=1)
+    fake_call = FakeCall(rpc)
+    app.OWNER_ID = 1
+    app._import_pytgcalls = lambda: None
+    app.init_voice = lambda: None
+    app.user_app = fake_user
+    app.call_py = fake_call
+    app.CALL_CLIENT = fake_user
+    app.MediaStream = lambda source, *a, **k: source
+    app.assistant_pool = app.AssistantPool()
+    app.assistant_pool.add(fake_user, fake_call)
+
+    def fake_extract(query: str, profile: str = app.AUDIO_PROFILE) -> Optional[Dict[str, Any]]:
+        time.sleep(max(0.0, rpc.rng.gauss(rpc.latency * 5, rpc.jitter)))
+        return {"title": f"Track {query}", "webpage_url": query, "stream_url": f"https://example.invalid/{query}", "thumbnail": f"https://example.invalid/{query}.jpg", "duration": 180}
+
+    async def fake_thumb(thumbnail_url, webpage, title, chat_id=0):
+        # thumbnail download + card render
+        await asyncio.sleep(max(0.0, rpc.rng.gauss(rpc.latency * 3, rpc.jitter)))
+        return None
+
+    app.extract_audio_url = fake_extract
+    app.get_thumb_from_url_or_webpage = fake_thumb
+    return fake_user
+
+
+def synthetic_stream(chats: int, messages: int, plays: int, seed: int = 0) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    chat_ids = [-1000000000 - i for i in range(chats)]
+    events = [{"kind": "message", "chat_id": rng.choice(chat_ids), "text": "hello"} for _ in range(messages)]
+    events += [{"kind": "play", "chat_id": rng.choice(chat_ids), "text": f"/play song {i}"} for i in range(plays)]
+    rng.shuffle(events)
+    return events
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+async def timed_call(bucket: List[float], coro):
+    start = time.perf_counter()
+    try:
+        await coro
+    except Exception:
+        pass
+    bucket.append(time.perf_counter() - start)
+
+
+async def run_stream(fake_user: FakeClient, events: List[Dict[str, Any]], concurrency: int) -> Dict[str, Any]:
+    latencies: Dict[str, List[float]] = {"auto_react": [], "cmd_play": [], "play_entry": []}
+    sem = asyncio.Semaphore(concurrency)
+    original_play_entry = app.play_entry
+
+    async def play_entry(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await original_play_entry(*args, **kwargs)
+        finally:
+            latencies["play_entry"].append(time.perf_counter() - start)
+
+    app.play_entry = play_entry
+
+    async def dispatch(ev: Dict[str, Any]):
+        async with sem:
+            msg = FakeMessage(fake_user, ev["chat_id"], ev.get("text") or "")
+            if ev["kind"] == "play":
+                await timed_call(latencies["cmd_play"], app.cmd_play(fake_user, msg))
+            else:
+                await timed_call(latencies["auto_react"], app.auto_react(fake_user, msg))
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(dispatch(ev) for ev in events))
+    finally:
+        app.play_entry = original_play_entry
+    wall = time.perf_counter() - start
+    return {"wall": wall, "latencies": latencies}
+
+
+async def bench_timers(fake_user: FakeClient, chats: int, seconds: float, interval: float) -> Dict[str, Any]:
+    app.RADIO_TIMER_INTERVAL = interval
+    before = fake_user.rpc.calls["EditMessage"]
+    tasks = [asyncio.create_task(app.update_radio_timer(-2000000000 - i, i + 1, "Bench", time.time())) for i in range(chats)]
+    await asyncio.sleep(seconds)
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    edits = fake_user.rpc.calls["EditMessage"] - before
+    return {"edits": edits, "edits_per_s": edits / seconds}
+
+
+async def cleanup():
+    for session in app.sessions:
+        await app.leave_voice_chat(session.chat_id)
+    await asyncio.sleep(0)
+    leftover = app.sessions.stats()
+    if leftover["sessions"] or leftover["tasks"]:
+        print(f"leaked playback state: {leftover}")
+    app.react_cache.clear()
+    app.allowed_reactions_cache.clear()
+
+
+def report(title: str, result: Dict[str, Any], rpc: FakeRPC):
+    print(f"\n== {title} (wall {result['wall']:.2f}s)")
+    print(f"{'handler':<12} {'count':>7} {'per_s':>9} {'p50_ms':>9} {'p99_ms':>9}")
+    for name, values in result["latencies"].items():
+        if not values:
+            continue
+        print(f"{name:<12} {len(values):>7} {len(values) / result['wall']:>9.1f} "
+              f"{percentile(values, 50) * 1000:>9.1f} {percentile(values, 99) * 1000:>9.1f}")
+    stages = [(dict(labels).get("stage"), h) for (name, labels), h in app.metrics.histograms.items() if name == "play_stage_seconds"]
+    if stages:
+        print("play_entry stages (mean ms): " + ", ".join(f"{stage}={h[-2] / h[-1] * 1000:.1f}" for stage, h in sorted(stages) if h[-1]))
+    print("RPCs: " + ", ".join(f"{k}={v}" for k, v in sorted(rpc.calls.items())))
+    if rpc.floods:
+        print("FloodWaits: " + ", ".join(f"{k}={v}" for k, v in sorted(rpc.floods.items())))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", default="10,100,1000", help="comma separated chat counts")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--plays", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=64, help="updates handled at once (Pyrogram workers)")
+    parser.add_argument("--rpc-latency", type=float, default=0.03)
+    parser.add_argument("--rpc-jitter", type=float, default=0.01)
+    parser.add_argument("--floodwait-rate", type=float, default=0.0)
+    parser.add_argument("--floodwait-seconds", type=float, default=0.2)
+    parser.add_argument("--timer-seconds", type=float, default=2.0)
+    parser.add_argument("--replay", help="JSONL update stream to replay instead of synthetic updates")
+    parser.add_argument("--record", help="write the synthetic update stream to this JSONL file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's own log output")
+    args = parser.parse_args()
+    if not args.verbose:
+        app.logger.setLevel(logging.CRITICAL)
+
+    rpc = FakeRPC(args.rpc_latency, args.rpc_jitter, args.floodwait_rate, args.floodwait_seconds, args.seed)
+    fake_user = install_fakes(rpc)
+
+    if args.replay:
+        with open(args.replay, "r", encoding="utf-8") as f:
+            streams = [("replay " + os.path.basename(args.replay), [json.loads(line) for line in f if line.strip()])]
+    else:
+        streams = [(f"{n} chats", synthetic_stream(n, args.messages, args.plays, args.seed))
+                   for n in [int(c) for c in args.chats.split(",") if c.strip()]]
+    if args.record and not args.replay:
+        with open(args.record, "w", encoding="utf-8") as f:
+            for _, events in streams:
+                for ev in events:
+                    f.write(json.dumps(ev) + "\n")
+
+    for title, events in streams:
+        rpc.reset()
+        app.metrics.histograms.clear()
+        result = await run_stream(fake_user, events, args.concurrency)
+        report(title, result, rpc)
+        print("sessions: " + ", ".join(f"{k}={v}" for k, v in app.sessions.stats().items()))
+        await cleanup()
+        chats = len({ev["chat_id"] for ev in events})
+        rpc.reset()
+        timers = await bench_timers(fake_user, chats, args.timer_seconds, interval=0.5)
+        print(f"update_radio_timer: {chats} timers -> {timers['edits']} edits ({timers['edits_per_s']:.1f}/s)")
+    if app.TRACE_FILE:
+        print(f"traces: {app.trace_exporter.flush()} spans appended to {app.TRACE_FILE} (summarise with trace_report.py)")
+    app.shard_router.shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Load test for SHARD_WORKERS: renders now-playing cards for many chats through
+ShardRouter with 0 (thread pool), 1, 2, 4 ... worker processes and prints throughput.
+
+Usage: python bench_shards.py [--cards 64] [--chats 16] [--workers 0,1,2,4]
+No Telegram login is made; app.py is imported with placeholder credentials.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ["MONGO_URI"] = ""
+
+import app  # noqa: E402
+from PIL import Image  # noqa: E402
+
+
+def make_source_image(path: str) -> None:
+    img = Image.new("RGB", (1280, 720))
+    px = img.load()
+    for x in range(0, 1280, 4):
+        for y in range(0, 720, 4):
+            px[x, y] = (x % 256, y % 256, (x * y) % 256)
+    img.save(path)
+
+
+async def run_load(router: "app.ShardRouter", src: str, cards: int, chats: int) -> float:
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        router.run(-1000 - (i % chats), app._render_overlay_sync, src, f"bench_{i}", f"Bench track {i}")
+        for i in range(cards)
+    ))
+    return time.perf_counter() - start
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cards", type=int, default=64)
+    parser.add_argument("--chats", type=int, default=16)
+    parser.add_argument("--workers", default=f"0,1,2,{os.cpu_count() or 4}")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "src.png")
+        make_source_image(src)
+        baseline = None
+        print(f"{'workers':>8} {'seconds':>9} {'cards/s':>9} {'speedup':>8}")
+        for n in [int(w) for w in args.workers.split(",") if w.strip()]:
+            router = app.ShardRouter(n)
+            # warm the worker processes so start-up cost is not measured
+            await run_load(router, src, max(n, 1), max(n, 1))
+            elapsed = await run_load(router, src, args.cards, args.chats)
+            router.shutdown()
+            rate = args.cards / elapsed
+            baseline = baseline or rate
+            print(f"{n:>8} {elapsed:>9.2f} {rate:>9.1f} {rate / baseline:>7.2f}x")
+    for i in range(args.cards):
+        try:
+            os.remove(os.path.join(app.THUMB_CACHE_DIR, f"bench_{i}.png"))
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
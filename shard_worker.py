@@ -0,0 +1,295 @@
+"""
+Blocking work that ShardRouter runs in worker processes: now-playing card rendering
+and yt-dlp extraction.
+
+This module must stay free of side effects at import time (no clients, handlers,
+event loop or database). Worker processes are started with the "spawn" method, which
+imports it as the child's main module instead of app.py.
+"""
+import os
+import logging
+from typing import TYPE_CHECKING, Optional, Dict, Any
+from urllib.parse import urlparse
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+logger = logging.getLogger("dlk_userbot")
+
+youtube_dl = None
+
+THUMB_CACHE_DIR = "cache"
+PLAYLIST_LIMIT = int(os.environ.get("PLAYLIST_LIMIT", "200") or 200)
+# Quality profiles: target audio bitrate (kbps) close to what the voice call sends anyway
+AUDIO_PROFILES = {"low": 48, "medium": 96, "high": 160}
+AUDIO_PROFILE = os.environ.get("AUDIO_PROFILE", "medium").lower()
+if AUDIO_PROFILE not in AUDIO_PROFILES:
+    AUDIO_PROFILE = "medium"
+
+# ===================== YT / stream extraction =====================
+class ExtractorUnavailable(Exception):
+    """yt-dlp failed for a reason outside the query: network error, rate limit (HTTP 429) or a 5xx."""
+
+_NETWORK_ERROR_NAMES = {"TransportError", "ConnectionError", "TimeoutError", "SSLError", "ProxyError", "IncompleteRead", "URLError"}
+_NETWORK_ERROR_TEXT = ("http error 429", "too many requests", "timed out", "connection reset", "connection refused",
+                       "temporary failure in name resolution", "network is unreachable", "remote end closed connection")
+
+def _is_network_error(exc: BaseException) -> bool:
+    """Walks yt-dlp's error chain (DownloadError.exc_info, ExtractorError.cause, __cause__) for a transport-level cause."""
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if isinstance(exc, OSError) or any(c.__name__ in _NETWORK_ERROR_NAMES for c in type(exc).__mro__):
+            return True
+        status = getattr(exc, "status", None) or getattr(exc, "code", None)
+        if isinstance(status, int) and (status == 429 or 500 <= status < 600):
+            return True
+        if any(t in str(exc).lower() for t in _NETWORK_ERROR_TEXT):
+            return True
+        exc_info = getattr(exc, "exc_info", None)
+        cause = getattr(exc, "cause", None)
+        exc = (exc_info[1] if isinstance(exc_info, tuple) and len(exc_info) > 1 else None) or \
+            (cause if isinstance(cause, BaseException) else None) or exc.__cause__ or exc.__context__
+    return False
+
+def looks_like_url(text: str) -> bool:
+    try:
+        p = urlparse(text)
+        return bool(p.scheme and p.netloc)
+    except Exception:
+        return False
+
+def _load_youtube_dl():
+    global youtube_dl
+    if youtube_dl is None:
+        try:
+            import yt_dlp
+            youtube_dl = yt_dlp
+        except Exception:
+            youtube_dl = None
+    return youtube_dl
+
+def audio_format_selector(profile: str = AUDIO_PROFILE) -> str:
+    """yt-dlp format string: audio-only, opus preferred, at or below the profile bitrate."""
+    abr = AUDIO_PROFILES.get(profile, AUDIO_PROFILES["medium"])
+    return (
+        f"bestaudio[vcodec=none][acodec=opus][abr<={abr}]"
+        f"/bestaudio[vcodec=none][abr<={abr}]"
+        f"/worstaudio[vcodec=none][acodec=opus]"
+        f"/bestaudio[vcodec=none]"
+        f"/bestaudio/best"
+    )
+
+def _score_format(f: Dict[str, Any], target_abr: int) -> tuple:
+    audio_only = (f.get("vcodec") in (None, "none")) and f.get("acodec") not in (None, "none")
+    is_opus = "opus" in (f.get("acodec") or "")
+    abr = f.get("abr") or f.get("tbr") or 0
+    return (not audio_only, not is_opus, abs(abr - target_abr))
+
+def _format_summary(f: Dict[str, Any], profile: str = AUDIO_PROFILE) -> Dict[str, Any]:
+    return {
+        "format_id": f.get("format_id"),
+        "ext": f.get("ext"),
+        "acodec": f.get("acodec"),
+        "vcodec": f.get("vcodec"),
+        "abr": f.get("abr") or f.get("tbr"),
+        "asr": f.get("asr"),
+        "filesize": f.get("filesize") or f.get("filesize_approx"),
+        "profile": profile,
+    }
+
+def extract_audio_url(query: str, profile: str = AUDIO_PROFILE) -> Optional[Dict[str, Any]]:
+    if _load_youtube_dl() is None:
+        logger.warning("yt_dlp not installed. /play requires yt-dlp.")
+        return None
+    target = query if looks_like_url(query) else f"ytsearch1:{query}"
+    ydl_opts = {
+        "format": audio_format_selector(profile),
+        "quiet": True,
+        "no_warnings": True,
+        "skip_download": True,
+        "noplaylist": True,
+    }
+    try:
+        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(target, download=False)
+            if not info:
+                return None
+            if "entries" in info and isinstance(info["entries"], list) and info["entries"]:
+                info = info["entries"][0]
+            return _info_to_track(info, target, profile)
+    except Exception as e:
+        logger.warning(f"yt_dlp extraction failed for {query}: {e}")
+        if _is_network_error(e):
+            raise ExtractorUnavailable(str(e)) from None
+        return None
+
+def _info_to_track(info: Dict[str, Any], target: str, profile: str = AUDIO_PROFILE) -> Optional[Dict[str, Any]]:
+    stream_url = info.get("url")
+    chosen = info.get("requested_formats", [None])[0] if info.get("requested_formats") else info
+    if not stream_url and "formats" in info:
+        target_abr = AUDIO_PROFILES[profile]
+        candidates = [f for f in info.get("formats", []) if f.get("url") and f.get("acodec") not in (None, "none")]
+        if candidates:
+            chosen = min(candidates, key=lambda f: _score_format(f, target_abr))
+            stream_url = chosen.get("url")
+    if not stream_url:
+        logger.warning("yt_dlp did not return playable stream URL.")
+        return None
+    fmt = _format_summary(chosen or {}, profile)
+    if not fmt["filesize"] and fmt["abr"] and info.get("duration"):
+        fmt["filesize"] = int(fmt["abr"] * 1000 / 8 * info["duration"])
+    return {
+        "title": info.get("title") or "Unknown",
+        "webpage_url": info.get("webpage_url") or info.get("id") or target,
+        "stream_url": stream_url,
+        "thumbnail": info.get("thumbnail"),
+        "duration": int(info.get("duration")) if info.get("duration") else None,
+        "format": fmt,
+    }
+
+def track_to_entry(info: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "title": info.get("title"),
+        "stream_url": info.get("stream_url"),
+        "webpage": info.get("webpage_url"),
+        "thumbnail": info.get("thumbnail"),
+        "duration": info.get("duration"),
+        "is_local": False,
+        "format": info.get("format"),
+    }
+
+def _flat_to_entry(item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Placeholder queue entry from a flat playlist/search item; stream_url is filled in by resolve_entry."""
+    page = item.get("webpage_url") or item.get("url")
+    if not page:
+        return None
+    if not looks_like_url(page) and item.get("ie_key") == "Youtube":
+        page = f"https://www.youtube.com/watch?v={page}"
+    thumbs = item.get("thumbnails") or []
+    return {
+        "title": item.get("title") or page,
+        "stream_url": None,
+        "webpage": page,
+        "thumbnail": item.get("thumbnail") or (thumbs[-1].get("url") if thumbs else None),
+        "duration": int(item["duration"]) if item.get("duration") else None,
+        "is_local": False,
+        "lazy": True,
+    }
+
+def extract_tracks(query: str, limit: int = PLAYLIST_LIMIT, playlist: bool = False, profile: str = AUDIO_PROFILE) -> Optional[Dict[str, Any]]:
+    """Playlist URL or ytsearchN query -> {"title", "entries"} using flat extraction (no per-track requests).
+
+    A plain video URL is fully extracted in the same call and returned as a single resolved entry.
+    So is a video URL carrying a playlist (watch?v=...&list=...) unless `playlist` is set;
+    /playlist?list= URLs and searches are always listed. `profile` caps the source bitrate
+    of that resolved entry like extract_audio_url does.
+    """
+    if _load_youtube_dl() is None:
+        logger.warning("yt_dlp not installed. /play requires yt-dlp.")
+        return None
+    ydl_opts = {
+        "format": audio_format_selector(profile),
+        "quiet": True,
+        "no_warnings": True,
+        "skip_download": True,
+        "noplaylist": not playlist,
+        "extract_flat": "in_playlist",
+        "playlistend": limit,
+    }
+    try:
+        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(query, download=False)
+    except Exception as e:
+        logger.warning(f"yt_dlp extraction failed for {query}: {e}")
+        if _is_network_error(e):
+            raise ExtractorUnavailable(str(e)) from None
+        return None
+    if not info:
+        return None
+    if "entries" not in info:
+        track = _info_to_track(info, query, profile)
+        return {"title": info.get("title"), "entries": [track_to_entry(track)] if track else []}
+    entries = []
+    for item in info.get("entries") or []:
+        entry = _flat_to_entry(item or {})
+        if entry:
+            entries.append(entry)
+        if len(entries) >= limit:
+            break
+    return {"title": info.get("title"), "entries": entries}
+
+# ===================== now-playing card =====================
+def clear_title(text: str) -> str:
+    parts = (text or "").split(" ")
+    title = ""
+    for i in parts:
+        if len(title) + len(i) < 60:
+            title += " " + i
+    return title.strip()
+
+def _create_circular_artwork(image: "Image.Image", diameter: int = 520, border: int = 8) -> "Image.Image":
+    from PIL import Image, ImageDraw, ImageFilter, ImageOps
+    try:
+        square = ImageOps.fit(image, (diameter, diameter), centering=(0.5, 0.5))
+    except Exception:
+        square = image.resize((diameter, diameter), Image.LANCZOS)
+    mask = Image.new('L', (diameter, diameter), 0)
+    draw = ImageDraw.Draw(mask)
+    draw.ellipse((0, 0, diameter, diameter), fill=255)
+    circ = Image.new('RGBA', (diameter, diameter), (0, 0, 0, 0))
+    circ.paste(square.convert('RGBA'), (0, 0), mask=mask)
+    out_size = diameter + border * 2
+    out = Image.new('RGBA', (out_size, out_size), (0, 0, 0, 0))
+    shadow = Image.new('RGBA', (out_size, out_size), (0, 0, 0, 0))
+    shadow_mask = Image.new('L', (out_size, out_size), 0)
+    draw_sm = ImageDraw.Draw(shadow_mask)
+    draw_sm.ellipse((border//2, border//2, out_size - border//2, out_size - border//2), fill=200)
+    shadow.putalpha(shadow_mask)
+    shadow = shadow.filter(ImageFilter.GaussianBlur(radius=6))
+    out = Image.alpha_composite(out, shadow)
+    border_layer = Image.new('RGBA', (out_size, out_size), (255, 255, 255, 0))
+    draw_bl = ImageDraw.Draw(border_layer)
+    draw_bl.ellipse((border, border, out_size - border, out_size - border), fill=(255, 255, 255, 255))
+    inner_margin = border + 4
+    draw_bl.ellipse((inner_margin, inner_margin, out_size - inner_margin, out_size - inner_margin), fill=(0, 0, 0, 0))
+    out = Image.alpha_composite(out, border_layer)
+    paste_pos = (border, border)
+    out.paste(circ, paste_pos, circ)
+    return out
+
+def _render_overlay_sync(src_path: str, out_key: str, title: str) -> Optional[str]:
+    try:
+        from PIL import Image, ImageDraw, ImageEnhance, ImageFilter, ImageFont, ImageOps
+        image = Image.open(src_path).convert("RGBA")
+        try:
+            background = ImageOps.fit(image, (1280, 720), centering=(0.5, 0.5)).convert("RGBA")
+        except Exception:
+            background = image.resize((1280, 720), Image.LANCZOS).convert("RGBA")
+        background = background.filter(ImageFilter.BoxBlur(6))
+        enhancer = ImageEnhance.Brightness(background)
+        background = enhancer.enhance(0.85)
+        art = _create_circular_artwork(image, diameter=520, border=10)
+        art_x = 60
+        art_y = (720 - art.size[1]) // 2
+        background.paste(art, (art_x, art_y), art)
+        draw = ImageDraw.Draw(background)
+        try:
+            title_font = ImageFont.truetype("arial.ttf", 48)
+            small_font = ImageFont.truetype("arial.ttf", 18)
+        except Exception:
+            title_font = ImageFont.load_default()
+            small_font = ImageFont.load_default()
+        draw.text((20, 20), "DLK DEVELOPER", fill="white", font=small_font)
+        title_x = art_x + art.size[0] + 30
+        title_y = art_y + 30
+        shadow_color = (0, 0, 0, 200)
+        for dx, dy in ((1, 1), (2, 2)):
+            draw.text((title_x + dx, title_y + dy), clear_title(title), fill=shadow_color, font=title_font)
+        draw.text((title_x, title_y), clear_title(title), fill="white", font=title_font)
+        out_path = os.path.join(THUMB_CACHE_DIR, f"{out_key}.png")
+        background.save(out_path)
+        return out_path
+    except Exception as e:
+        logger.debug(f"_process_image failed: {e}")
+        return None
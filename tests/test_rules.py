@@ -0,0 +1,89 @@
+"""Unit tests for the reaction-rule matchers (AhoCorasick, CompiledRules, rule_regex_error) and the allowed-reactions lookup."""
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "test")
+os.environ["MONGO_URI"] = ""
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def rule(pattern, *emojis, regex=False):
+    return {"pattern": pattern, "regex": regex, "emojis": {e: 1.0 for e in emojis}}
+
+
+def test_aho_corasick_finds_every_occurrence():
+    ac = app.AhoCorasick(["he", "she", "his", "hers"])
+    found = sorted((idx, end) for idx, end in ac.iter_matches("ushers"))
+    assert found == [(0, 4), (1, 4), (3, 6)]
+
+
+def test_aho_corasick_overlapping_and_repeated():
+    ac = app.AhoCorasick(["aa", "a"])
+    assert sorted(ac.iter_matches("aaa")) == [(0, 2), (0, 3), (1, 1), (1, 2), (1, 3)]
+
+
+def test_keywords_match_on_word_boundaries_case_insensitively():
+    compiled = app.CompiledRules([rule("cat", "🔥")])
+    assert compiled.match("My CAT sleeps") == 0
+    assert compiled.match("concatenate") is None
+    assert compiled.match("cat") == 0
+
+
+def test_earliest_rule_wins():
+    compiled = app.CompiledRules([
+        rule("world", "👍"),
+        rule("hello", "❤"),
+        rule(r"h\w+o", "🔥", regex=True),
+    ])
+    assert compiled.match("hello world") == 0
+    assert compiled.match("hello there") == 1
+    assert compiled.match("hippo") == 2
+
+
+def test_regex_rules_use_their_own_index():
+    compiled = app.CompiledRules([rule("x", "👍"), rule(r"\d{3}", "❤", regex=True), rule("a|b", "🔥", regex=True)])
+    assert compiled.match("code 123") == 1
+    assert compiled.match("b") == 2
+
+
+def test_choose_respects_allowed_emojis():
+    compiled = app.CompiledRules([rule("hi", "👍", "❤")])
+    assert compiled.choose("hi there", ("❤",)) == "❤"
+    assert compiled.choose("hi there", ("🔥",)) is None
+    assert compiled.choose("nothing", ("❤",)) is None
+
+
+def test_rule_regex_error_rejects_unsafe_patterns():
+    assert app.rule_regex_error(r"colou?r") is None
+    assert app.rule_regex_error(r"(?i:abc)def") is None
+    assert "Backreferences" in app.rule_regex_error(r"(a)\1")
+    assert "Backreferences" in app.rule_regex_error(r"(a)?(?(1)b|c)")
+    assert "Named groups" in app.rule_regex_error(r"(?P<x>a)")
+    assert "Global inline flags" in app.rule_regex_error(r"(?i)abc")
+    assert app.rule_regex_error(r"a)|(b").startswith("Invalid regex")
+
+
+def test_unsafe_stored_regex_is_skipped_not_fatal():
+    compiled = app.CompiledRules([rule(r"(a)\1", "👍", regex=True), rule(r"b+", "❤", regex=True)])
+    assert compiled.match("aa") is None
+    assert compiled.match("bbb") == 1
+
+
+def test_restricted_reactions_keep_emojis_with_variation_selectors(monkeypatch):
+    # Telegram reports emoticons without U+FE0F, e.g. "❤" and "❤‍🔥" for VALID_EMOJIS' "❤️" and "❤️‍🔥"
+    chosen = ["❤️", "❤️‍🔥", "👍"]
+    reactions = [SimpleNamespace(emoji=e.replace("\ufe0f", "")) for e in chosen]
+    chat = SimpleNamespace(available_reactions=SimpleNamespace(all_are_enabled=False, reactions=reactions))
+
+    async def get_chat(chat_id):
+        return chat
+
+    monkeypatch.setattr(app.user_app, "get_chat", get_chat)
+    allowed = asyncio.run(app._fetch_allowed_reactions(-100))
+    assert sorted(allowed) == sorted(chosen)
+    assert all(e in app.VALID_EMOJIS for e in allowed)
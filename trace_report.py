@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Per-stage latency breakdown from the spans the bot writes to TRACE_FILE.
+
+Groups spans by name and prints count, p50/p95/p99/max duration, mean self time
+(duration minus time covered by child spans) and the share of the root spans'
+time each stage accounts for. --slowest N also prints the N slowest traces as
+span trees, which shows where one particular slow /play spent its time.
+
+Usage:
+  python trace_report.py traces.jsonl
+  python trace_report.py traces.jsonl --root cmd.play --slowest 3
+  python trace_report.py traces.jsonl --trace 3f9c0a1b2c3d4e5f
+"""
+import sys
+import json
+import argparse
+from collections import defaultdict
+from typing import Any, Dict, List
+
+
+def load(path: str) -> List[Dict[str, Any]]:
+    spans = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                spans.append(json.loads(line))
+            except ValueError:
+                continue  # a line cut short by a crash mid-write
+    return spans
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def covered_ms(children: List[Dict[str, Any]]) -> float:
+    """Wall time covered by the children's intervals; overlapping (concurrent) children count once."""
+    intervals = sorted((c["ts"], c["ts"] + c["duration_ms"] / 1000) for c in children)
+    total, end = 0.0, float("-inf")
+    for start, stop in intervals:
+        if stop <= end:
+            continue
+        total += stop - max(start, end)
+        end = stop
+    return total * 1000
+
+
+def print_tree(span: Dict[str, Any], children: Dict[str, List[Dict[str, Any]]], origin: float, depth: int = 0) -> None:
+    offset = (span["ts"] - origin) * 1000
+    attrs = " ".join(f"{k}={v}" for k, v in (span.get("attrs") or {}).items())
+    error = f"  !! {span['error']}" if span.get("error") else ""
+    print(f"  {'  ' * depth}{span['name']:<{32 - 2 * depth}} +{offset:>8.1f}ms {span['duration_ms']:>9.1f}ms  {attrs}{error}")
+    for child in sorted(children.get(span["span_id"], []), key=lambda c: c["ts"]):
+        print_tree(child, children, origin, depth + 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", help="TRACE_FILE written by the bot")
+    parser.add_argument("--root", help="only traces whose root span has this name (e.g. cmd.play)")
+    parser.add_argument("--slowest", type=int, default=0, help="print the N slowest traces as trees")
+    parser.add_argument("--trace", help="print a single trace by id")
+    args = parser.parse_args()
+
+    spans = load(args.file)
+    traces: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for s in spans:
+        traces[s["trace_id"]].append(s)
+
+    roots: Dict[str, Dict[str, Any]] = {}
+    for trace_id, members in traces.items():
+        ids = {s["span_id"] for s in members}
+        top = [s for s in members if not s.get("parent_id") or s["parent_id"] not in ids]
+        if top:
+            roots[trace_id] = max(top, key=lambda s: s["duration_ms"])
+    if args.root:
+        roots = {t: r for t, r in roots.items() if r["name"] == args.root}
+    selected = [s for t in roots for s in traces[t]]
+    if not selected:
+        print("no matching spans")
+        return 1
+
+    children: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for s in selected:
+        if s.get("parent_id"):
+            children[s["parent_id"]].append(s)
+
+    if args.trace:
+        members = traces.get(args.trace)
+        if not members or args.trace not in roots:
+            print(f"trace {args.trace} not found")
+            return 1
+        root = roots[args.trace]
+        print(f"trace {args.trace}: {root['name']} {root['duration_ms']:.1f}ms")
+        print_tree(root, children, root["ts"])
+        return 0
+
+    root_total = sum(r["duration_ms"] for r in roots.values())
+    by_name: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for s in selected:
+        by_name[s["name"]].append(s)
+
+    print(f"{len(roots)} traces, {len(selected)} spans from {args.file}")
+    print(f"{'stage':<28} {'count':>6} {'p50_ms':>9} {'p95_ms':>9} {'p99_ms':>9} {'max_ms':>9} {'self_ms':>9} {'%root':>6} {'errors':>6}")
+    rows = []
+    for name, group in by_name.items():
+        durations = [s["duration_ms"] for s in group]
+        self_ms = [max(0.0, s["duration_ms"] - covered_ms(children.get(s["span_id"], []))) for s in group]
+        errors = sum(1 for s in group if s.get("error"))
+        rows.append((sum(durations), name, durations, self_ms, errors))
+    for total, name, durations, self_ms, errors in sorted(rows, reverse=True):
+        share = total / root_total * 100 if root_total else 0.0
+        print(f"{name:<28} {len(durations):>6} {percentile(durations, 0.5):>9.1f} {percentile(durations, 0.95):>9.1f} "
+              f"{percentile(durations, 0.99):>9.1f} {max(durations):>9.1f} {sum(self_ms) / len(self_ms):>9.1f} {share:>6.1f} {errors:>6}")
+
+    for trace_id, root in sorted(roots.items(), key=lambda kv: -kv[1]["duration_ms"])[:args.slowest]:
+        print(f"\ntrace {trace_id}: {root['name']} {root['duration_ms']:.1f}ms")
+        print_tree(root, children, root["ts"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())